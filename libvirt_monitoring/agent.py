@@ -2,67 +2,317 @@ import logging
 import time
 
 from libvirt_monitoring import base
+from libvirt_monitoring import checkpoint
+from libvirt_monitoring import deadband
 from libvirt_monitoring import inspector
+from libvirt_monitoring import lld
+from libvirt_monitoring import poller
+from libvirt_monitoring import profiler
+from libvirt_monitoring import recorder
+from libvirt_monitoring import sampling
+from libvirt_monitoring import sinks
+from libvirt_monitoring import topn
 from libvirt_monitoring import utils
+from libvirt_monitoring.py_zabbix_api.hsender import HistorySender
 from libvirt_monitoring.py_zabbix_api.zapi import ZabbixAPI
-from libvirt_monitoring.py_zabbix_api.zsender import ZabbixMetric
 from libvirt_monitoring.py_zabbix_api.zsender import ZabbixSender
 
 
 LOG = logging.getLogger(__name__)
 
 
+def _timeout(config):
+    """(connect, read) timeouts of Zabbix API and trapper."""
+    return (float(config.get('zabbix_server-connect_timeout', 5)),
+            float(config.get('zabbix_server-read_timeout', 30)))
+
+
+def _rate_limit(config, endpoint):
+    """(rate, burst) of api or trapper requests, None if unlimited."""
+    rate = float(config.get('zabbix_server-%s_rate' % endpoint, 0))
+    if not rate:
+        return None
+    return (rate, float(config.get('zabbix_server-%s_burst' % endpoint,
+                                   rate)))
+
+
+def _breaker(config):
+    """(failures, latency, reset_timeout) of circuit breakers."""
+    failures = int(config.get('zabbix_server-breaker_failures', 0))
+    if not failures:
+        return None
+    return (failures,
+            float(config.get('zabbix_server-breaker_latency', 0)) or None,
+            float(config.get('zabbix_server-breaker_reset', 30)))
+
+
+def get_zabbix_api(config, url=None, login=True):
+    """Init ZabbixAPI from agent configuration."""
+    return ZabbixAPI(
+        url=url or config['zabbix_server-url'],
+        user=config['zabbix_server-user'],
+        password=config['zabbix_server-password'],
+        timeout=_timeout(config),
+        api_token=config.get('zabbix_server-api_token') or None,
+        token_cache=config.get('zabbix_server-token_cache') or None,
+        rate_limit=_rate_limit(config, 'api'),
+        breaker=_breaker(config),
+        login=login)
+
+
 class LibvirtAgent(object):
 
-    def __init__(self):
+    def __init__(self, config=None):
         # Load config from config.ini file
-        self.config = utils.ini_file_loader()
-        self.inspector = inspector.LibvirtInspector()
+        self.config = config or utils.ini_file_loader()
+        self.poller = None
+        if self.config.get('poller-enabled') == 'True':
+            # Central poller of remote hypervisors.
+            self.poller = poller.RemotePoller(
+                uris=[u.strip() for u in
+                      self.config.get('poller-uris', '').split(',')
+                      if u.strip()],
+                workers=int(self.config.get('poller-workers', 16)),
+                deadline=float(self.config.get('poller-deadline', 30)),
+                keepalive=(
+                    int(self.config.get('poller-keepalive_interval', 5)),
+                    int(self.config.get('poller-keepalive_count', 3))))
+            self.inspector = self.poller
+        else:
+            self.inspector = inspector.LibvirtInspector()
+        # Outputs, e.x: zabbix,openmetrics,udp,file.
+        self.interval = int(self.config.get('default-interval', 60))
+        # Items/triggers provisioning: api (created on demand) or
+        # lld (discovered from template prototypes).
+        self.provisioning = self.config.get('zabbix_agent-provisioning',
+                                            'api')
+        self.sinks = sinks.load_sinks(self, self.config)
+        if any(isinstance(s, sinks.ZabbixSink) for s in self.sinks):
+            self._init_zabbix()
+        self.fanout = sinks.FanOut(self.sinks)
+        # Sample every sample_interval seconds, report aggregates
+        # every interval.
+        self.aggregator = None
+        if self.config.get('sampling-enabled') == 'True':
+            self.aggregator = sampling.Aggregator()
+            self.sample_interval = float(
+                self.config.get('sampling-interval', 5))
+        # Number of domains in noisy neighbour rankings, 0 to disable.
+        self.topn_size = 0
+        if self.config.get('topn-enabled') == 'True':
+            self.topn_size = int(self.config.get('topn-size', 10))
+        # Change-only reporting.
+        self.deadband = None
+        if self.config.get('deadband-enabled') == 'True':
+            self.deadband = deadband.DeadbandFilter(
+                absolute=self.config.get('deadband-absolute', 0),
+                relative=self.config.get('deadband-relative', 0),
+                heartbeat=self.config.get('deadband-heartbeat', 10))
+        # "metric.field" -> if it is in deadband checksums.
+        self._deadband_fields = {}
+        # Counter snapshots checkpoint, rates are valid on the first
+        # cycle after a restart.
+        self.checkpoint_path = None
+        if self.config.get('checkpoint-enabled') == 'True':
+            self.checkpoint_path = self.config.get(
+                'checkpoint-path',
+                '/var/lib/libvirt_monitoring/snapshots.ckpt')
+            self.checkpoint_interval = float(
+                self.config.get('checkpoint-interval', 300))
+            self._next_checkpoint = time.time() + self.checkpoint_interval
+            self.inspector.restore_snapshots(checkpoint.load(
+                self.checkpoint_path,
+                max_age=float(self.config.get('checkpoint-max_age', 600))))
+        # Profiling of cycles on demand, see AgentDaemon signals.
+        self.profiler = profiler.CycleProfiler(
+            self.config.get('profiler-directory',
+                            '/var/lib/libvirt_monitoring/profiles'),
+            cycles=self.config.get('profiler-cycles', 3),
+            mode=self.config.get('profiler-mode', 'sampler'),
+            sample_interval=self.config.get('profiler-sample_interval',
+                                            0.005),
+            top=self.config.get('profiler-top', 25))
+        # Log only one per-item debug record in every debug_sample.
+        self.item_log = utils.SampledLogger(
+            LOG, self.config.get('default-debug_sample', 1))
+        # Trace of libvirt/Zabbix calls, for replay.
+        self.recorder = None
+        if self.config.get('replay-record'):
+            self.recorder = recorder.Recorder(self.config['replay-record'])
+            self.recorder.attach(self)
+
+    def _init_zabbix(self):
         # Config ZabbixSender and ZabbixAPI
-        if self.config['zabbix_agent-use_config'] == 'True':
-            self.zsender = ZabbixSender(use_config=True)
+        sender_opts = dict(
+            timeout=_timeout(self.config),
+            rate_limit=_rate_limit(self.config, 'trapper'),
+            breaker=_breaker(self.config),
+            shed_policy=self.config.get('zabbix_server-shed_policy',
+                                        'drop'),
+            shed_buffer=int(self.config.get('zabbix_server-shed_buffer',
+                                            10000)),
+            compression=self.config.get('zabbix_server-compression') ==
+            'True',
+            delivery_policy=self.config.get('zabbix_server-delivery',
+                                            'broadcast'),
+            probe_interval=float(self.config.get(
+                'zabbix_server-probe_interval', 30)))
+        if self.config.get('zabbix_server-transport') == 'history':
+            # history.push over HTTP(S), where the trapper port is
+            # not reachable.
+            urls = [u.strip() for u in self.config.get(
+                'zabbix_server-history_urls', '').split(',') if u.strip()]
+            del sender_opts['timeout']
+            sender_opts['compression'] = self.config.get(
+                'zabbix_server-history_compression') == 'True'
+            apis = [get_zabbix_api(self.config, url, login=False)
+                    for url in urls or [self.config['zabbix_server-url']]]
+            self.zsender = HistorySender(
+                apis,
+                chunk_size=int(self.config.get(
+                    'zabbix_server-history_chunk_size', 1000)),
+                **sender_opts)
+        elif self.config['zabbix_agent-use_config'] == 'True':
+            self.zsender = ZabbixSender(use_config=True, **sender_opts)
         else:
             self.zsender = ZabbixSender(
                 zabbix_server=self.config['zabbix_server-ip'],
-                zabbix_port=int(self.config['zabbix_server-port']))
-        LOG.debug('Init ZabbixSender object - {}' . format(self.zsender))
-        self.zapi = ZabbixAPI(url=self.config['zabbix_server-url'],
-                              user=self.config['zabbix_server-user'],
-                              password=self.config['zabbix_server-password'])
-        LOG.debug('Init ZabbixAPI object - {}' . format(self.zapi))
+                zabbix_port=int(self.config['zabbix_server-port']),
+                **sender_opts)
+        LOG.debug('Init ZabbixSender object - %s', self.zsender)
+        if self.provisioning == 'lld':
+            # API is only used at install time, see lld.import_template.
+            self.zapi = None
+            return
+        self.zapi = get_zabbix_api(self.config)
+        LOG.debug('Init ZabbixAPI object - %s', self.zapi)
 
     def run(self):
         """Run Agent forever.
         """
+        self.fanout.start()
+        try:
+            if self.aggregator:
+                self._run_sampling()
+            while True:
+                LOG.debug('Starting agent, get and send metrics')
+                self.profiler.run(self.get_and_send_metrics)
+                self._maybe_checkpoint()
+                time.sleep(self.interval)
+        finally:
+            # Shutdown, e.x: SIGTERM.
+            self.save_checkpoint()
+            if self.recorder:
+                self.recorder.close()
+
+    def save_checkpoint(self):
+        if self.checkpoint_path:
+            checkpoint.save(self.checkpoint_path,
+                            self.inspector.export_snapshots())
+
+    def _maybe_checkpoint(self):
+        """Checkpoint periodically, a crash loses at most one
+        checkpoint interval of snapshots.
+        """
+        if self.checkpoint_path and time.time() >= self._next_checkpoint:
+            self.save_checkpoint()
+            self._next_checkpoint = time.time() + self.checkpoint_interval
+
+    def _run_sampling(self):
+        """Sample metrics at high rate, send their aggregates
+        once per interval.
+        """
+        next_report = time.time() + self.interval
         while True:
-            LOG.debug('Starting agent, get and send metrics')
-            self.get_and_send_metrics()
-            time.sleep(60)
+            started = time.time()
+            self.aggregator.add(
+                self.profiler.run(self.inspector.get_vm_metrics))
+            self._maybe_checkpoint()
+            if started >= next_report:
+                LOG.debug('Send aggregates of %d samples',
+                          self.aggregator.samples)
+                self.send_metrics(self.aggregator.flush())
+                next_report += self.interval
+                if next_report <= started:
+                    # Cycles overran, do not try to catch up.
+                    next_report = started + self.interval
+            time.sleep(max(self.sample_interval -
+                           (time.time() - started), 0))
 
     def get_and_send_metrics(self):
         """Get metrics from inspector
-        send it to ZabbixServer.
+        hand them to all configured outputs.
+        """
+        self.send_metrics(self.inspector.get_vm_metrics())
+
+    def send_metrics(self, all_metrics):
+        """Hand {uuid: metrics} to all configured outputs.
         """
-        all_metrics = self.inspector.get_vm_metrics()
+        if self.deadband:
+            self.deadband.next_cycle(all_metrics)
+        items = []
         for vm, vm_metrics in all_metrics.items():
+            if self.deadband and self.deadband.unchanged(
+                    vm, self._deadband_values(vm_metrics)):
+                continue
+            vm_items = []
             for metric_key, metric_value in vm_metrics.items():
                 if not metric_value:
-                    msg = ('Failed when get %(metric)s' %
-                           {'metric': metric_key})
-                    LOG.error(msg)
+                    LOG.error('Failed when get %s', metric_key)
                 else:
                     for f in metric_value._fields:
                         # Item key, example: cpustats.number[instance-000002ee]
-                        item_key = "{}.{}[{}]" . format(metric_key, f, vm)
+                        if self.provisioning == 'lld':
+                            item_key = lld.item_key(metric_key, f, vm)
+                        else:
+                            item_key = "{}.{}[{}]" . format(metric_key, f, vm)
                         item_name = "{} - {} - {}" . format(vm.title(),
                                                             metric_key.title(),
                                                             f.title())
                         item_value = getattr(metric_value, f)
-                        LOG.debug('Get item {} = {}' . format(
-                            item_key, item_value))
-                        self.send_item(base.Item(key=item_key,
-                                                 name=item_name,
-                                                 value=item_value))
+                        if item_value is None:
+                            # e.x: rates on first cycle.
+                            continue
+                        self.item_log.debug('Get item %s = %s',
+                                            item_key, item_value)
+                        vm_items.append(base.Item(key=item_key,
+                                                  name=item_name,
+                                                  value=item_value))
+            items.extend(vm_items)
+        if self.deadband:
+            LOG.info('Deadband skipped %d unchanged domains',
+                     self.deadband.skipped)
+        host_items = []
+        if self.topn_size:
+            host_items = topn.items(topn.rank(all_metrics, self.topn_size))
+        if self.poller:
+            host_items.extend(self.poller.status_items())
+        elif self.inspector.budget is not None:
+            host_items.extend(self.inspector.budget.items())
+        # Sinks share the batch, each one sends it from its own thread.
+        self.fanout.publish(sinks.Batch(
+            self.config.get('zabbix_agent-hostname'), all_metrics, items,
+            host_items=host_items))
+
+    def _deadband_values(self, vm_metrics):
+        """Values of a domain which may be sent, the ones with
+        a threshold, for its deadband checksum.
+        """
+        values = []
+        for metric_key, metric_value in vm_metrics.items():
+            if not metric_value:
+                continue
+            for f, value in zip(metric_value._fields, metric_value):
+                name = metric_key + '.' + f
+                tracked = self._deadband_fields.get(name)
+                if tracked is None:
+                    item = base.Item(key=name, name=name, value=None)
+                    tracked = (name not in deadband.COUNTERS and
+                               self._check_threshold_item(item) is not None)
+                    self._deadband_fields[name] = tracked
+                if tracked and value is not None:
+                    values.append((name, value))
+        return frozenset(values)
 
     def get_agent_hostid(self):
         """Get agent hostid.
@@ -79,7 +329,7 @@ class LibvirtAgent(object):
                 you have more than one host with hostname {}'
                      . format(self.config['zabbix_agent-hostname']))
         elif len(resp['result']) == 1:
-            LOG.info('Hostid {}' . format(resp['result'][0]['hostid']))
+            LOG.info('Hostid %s', resp['result'][0]['hostid'])
             return resp['result'][0]['hostid']
         else:
             LOG.exception('Unknow hostname {}' .
@@ -124,10 +374,10 @@ class LibvirtAgent(object):
             else:
                 LOG.error('Not found hostid!')
         except Exception as e:
-            LOG.error('Error when creating trigger - {}!' . format(e))
+            LOG.error('Error when creating trigger - %s!', e)
             raise e
 
-    def create_item(self, item):
+    def create_item(self, item, value_type=0):
         """Create item
         """
         # Get agent hostid
@@ -148,12 +398,12 @@ class LibvirtAgent(object):
                     'name': item.name,
                     'key_': item.key,
                     'hostid': _hostid,
-                    'value_type': 0,
+                    'value_type': value_type,
                     'type': 2,
                 }
 
                 self.zapi.do_request('item.create', create_params)
-                LOG.info('Created new item with key {}' . format(item.key))
+                LOG.info('Created new item with key %s', item.key)
         else:
             LOG.error('Not found hostid!')
 
@@ -174,35 +424,87 @@ class LibvirtAgent(object):
                 return t
         return None
 
-    def send_item(self, item):
-        """Send item to Zabbix Server.
+    def _over_threshold(self, item):
+        """Check if item value is over its defined threshold.
+        """
+        _metric = self._check_threshold_item(item)
+        if not _metric:
+            return False
+        if abs(item.value) > float(self.config[_metric]):
+            self.item_log.debug('Metric (%s = %s) > %s',
+                                item.key, item.value, self.config[_metric])
+            return True
+        self.item_log.debug('Metric (%s = %s) <= %s',
+                            item.key, item.value, self.config[_metric])
+        return False
 
-        Check if item value is over its threshold
-        create item (if it is't existed) and send value
-        to Zabbix Server.
+    def send_items(self, batch):
+        """Send items of a batch to Zabbix Server.
+
+        Items over their threshold are created (if they don't
+        exist yet) and their values sent together, from the batch's
+        shared encoding.
         """
-        try:
-            _metric = self._check_threshold_item(item)
-            if _metric:
-                # Item value > Defined Threshold, send it to Zabbix Server
-                if abs(item.value) > float(self.config[_metric]):
+        messages = batch.encode('json')
+        provision = self.provisioning != 'lld'
+        over = []
+        for i, item in enumerate(batch.items):
+            try:
+                if self._over_threshold(item):
+                    over.append(i)
+                elif self.deadband:
+                    self.deadband.forget(item)
+            except Exception as e:
+                LOG.error('Error when checking item %s - %s', item.key, e)
+        if self.deadband:
+            # Change-only reporting of items over their threshold.
+            keys = set(item.key for item in self.deadband.filter(
+                [batch.items[i] for i in over]))
+            over = [i for i in over if batch.items[i].key in keys]
+            LOG.info('Deadband suppressed %d items',
+                     self.deadband.suppressed)
+        selected = []
+        for i in over:
+            try:
+                if provision:
                     # Create item first, if it's not existed
-                    self.create_item(item)
-                    LOG.debug('Metric ({} = {}) > {}' . format(
-                        item.key, item.value,
-                        int(self.config[_metric])))
-                    metrics = \
-                        [ZabbixMetric(self.config['zabbix_agent-hostname'],
-                                      item.key, item.value)]
-                    result = self.zsender.send(metrics)
-                    LOG.info('Send metric {} : {}' . format(item.name,
-                                                            result))
-                    # Create trigger for this item.
-                    self.create_trigger(item)
-                else:
-                    LOG.debug('Metric ({} = {}) <= {}' . format(
-                        item.key, item.value,
-                        int(self.config[_metric])))
-        except Exception as e:
-            LOG.error(
-                'Error when send metric to Zabbix Server - {}' . format(e))
+                    self.create_item(batch.items[i])
+                selected.append(i)
+            except Exception as e:
+                LOG.error('Error when creating item %s - %s',
+                          batch.items[i].key, e)
+
+        to_send = [messages[i] for i in selected]
+        # Host level items (e.x: rankings) have no threshold.
+        to_send.extend(messages[len(batch.items):])
+        if provision:
+            for item in batch.host_items:
+                try:
+                    # Text item.
+                    self.create_item(item, value_type=4)
+                except Exception as e:
+                    LOG.error('Error when creating item %s - %s',
+                              item.key, e)
+        else:
+            # Zabbix creates items/triggers from discovered domains,
+            # vNICs and disks.
+            to_send[:0] = [str(m) for m in lld.discovery_metrics(
+                batch.host, batch.metrics, batch.clock)]
+        if not to_send:
+            return
+
+        result = self.zsender.send_messages(to_send)
+        LOG.info('Send %d metrics : %s', len(to_send), result)
+        if self.deadband:
+            self.deadband.sent([batch.items[i] for i in selected])
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Trapper stats: %s', self.zsender.target_stats())
+        if not provision:
+            return
+        for i in selected:
+            try:
+                # Create trigger for this item.
+                self.create_trigger(batch.items[i])
+            except Exception as e:
+                LOG.error('Error when creating trigger of %s - %s',
+                          batch.items[i].key, e)
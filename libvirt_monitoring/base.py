@@ -1,7 +1,4 @@
 import collections
-import re
-import subprocess
-import sys
 
 
 # Named tuple representing Domain State.
@@ -14,8 +11,15 @@ StateStats = collections.namedtuple('StateStats', ['state'])
 #
 # number: number of CPUs
 # time: cumulative CPU time
+# util: CPU utilization (percent), normalized by number of CPUs
 #
-CPUStats = collections.namedtuple('CPUStats', ['number', 'time'])
+CPUStats = collections.namedtuple('CPUStats', ['number', 'time', 'util'])
+
+# Named tuple representing vCPU statistics.
+#
+# util: vCPU utilization (percent)
+#
+VCPUStats = collections.namedtuple('VCPUStats', ['util'])
 
 # Named tuple representing Memory usage statistics.
 #
@@ -111,15 +115,7 @@ class NoDataException(InspectorException):
     pass
 
 
-class IOStatError(Exception):
-    pass
-
-
-class CmdError(IOStatError):
-    pass
-
-
-class ParseError(IOStatError):
+class ConnectionUnavailable(InspectorException):
     pass
 
 
@@ -138,138 +134,3 @@ class AgentLogger(object):
         # Only log if there is a message (not just a new line)
         if message.rstrip() != "":
             self.logger.log(self.level, message.rstrip())
-
-
-# Class IOStat is inherited from collecd-iostat-python
-# with a little customization.
-# https://github.com/deniszh/collectd-iostat-python/
-
-class IOStat(object):
-    def __init__(self, interval=2, count=2, disks=[]):
-        self.path = self._get_iostat_path()
-        self.interval = interval
-        self.count = count
-        self.disks = disks
-
-    def _get_iostat_path(self):
-        proc = subprocess.Popen('which iostat',
-                                shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        path, error = proc.communicate()
-        if error:
-            raise Exception()
-        else:
-            return path.rstrip()
-
-    def parse_diskstats(self, input):
-        """
-        Parse iostat -d and -dx output.If there are more
-        than one series of statistics, get the last one.
-        By default parse statistics for all avaliable block devices.
-
-        @type input: C{string}
-        @param input: iostat output
-
-        @type disks: list of C{string}s
-        @param input: lists of block devices that
-        statistics are taken for.
-
-        @return: C{dictionary} contains per block device statistics.
-        Statistics are in form of C{dictonary}.
-        Main statistics:
-          tps  Blk_read/s  Blk_wrtn/s  Blk_read  Blk_wrtn
-        Extended staistics (available with post 2.5 kernels):
-          rrqm/s  wrqm/s  r/s  w/s  rsec/s  wsec/s  rkB/s  wkB/s  avgrq-sz \
-          avgqu-sz  await  svctm  %util
-        See {man iostat} for more details.
-        """
-        dstats = {}
-        dsi = input.rfind('Device:')
-        if dsi == -1:
-            raise ParseError('Unknown input format: %r' % input)
-
-        ds = input[dsi:].splitlines()
-        hdr = ds.pop(0).split()[1:]
-
-        for d in ds:
-            if d:
-                d = d.split()
-                d = [re.sub(r',', '.', element) for element in d]
-                dev = d.pop(0)
-                if (dev in self.disks) or not self.disks:
-                    dstats[dev] = dict([(k, float(v)) for k, v in zip(hdr, d)])
-
-        return dstats
-
-    def sum_dstats(self, stats, smetrics):
-        """
-        Compute the summary statistics for chosen metrics.
-        """
-        avg = {}
-
-        for disk, metrics in stats.iteritems():
-            for mname, metric in metrics.iteritems():
-                if mname not in smetrics:
-                    continue
-                if mname in avg:
-                    avg[mname] += metric
-                else:
-                    avg[mname] = metric
-
-        return avg
-
-    def _run(self, options=None):
-        """
-        Run iostat command.
-        """
-        close_fds = 'posix' in sys.builtin_module_names
-        args = '%s %s %s %s %s' % (
-            self.path,
-            ''.join(options),
-            self.interval,
-            self.count,
-            ' '.join(self.disks))
-
-        return subprocess.Popen(
-            args,
-            bufsize=1,
-            shell=True,
-            stdout=subprocess.PIPE,
-            close_fds=close_fds)
-
-    @staticmethod
-    def _get_childs_data(child):
-        """
-        Return child's data when avaliable.
-        """
-        (stdout, stderr) = child.communicate()
-        ecode = child.poll()
-
-        if ecode != 0:
-            raise CmdError('Command %r returned %d' % (child.cmd, ecode))
-
-        return stdout
-
-    def get_diskstats(self):
-        """
-        Get all avaliable disks statistics that we can get.
-        """
-        dstats = self._run(options=['-kNd'])
-        extdstats = self._run(options=['-kNdx'])
-        dsd = self._get_childs_data(dstats)
-        edd = self._get_childs_data(extdstats)
-        ds = self.parse_diskstats(dsd)
-        eds = self.parse_diskstats(edd)
-
-        for dk, dv in ds.iteritems():
-            if dk in eds:
-                ds[dk].update(eds[dk])
-
-        return ds
-
-    def get_specific_diskstat(self, device):
-        """
-        Get specific disk statistics.
-        """
-        return self.get_diskstats()[device]
@@ -0,0 +1,194 @@
+"""Adaptive collection budget, protects a loaded hypervisor.
+
+Metric families are planned each cycle in priority order, against
+their learned cost (moving average of wall and CPU seconds per
+domain) and the per-cycle wall/CPU budget: higher priority families
+take the budget first, lower ones fill what is left. While the host
+load average per CPU or the agent's own CPU usage is over its
+threshold, families below cpu are only collected every pressure_every
+cycles. No family is deferred more than max_defer cycles in a row.
+
+state and cpu are always collected.
+"""
+import collections
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from libvirt_monitoring import base
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    # Python 2.
+    _cpu_time = time.clock
+
+
+LOG = logging.getLogger(__name__)
+
+# Highest priority first.
+PRIORITIES = ('statestats', 'cpustats', 'memoryusagestats',
+              'memoryresidentstats', 'interfacestats', 'diskstats',
+              'diskinfo')
+ESSENTIAL = ('statestats', 'cpustats')
+# Weight of the last domain in learned costs.
+COST_ALPHA = 0.2
+
+DEFERRED_KEY = 'libvirt.budget.deferred'
+
+# (wall, cpu) seconds of one family on one domain.
+Cost = collections.namedtuple('Cost', ['wall', 'cpu'])
+
+
+class _NoMeasure(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# Context of collections without budget.
+NO_MEASURE = _NoMeasure()
+
+
+class CollectionBudget(object):
+
+    def __init__(self, wall=0, cpu=0, load_threshold=1.0, agent_cpu=0.25,
+                 pressure_every=5, max_defer=10):
+        # Seconds per cycle, 0 for no limit.
+        self.wall = float(wall)
+        self.cpu = float(cpu)
+        # 1 minute load average per CPU.
+        self.load_threshold = float(load_threshold)
+        # Fraction of one CPU used by the agent between cycles.
+        self.agent_cpu = float(agent_cpu)
+        self.pressure_every = max(int(pressure_every), 1)
+        self.max_defer = int(max_defer)
+        self.costs = {}
+        self.cycle = 0
+        self.pressure = None
+        # family -> consecutive cycles it was deferred.
+        self._deferred_cycles = collections.Counter()
+        # family -> reason, of current cycle.
+        self.deferred = {}
+        self._plan = set()
+        self._skipped = collections.Counter()
+        self._started = None
+        self._started_cpu = None
+        # Position of the domain to start next cycle from, the first
+        # one cut off, and position of current domain.
+        self._resume = 0
+        self._cut_at = None
+        self._position = None
+        self._last = None
+        self._cpus = multiprocessing.cpu_count()
+
+    def _check_pressure(self, now, now_cpu):
+        """Reason the host is under pressure, None if it is not."""
+        reason = None
+        if self._last is not None and now > self._last[0]:
+            usage = (now_cpu - self._last[1]) / (now - self._last[0])
+            if usage > self.agent_cpu:
+                reason = 'agent cpu %.2f' % usage
+        try:
+            load = os.getloadavg()[0] / self._cpus
+        except OSError:
+            load = 0
+        if load > self.load_threshold:
+            reason = 'load %.2f' % load
+        self._last = (now, now_cpu)
+        return reason
+
+    def start(self, domains):
+        """Plan the families of a cycle over domains, return an
+        iterator of the domains starting from the first one cut off
+        last cycle.
+        """
+        self.cycle += 1
+        self._started = time.time()
+        self._started_cpu = _cpu_time()
+        self.pressure = self._check_pressure(self._started,
+                                             self._started_cpu)
+        self.deferred = {}
+        self._skipped = collections.Counter()
+        self._plan = set()
+        wall = cpu = 0.0
+        for family in PRIORITIES:
+            cost = self.costs.get(family, Cost(0.0, 0.0))
+            forced = self._deferred_cycles[family] >= self.max_defer
+            if family not in ESSENTIAL and not forced:
+                if self.wall and wall + cost.wall * len(domains) > \
+                        self.wall or \
+                        self.cpu and cpu + cost.cpu * len(domains) > self.cpu:
+                    self.deferred[family] = 'budget'
+                    continue
+                if self.pressure and self.cycle % self.pressure_every:
+                    self.deferred[family] = self.pressure
+                    continue
+            wall += cost.wall * len(domains)
+            cpu += cost.cpu * len(domains)
+            self._plan.add(family)
+        self._cut_at = None
+        return self._rotate(domains)
+
+    def _rotate(self, domains):
+        start = self._resume % len(domains) if domains else 0
+        for n in range(len(domains)):
+            self._position = (start + n) % len(domains)
+            yield domains[self._position]
+
+    def allow(self, family):
+        """Check if family may be collected on the next domain."""
+        if family in ESSENTIAL:
+            return True
+        if family not in self._plan:
+            return False
+        if self.wall and time.time() - self._started > self.wall or \
+                self.cpu and _cpu_time() - self._started_cpu > self.cpu:
+            self._skipped[family] += 1
+            if self._cut_at is None:
+                self._cut_at = self._position
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def measure(self, family):
+        """Learn cost of collecting family on one domain."""
+        started = time.time()
+        started_cpu = _cpu_time()
+        yield
+        cost = Cost(time.time() - started, _cpu_time() - started_cpu)
+        prev = self.costs.get(family)
+        if prev is not None:
+            cost = Cost(*[p + COST_ALPHA * (c - p)
+                          for c, p in zip(cost, prev)])
+        self.costs[family] = cost
+
+    def finish(self):
+        """Account deferred families of the cycle."""
+        if self._cut_at is not None:
+            self._resume = self._cut_at
+        for family, count in self._skipped.items():
+            self.deferred.setdefault(family, 'cut off, %d domains' % count)
+        for family in PRIORITIES:
+            if family in self.deferred:
+                self._deferred_cycles[family] += 1
+            else:
+                self._deferred_cycles[family] = 0
+        if self.deferred:
+            LOG.info('Deferred metric families: %s', self.deferred)
+        LOG.debug('Cycle of %.3fs, learned costs per domain: %s',
+                  time.time() - self._started,
+                  dict((f, tuple(round(c, 6) for c in cost))
+                       for f, cost in self.costs.items()))
+
+    def items(self):
+        """Host level item with the families deferred last cycle."""
+        return [base.Item(key=DEFERRED_KEY,
+                          name='Deferred metric families',
+                          value=json.dumps(self.deferred, sort_keys=True))]
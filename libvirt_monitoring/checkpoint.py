@@ -0,0 +1,130 @@
+"""Checkpoint of inspector counter snapshots.
+
+Rates are computed against the counters of the previous cycle, the
+snapshots are saved so that a restarted agent sends valid rates on
+its first cycle.
+
+The file is a header followed by fixed size records, loading is one
+read and one struct unpack per series, no JSON parsing:
+    header: magic, version, number of records
+    record: kind, uuid (16 bytes), domain ID, device, time, counters
+"""
+import collections
+import errno
+import logging
+import os
+import struct
+import time
+import uuid as uuidlib
+
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'LVCK'
+VERSION = 2
+
+KIND_DISK = 1
+KIND_VNIC = 2
+KIND_CPU = 3
+KIND_VCPU = 4
+# vNIC counters of libvirt interfaceStats, KIND_VNIC are tap counters.
+KIND_VNIC_LIBVIRT = 5
+# cgroup cpu time, KIND_CPU is libvirt cpu time.
+KIND_CPU_HOSTFS = 6
+
+# blockStatsFlags counters used by disk rates.
+DISK_COUNTERS = ('rd_operations', 'wr_operations', 'rd_bytes', 'wr_bytes',
+                 'rd_total_times', 'wr_total_times', 'flush_operations',
+                 'flush_total_times', 'errs')
+# Tap counters, see hostfs.NET_STATS. libvirt counters are stored
+# in the same host point of view.
+VNIC_COUNTERS = ('rx_bytes', 'rx_packets', 'tx_bytes', 'tx_packets')
+NUM_COUNTERS = len(DISK_COUNTERS)
+# Bytes of UTF-8 device names, longer ones are not saved: truncated,
+# they would not match their snapshot key.
+DEVICE_SIZE = 32
+
+HEADER = struct.Struct('<4sHI')
+RECORD = struct.Struct('<B16si%dsd%dq' % (DEVICE_SIZE, NUM_COUNTERS))
+
+# counters: tuple of NUM_COUNTERS integers, unused ones are 0.
+Record = collections.namedtuple('Record', ['kind', 'uuid', 'domain_id',
+                                           'device', 'time', 'counters'])
+
+
+def make_record(kind, uuid, domain_id, device, timestamp, counters):
+    counters = tuple(int(c) for c in counters)
+    return Record(kind, uuid, domain_id, device, timestamp,
+                  counters + (0,) * (NUM_COUNTERS - len(counters)))
+
+
+def save(path, records):
+    """Write records to path atomically (temporary file + rename)."""
+    tmp_path = path + '.tmp'
+    data = bytearray()
+    count = 0
+    for r in records:
+        device = r.device
+        if not isinstance(device, bytes):
+            device = device.encode('utf-8')
+        if len(device) > DEVICE_SIZE:
+            LOG.debug('Skip snapshot of %s %s, device name is too long',
+                      r.uuid, r.device)
+            continue
+        data += RECORD.pack(r.kind, uuidlib.UUID(r.uuid).bytes,
+                            r.domain_id, device, r.time, *r.counters)
+        count += 1
+    data[:0] = HEADER.pack(MAGIC, VERSION, count)
+    try:
+        checkpoint_dir = os.path.dirname(path)
+        if checkpoint_dir and not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir, 0o700)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        try:
+            os.write(fd, bytes(data))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        LOG.warning('Unable to write checkpoint %s: %s', path, e)
+        return False
+    LOG.debug('Checkpointed %d counter snapshots to %s', count, path)
+    return True
+
+
+def load(path, max_age=None):
+    """Read records of path, dropping those older than max_age."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            LOG.warning('Unable to read checkpoint %s: %s', path, e)
+        return []
+
+    if len(data) < HEADER.size:
+        LOG.warning('Ignore truncated checkpoint %s', path)
+        return []
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or \
+            len(data) != HEADER.size + count * RECORD.size:
+        LOG.warning('Ignore invalid checkpoint %s', path)
+        return []
+
+    oldest = time.time() - max_age if max_age else 0
+    records = []
+    offset = HEADER.size
+    for _ in range(count):
+        fields = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if fields[4] < oldest:
+            continue
+        records.append(Record(
+            fields[0], str(uuidlib.UUID(bytes=fields[1])), fields[2],
+            fields[3].rstrip(b'\0').decode('utf-8', 'replace'), fields[4],
+            fields[5:]))
+    LOG.info('Loaded %d of %d counter snapshots from %s',
+             len(records), count, path)
+    return records
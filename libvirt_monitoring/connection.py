@@ -0,0 +1,235 @@
+"""Resilient libvirt connection.
+
+The connection is watched by libvirt keepalive and a close callback,
+both driven by the default event loop. When it is lost, it is opened
+again from a background thread with exponential backoff, collectors
+check the health state instead of blocking on a dead connection.
+"""
+import logging
+import random
+import threading
+import time
+
+from libvirt_monitoring import base
+
+libvirt = None
+
+LOG = logging.getLogger(__name__)
+
+STATE_DOWN = 'down'
+STATE_CONNECTING = 'connecting'
+STATE_UP = 'up'
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def _import_libvirt():
+    global libvirt
+    if libvirt is None:
+        libvirt = __import__('libvirt')
+    return libvirt
+
+
+def start_event_loop():
+    """Run libvirt default event loop in a background thread.
+
+    Keepalive and close callbacks need it, it must be started
+    before connections are opened.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is not None:
+            return
+        _import_libvirt()
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop = threading.Thread(target=run, name='libvirt-events')
+        _event_loop.daemon = True
+        _event_loop.start()
+
+
+def is_connection_error(e):
+    """Check if libvirtError means the connection is lost."""
+    _import_libvirt()
+    code = e.get_error_code()
+    if code == libvirt.VIR_ERR_SYSTEM_ERROR:
+        return e.get_error_domain() in (libvirt.VIR_FROM_REMOTE,
+                                        libvirt.VIR_FROM_RPC)
+    return code in (getattr(libvirt, 'VIR_ERR_NO_CONNECT', None),
+                    getattr(libvirt, 'VIR_ERR_INVALID_CONN', None))
+
+
+class ConnectionManager(object):
+
+    """
+    Read-only connection to one libvirt URI.
+
+    get() never blocks on a lost connection: it returns None while
+    the connection is reopened in background. Domain handles of the
+    last listing are cached for lookup(), they are dropped when the
+    connection is reopened and bound again to the new one.
+    """
+
+    def __init__(self, uri, keepalive=(5, 3), min_backoff=1,
+                 max_backoff=60):
+        self.uri = uri
+        # (interval, count) of libvirt keepalive, None to disable.
+        self.keepalive = keepalive
+        self.min_backoff = float(min_backoff)
+        self.max_backoff = float(max_backoff)
+        self.state = STATE_DOWN
+        # Failed attempts since connection was lost.
+        self.failures = 0
+        # Incremented on each successful (re)connection.
+        self.generation = 0
+        self._conn = None
+        # Connections to close, from reconnect thread.
+        self._stale = []
+        # uuid -> domain handle of current connection.
+        self._domains = {}
+        self._lock = threading.Lock()
+        self._reconnecting = False
+
+    @property
+    def healthy(self):
+        return self.state == STATE_UP
+
+    def get(self):
+        """Return open connection, None if it is down.
+
+        First call connects inline, later ones only schedule
+        a background reconnect.
+        """
+        with self._lock:
+            if self.state == STATE_UP:
+                return self._conn
+            first = self.generation == 0 and not self._reconnecting
+        if first and self._connect():
+            return self._conn
+        self._schedule_reconnect()
+        return None
+
+    def _connect(self):
+        _import_libvirt()
+        with self._lock:
+            self.state = STATE_CONNECTING
+            stale, self._stale = self._stale, []
+        for conn in stale:
+            self._close(conn)
+        try:
+            start_event_loop()
+            conn = libvirt.openReadOnly(self.uri)
+            if self.keepalive:
+                try:
+                    conn.setKeepAlive(*self.keepalive)
+                except libvirt.libvirtError as e:
+                    LOG.debug('Keepalive not supported by %s - %s',
+                              self.uri, e)
+            conn.registerCloseCallback(self._on_close, None)
+        except libvirt.libvirtError as e:
+            with self._lock:
+                self.state = STATE_DOWN
+                self.failures += 1
+            LOG.error('Unable to connect to %s (attempt %d) - %s',
+                      self.uri, self.failures, e)
+            return False
+        with self._lock:
+            self._conn = conn
+            self._domains = {}
+            self.state = STATE_UP
+            self.failures = 0
+            self.generation += 1
+        LOG.info('Connected to %s', self.uri)
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+        try:
+            conn.close()
+        except libvirt.libvirtError as e:
+            LOG.debug('Error when closing connection to %s - %s',
+                      self.uri, e)
+
+    def _on_close(self, conn, reason, opaque):
+        LOG.warning('Connection to %s closed, reason %s', self.uri, reason)
+        self.mark_down()
+
+    def mark_down(self):
+        """Connection is lost, reopen it in background."""
+        with self._lock:
+            if self._conn is not None:
+                # Not closed here: it may be called from the close
+                # callback, inside the event loop.
+                self._stale.append(self._conn)
+            self._conn = None
+            self._domains = {}
+            self.state = STATE_DOWN
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        with self._lock:
+            if self._reconnecting or self.state == STATE_UP:
+                return
+            self._reconnecting = True
+        thread = threading.Thread(target=self._reconnect,
+                                  name='reconnect-%s' % self.uri)
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect(self):
+        delay = self.min_backoff
+        try:
+            while True:
+                # Jitter, so many agents/hosts do not retry together.
+                time.sleep(random.uniform(delay / 2, delay))
+                if self._connect():
+                    return
+                delay = min(delay * 2, self.max_backoff)
+        finally:
+            with self._lock:
+                self._reconnecting = False
+
+    def domains(self):
+        """All domains, their handles are cached for lookup()."""
+        conn = self.get()
+        if conn is None:
+            raise base.ConnectionUnavailable(
+                'Connection to %s is %s' % (self.uri, self.state))
+        try:
+            listed = conn.listAllDomains()
+        except libvirt.libvirtError as e:
+            if is_connection_error(e):
+                self.mark_down()
+                raise base.ConnectionUnavailable(
+                    'Lost connection to %s - %s' % (self.uri, e))
+            raise
+        # Listed handles replace cached ones: a restarted domain has
+        # a new ID, UUIDString is read from the handle without RPC.
+        domains = dict((domain.UUIDString(), domain) for domain in listed)
+        with self._lock:
+            if self._conn is conn:
+                self._domains = domains
+        return listed
+
+    def lookup(self, uuid):
+        """Handle of a domain, bound to current connection."""
+        conn = self.get()
+        if conn is None:
+            raise base.ConnectionUnavailable(
+                'Connection to %s is %s' % (self.uri, self.state))
+        with self._lock:
+            handle = self._domains.get(uuid)
+        if handle is None:
+            handle = conn.lookupByUUIDString(uuid)
+            with self._lock:
+                if self._conn is conn:
+                    self._domains[uuid] = handle
+        return handle
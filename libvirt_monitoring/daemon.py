@@ -4,6 +4,7 @@ import os
 import time
 import sys
 from signal import SIGTERM
+import signal
 
 from libvirt_monitoring import agent
 from libvirt_monitoring import base
@@ -141,5 +142,19 @@ class AgentDaemon(Daemon):
     """
 
     def run(self):
+        # Exit through agent's cleanup (e.x: checkpoint) on stop.
+        signal.signal(SIGTERM, self._terminate)
+        # Default action of SIGUSR1/2 kills the process, ignore them
+        # until the profiler exists (agent init may wait on libvirt).
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
         libvirt_agent = agent.LibvirtAgent()
+        # kill -USR1: profile next cycles, kill -USR2: trace allocations.
+        signal.signal(signal.SIGUSR1, libvirt_agent.profiler.request_profile)
+        signal.signal(signal.SIGUSR2, libvirt_agent.profiler.request_memory)
         libvirt_agent.run()
+
+    def _terminate(self, signum, frame):
+        # Ignore further SIGTERMs sent by stop() while exiting.
+        signal.signal(SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
@@ -0,0 +1,117 @@
+import logging
+import numbers
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+# Cumulative counters, they change on every cycle of a running domain
+# and are left out of domain checksums.
+COUNTERS = frozenset(['cpustats.time'])
+
+
+class DeadbandFilter(object):
+
+    """
+    Change-only reporting.
+
+    An item over its threshold is sent only if its value moved out of
+    the deadband around its last sent value, or if its heartbeat is
+    due (every `heartbeat` cycles it is sent anyway). An item which
+    crosses its threshold is always sent: values of items below their
+    threshold are forgotten.
+    Domains whose checksum of values which may be sent did not change
+    since last cycle are skipped as a whole.
+
+    next_cycle()/unchanged() are called by the collector,
+    filter()/forget()/sent() by the Zabbix output thread.
+    """
+
+    def __init__(self, absolute=0.0, relative=0.0, heartbeat=10):
+        self.absolute = float(absolute)
+        self.relative = float(relative)
+        self.heartbeat = max(int(heartbeat), 1)
+        self.cycle = 0
+        self.suppressed = 0
+        self.skipped = 0
+        # vm -> checksum of its metrics in last cycle.
+        self._checksums = {}
+        # vm -> last cycle its metrics were not skipped.
+        self._heartbeats = {}
+        # item key -> (last sent value, cycle it was sent).
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def next_cycle(self, vms):
+        """Start a new cycle, forget domains which disappeared."""
+        vms = set(vms)
+        with self._lock:
+            self.cycle += 1
+            self.skipped = 0
+            for vm in list(self._checksums):
+                if vm not in vms:
+                    del self._checksums[vm]
+                    self._heartbeats.pop(vm, None)
+
+    def _heartbeat_due(self, last):
+        return last is None or self.cycle - last >= self.heartbeat
+
+    def unchanged(self, vm, values):
+        """Check if the values of a domain which may be sent are the
+        same as in last cycle.
+
+        :param values: Hashable values, without COUNTERS.
+        """
+        try:
+            checksum = hash(values)
+        except TypeError:
+            return False
+        with self._lock:
+            previous = self._checksums.get(vm)
+            self._checksums[vm] = checksum
+            if previous == checksum and \
+                    not self._heartbeat_due(self._heartbeats.get(vm)):
+                self.skipped += 1
+                return True
+            self._heartbeats[vm] = self.cycle
+            return False
+
+    def _in_band(self, value, last):
+        if isinstance(value, bool) or \
+                not isinstance(value, numbers.Number) or \
+                not isinstance(last, numbers.Number):
+            return value == last
+        delta = abs(value - last)
+        return (delta <= self.absolute or
+                delta <= self.relative * abs(last))
+
+    def filter(self, items):
+        """Return items over their threshold which have to be sent."""
+        result = []
+        with self._lock:
+            self.suppressed = 0
+            for item in items:
+                last = self._last.get(item.key)
+                if last is not None and \
+                        not self._heartbeat_due(last[1]) and \
+                        self._in_band(item.value, last[0]):
+                    self.suppressed += 1
+                    continue
+                result.append(item)
+        return result
+
+    def forget(self, item):
+        """Item is below its threshold, send it when it crosses it."""
+        with self._lock:
+            self._last.pop(item.key, None)
+
+    def sent(self, items):
+        """Remember values of items which were sent."""
+        with self._lock:
+            for item in items:
+                self._last[item.key] = (item.value, self.cycle)
+            # Items of disappeared domains.
+            oldest = self.cycle - 2 * self.heartbeat
+            for key, last in list(self._last.items()):
+                if last[1] < oldest:
+                    del self._last[key]
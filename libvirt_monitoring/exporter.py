@@ -0,0 +1,151 @@
+import logging
+import math
+import numbers
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+
+LOG = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+METRIC_PREFIX = 'libvirt'
+
+
+def _escape(value):
+    """Label value escaped as OpenMetrics requires."""
+    return ('%s' % value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    """Sample value, NaN and infinities spelled as OpenMetrics does."""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+    return '%s' % value
+
+
+class OpenMetricsExporter(object):
+
+    """
+    Serve the latest collected {uuid: metrics} snapshot
+    in OpenMetrics text format.
+
+    The snapshot is rendered once per collection cycle by update(),
+    scrapes only write the cached payload and never call libvirt.
+    """
+
+    def __init__(self, host='0.0.0.0', port=9177):
+        self.address = (host, int(port))
+        # Label sets, keyed by (uuid, device), reused between cycles.
+        self._labels = {}
+        # Lines of each family, reused between cycles.
+        self._families = {}
+        self._payload = b'# EOF\n'
+        self._server = None
+        self._thread = None
+
+    def _get_labels(self, uuid, device):
+        key = (uuid, device)
+        labels = self._labels.get(key)
+        if labels is None:
+            if device:
+                labels = 'uuid="%s",device="%s"' % (_escape(uuid),
+                                                    _escape(device))
+            else:
+                labels = 'uuid="%s"' % _escape(uuid)
+            self._labels[key] = labels
+        return labels
+
+    def update(self, all_metrics):
+        """Render a new snapshot, called by the collector."""
+        for lines in self._families.values():
+            del lines[:]
+        used_labels = set()
+
+        for uuid, vm_metrics in all_metrics.items():
+            for metric_key, metric_value in vm_metrics.items():
+                if not metric_value:
+                    continue
+                # e.x: diskstats_vda -> family diskstats, device vda.
+                family, _, device = metric_key.partition('_')
+                used_labels.add((uuid, device))
+                labels = self._get_labels(uuid, device)
+                for f in metric_value._fields:
+                    value = getattr(metric_value, f)
+                    if value is None:
+                        continue
+                    name = '%s_%s_%s' % (METRIC_PREFIX, family, f)
+                    if isinstance(value, bool) or \
+                            not isinstance(value, numbers.Number):
+                        # Non numeric values (e.x: state) are exposed
+                        # as a label with value 1.
+                        line = '%s{%s,%s="%s"} 1' % (name, labels, f,
+                                                     _escape(value))
+                    else:
+                        line = '%s{%s} %s' % (name, labels,
+                                              _format_value(value))
+                    self._families.setdefault(name, []).append(line)
+
+        # Forget label sets of disappeared domains/devices.
+        for key in list(self._labels):
+            if key not in used_labels:
+                del self._labels[key]
+
+        out = []
+        for name in sorted(self._families):
+            lines = self._families[name]
+            if not lines:
+                continue
+            out.append('# TYPE %s gauge' % name)
+            out.extend(lines)
+        out.append('# EOF\n')
+        # Swap payload reference, readers always see a complete snapshot.
+        self._payload = '\n'.join(out).encode('utf-8')
+
+    @property
+    def payload(self):
+        return self._payload
+
+    def start(self):
+        """Start HTTP server in a background thread."""
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = exporter.payload
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                LOG.debug('Exporter %s - ' + format,
+                          self.client_address[0], *args)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(self.address, Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='openmetrics-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.info('OpenMetrics exporter listening on %s:%s', *self.address)
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
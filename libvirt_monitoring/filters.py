@@ -0,0 +1,195 @@
+"""Include/exclude rules of domains and devices.
+
+Rules are comma separated shell patterns, each list is compiled once
+into one regular expression. A domain is matched by name or UUID and
+by its <metadata> elements, before any stats call; disks and
+interfaces by type and target name, before their stats calls.
+An empty include list includes everything, exclude wins over include.
+"""
+import fnmatch
+import logging
+import re
+
+from lxml import etree
+
+
+LOG = logging.getLogger(__name__)
+
+
+def split(value):
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+
+def compile_patterns(patterns):
+    """One regex matching any of the patterns, None if there is none."""
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(p)
+                               for p in patterns))
+
+
+class Matcher(object):
+
+    """Compiled include/exclude patterns of values."""
+
+    def __init__(self, include='', exclude=''):
+        self.include = compile_patterns(split(include))
+        self.exclude = compile_patterns(split(exclude))
+
+    @property
+    def active(self):
+        return self.include is not None or self.exclude is not None
+
+    def match(self, *values):
+        values = [v for v in values if v]
+        if self.exclude is not None and \
+                any(self.exclude.match(v) for v in values):
+            return False
+        if self.include is not None:
+            return any(self.include.match(v) for v in values)
+        return True
+
+
+class MetadataMatcher(object):
+
+    """Rules <tag>=<pattern> of <metadata> elements, e.x: project=prod-*
+    matches <nova:project uuid="...">prod-web</nova:project> by text or
+    by any attribute value.
+    """
+
+    def __init__(self, include='', exclude=''):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+
+    @staticmethod
+    def _compile(rules):
+        tags = {}
+        for rule in split(rules):
+            tag, _, pattern = rule.partition('=')
+            tags.setdefault(tag.strip(), []).append(pattern.strip() or '*')
+        return dict((tag, compile_patterns(patterns))
+                    for tag, patterns in tags.items())
+
+    @property
+    def active(self):
+        return bool(self.include or self.exclude)
+
+    @staticmethod
+    def _values(tree):
+        """{local tag name: [text and attribute values]} of metadata."""
+        values = {}
+        metadata = tree.find('metadata')
+        if metadata is None:
+            return values
+        for element in metadata.iter():
+            if not isinstance(element.tag, str):
+                # Comments.
+                continue
+            found = values.setdefault(etree.QName(element).localname, [])
+            if element.text and element.text.strip():
+                found.append(element.text.strip())
+            found.extend(element.attrib.values())
+        return values
+
+    @staticmethod
+    def _any(rules, values):
+        for tag, regex in rules.items():
+            if any(regex.match(v) for v in values.get(tag, ())):
+                return True
+        return False
+
+    def match(self, tree):
+        values = self._values(tree)
+        if self._any(self.exclude, values):
+            return False
+        if self.include:
+            return self._any(self.include, values)
+        return True
+
+
+class DomainFilter(object):
+
+    """Domains to inspect. Decisions are kept per domain ID, metadata
+    is parsed again only when a domain is (re)started.
+    """
+
+    def __init__(self, include='', exclude='', metadata_include='',
+                 metadata_exclude=''):
+        self.names = Matcher(include, exclude)
+        self.metadata = MetadataMatcher(metadata_include, metadata_exclude)
+        # uuid -> (domain ID, allowed)
+        self._decisions = {}
+
+    @property
+    def active(self):
+        return self.names.active or self.metadata.active
+
+    def allowed(self, domain):
+        if not self.active:
+            return True
+        uuid = domain.UUIDString()
+        domain_id = domain.ID()
+        decision = self._decisions.get(uuid)
+        if decision is not None and decision[0] == domain_id:
+            return decision[1]
+        allowed = self.names.match(domain.name(), uuid)
+        if allowed and self.metadata.active:
+            allowed = self.metadata.match(
+                etree.fromstring(domain.XMLDesc(0)))
+        if not allowed:
+            LOG.info('Skip domain %s (%s), excluded by filters',
+                     domain.name(), uuid)
+        self._decisions[uuid] = (domain_id, allowed)
+        return allowed
+
+    def prune(self, uuids):
+        """Forget decisions of domains which disappeared."""
+        for uuid in list(self._decisions):
+            if uuid not in uuids:
+                del self._decisions[uuid]
+
+
+class DeviceFilter(object):
+
+    """Disks and interfaces to inspect, from domain XML elements."""
+
+    def __init__(self, disk_types='', disk_include='', disk_exclude='',
+                 interface_types='', interface_include='',
+                 interface_exclude=''):
+        # Excluded <disk device=...> and <interface type=...>.
+        self.disk_types = frozenset(split(disk_types))
+        self.disks = Matcher(disk_include, disk_exclude)
+        self.interface_types = frozenset(split(interface_types))
+        self.interfaces = Matcher(interface_include, interface_exclude)
+
+    def disk(self, disk):
+        """Check <disk> element, return its target or None."""
+        if disk.get('device', 'disk') in self.disk_types:
+            return None
+        target = disk.find('target')
+        device = target.get('dev') if target is not None else None
+        if not device or not self.disks.match(device):
+            return None
+        return device
+
+    def interface(self, interface, name):
+        if interface.get('type') in self.interface_types:
+            return False
+        return self.interfaces.match(name)
+
+
+def from_config(config):
+    """(DomainFilter, DeviceFilter) of [filters] section."""
+    domains = DomainFilter(
+        include=config.get('filters-domain_include'),
+        exclude=config.get('filters-domain_exclude'),
+        metadata_include=config.get('filters-metadata_include'),
+        metadata_exclude=config.get('filters-metadata_exclude'))
+    devices = DeviceFilter(
+        disk_types=config.get('filters-disk_types_exclude'),
+        disk_include=config.get('filters-disk_include'),
+        disk_exclude=config.get('filters-disk_exclude'),
+        interface_types=config.get('filters-interface_types_exclude'),
+        interface_include=config.get('filters-interface_include'),
+        interface_exclude=config.get('filters-interface_exclude'))
+    return domains, devices
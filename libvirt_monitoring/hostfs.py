@@ -0,0 +1,206 @@
+"""Host-local reader of domain counters.
+
+Reads qemu cgroup (v2) and tap device counters directly from
+cgroupfs/sysfs, so that libvirtd is not asked for them every cycle.
+Files are opened once per domain and read with pread.
+"""
+import errno
+import logging
+import os
+
+
+LOG = logging.getLogger(__name__)
+
+NET_STATS = ('rx_bytes', 'rx_packets', 'tx_bytes', 'tx_packets')
+
+# Sub cgroups created by libvirt inside the domain scope.
+LIBVIRT_SUB_CGROUPS = ('libvirt', 'emulator')
+
+
+def _pread(fd, size=4096):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, 0)
+    # Python 2 has no os.pread.
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _open(path):
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.EACCES):
+            raise
+        LOG.debug('Unable to open %s: %s', path, e)
+        return None
+
+
+class DomainFiles(object):
+
+    """Preopened counter files of one domain."""
+
+    def __init__(self, domain_id, cgroup, vcpus, interfaces, sysfs_root):
+        self.domain_id = domain_id
+        self.cgroup = cgroup
+        self.vcpus = vcpus
+        # base.Interface tuples of the domain.
+        self.interfaces = interfaces
+        self.cpu_fd = None
+        self.memory_fd = None
+        if cgroup:
+            self.cpu_fd = _open(os.path.join(cgroup, 'cpu.stat'))
+            self.memory_fd = _open(os.path.join(cgroup, 'memory.stat'))
+        self.net_fds = {}
+        for iface in interfaces:
+            stats_dir = os.path.join(sysfs_root, 'class/net', iface.name,
+                                     'statistics')
+            fds = dict((stat, _open(os.path.join(stats_dir, stat)))
+                       for stat in NET_STATS)
+            if None in fds.values():
+                for fd in fds.values():
+                    if fd is not None:
+                        os.close(fd)
+                continue
+            self.net_fds[iface.name] = fds
+
+    def close(self):
+        fds = [self.cpu_fd, self.memory_fd]
+        for net_fds in self.net_fds.values():
+            fds.extend(net_fds.values())
+        for fd in fds:
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.cpu_fd = self.memory_fd = None
+        self.net_fds = {}
+
+
+class HostReader(object):
+
+    """
+    Resolve each domain's cgroup and tap devices once, then read
+    their counters with pread.
+
+    Every read returns None if the counter is not available, callers
+    fall back to libvirt then.
+    """
+
+    def __init__(self, cgroup_root='/sys/fs/cgroup', sysfs_root='/sys',
+                 proc_root='/proc', pid_dir='/var/run/libvirt/qemu'):
+        self.cgroup_root = cgroup_root
+        self.sysfs_root = sysfs_root
+        self.proc_root = proc_root
+        self.pid_dir = pid_dir
+        # uuid -> DomainFiles
+        self._domains = {}
+
+    def get(self, uuid, domain_id):
+        """Get resolved files of a domain, None if it must be resolved.
+
+        A different domain ID means the domain was restarted, its
+        qemu process and cgroup changed.
+        """
+        files = self._domains.get(uuid)
+        if files is not None and files.domain_id != domain_id:
+            self.forget(uuid)
+            files = None
+        return files
+
+    def resolve(self, uuid, name, domain_id, vcpus, interfaces):
+        files = DomainFiles(domain_id, self._find_cgroup(name), vcpus,
+                            interfaces, self.sysfs_root)
+        self._domains[uuid] = files
+        LOG.debug('Resolved host files of %s: cgroup %s, taps %s',
+                  uuid, files.cgroup, list(files.net_fds))
+        return files
+
+    def _find_cgroup(self, name):
+        """Find domain scope cgroup from its qemu pid."""
+        try:
+            with open(os.path.join(self.pid_dir, name + '.pid')) as f:
+                pid = int(f.read().strip())
+            with open(os.path.join(self.proc_root, str(pid), 'cgroup')) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError, ValueError) as e:
+            LOG.debug('Unable to find cgroup of %s: %s', name, e)
+            return None
+
+        for line in lines:
+            # cgroup v2 unified hierarchy: 0::/machine.slice/...
+            if not line.startswith('0::'):
+                continue
+            path = line[3:].rstrip('/')
+            # qemu runs in <scope>/libvirt/emulator.
+            while os.path.basename(path) in LIBVIRT_SUB_CGROUPS:
+                path = os.path.dirname(path)
+            cgroup = os.path.join(self.cgroup_root, path.lstrip('/'))
+            if os.path.isdir(cgroup):
+                return cgroup
+        return None
+
+    def forget(self, uuid):
+        files = self._domains.pop(uuid, None)
+        if files is not None:
+            files.close()
+
+    def prune(self, uuids):
+        """Close files of domains which are not in uuids."""
+        for uuid in list(self._domains):
+            if uuid not in uuids:
+                self.forget(uuid)
+
+    def _read(self, files, fd):
+        try:
+            return _pread(fd).decode('ascii')
+        except OSError as e:
+            # cgroup/tap removed under us, resolve again next cycle.
+            LOG.debug('Unable to read counters: %s', e)
+            for uuid, f in list(self._domains.items()):
+                if f is files:
+                    self.forget(uuid)
+            return None
+
+    def read_cpu_time(self, files):
+        """Cumulative cpu time of domain, in nanoseconds."""
+        if files.cpu_fd is None:
+            return None
+        data = self._read(files, files.cpu_fd)
+        if data is None:
+            return None
+        for line in data.splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'usage_usec':
+                return int(value) * 1000
+        return None
+
+    def read_memory(self, files):
+        """Anonymous memory of domain cgroup, in bytes.
+
+        Guest RAM is anonymous memory of qemu, page cache charged to
+        the cgroup (memory.current) is not resident guest memory.
+        """
+        if files.memory_fd is None:
+            return None
+        data = self._read(files, files.memory_fd)
+        if data is None:
+            return None
+        for line in data.splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'anon':
+                return int(value)
+        return None
+
+    def read_net(self, files, tap):
+        """Counters of a tap device, host point of view."""
+        fds = files.net_fds.get(tap)
+        if fds is None:
+            return None
+        result = {}
+        for stat, fd in fds.items():
+            data = self._read(files, fd)
+            if data is None:
+                return None
+            result[stat] = int(data.strip())
+        return result
@@ -1,3 +1,4 @@
+import collections
 import logging
 import time
 
@@ -5,6 +6,11 @@ from lxml import etree
 from oslo_config import cfg
 
 from libvirt_monitoring import base
+from libvirt_monitoring import budget
+from libvirt_monitoring import checkpoint
+from libvirt_monitoring import connection
+from libvirt_monitoring import filters
+from libvirt_monitoring import hostfs
 from libvirt_monitoring import settings
 from libvirt_monitoring import utils
 
@@ -26,47 +32,136 @@ OPTS = [
 CONF = cfg.CONF
 CONF.register_opts(OPTS)
 
+# Origin of counter snapshots, rates are only computed between two
+# snapshots of the same origin.
+SOURCE_LIBVIRT = 'libvirt'
+SOURCE_HOSTFS = 'hostfs'
 
-def retry_on_disconnect(function):
+
+def skip_on_disconnect(function):
+    """Lost connection fails the cycle fast, it is reopened in
+    background by the connection manager.
+    """
     def decorator(self, *args, **kwargs):
         try:
             return function(self, *args, **kwargs)
         except libvirt.libvirtError as e:
-            if (e.get_error_code() == libvirt.VIR_ERR_SYSTEM_ERROR and
-                e.get_error_domain() in (libvirt.VIR_FROM_REMOTE,
-                                         libvirt.VIR_FROM_RPC)):
-                self.connection = None
-                return function(self, *args, **kwargs)
-            else:
+            if not connection.is_connection_error(e):
                 raise
+            LOG.warning('Lost connection to %s - %s', self.uri, e)
+            self.connection_manager.mark_down()
+            return {}
 
     return decorator
 
 
+class CycleDomain(object):
+
+    """
+    Domain handle of one collection pass.
+
+    Reads which return the same data within a pass (info, XML,
+    memory stats...) are done once, all calls are counted. It is
+    discarded with the pass, nothing is kept across cycles.
+    """
+
+    MEMOIZED = frozenset(['info', 'memoryStats', 'XMLDesc', 'UUIDString',
+                          'name', 'ID'])
+
+    def __init__(self, domain, calls):
+        self._domain = domain
+        self._memo = {}
+        # Counter shared by domains of the pass, method -> calls done.
+        self._calls = calls
+
+    def __getattr__(self, attr):
+        func = getattr(self._domain, attr)
+        calls = self._calls
+        if attr not in self.MEMOIZED:
+            def counted(*args):
+                calls[attr] += 1
+                return func(*args)
+            return counted
+
+        memo = self._memo
+
+        def memoized(*args):
+            key = (attr, args)
+            if key in memo:
+                calls['memoized'] += 1
+                return memo[key]
+            calls[attr] += 1
+            result = memo[key] = func(*args)
+            return result
+        return memoized
+
+
 class LibvirtInspector(object):
     per_type_uris = dict(uml='uml:///system', xen='xen:///', lxc='lxc:///')
 
-    def __init__(self):
-        self.uri = self._get_uri()
-        self.connection = None
+    def __init__(self, uri=None, keepalive=None):
+        self.uri = uri or self._get_uri()
+        config = utils.ini_file_loader()
+        if keepalive is None:
+            # (interval, count) of libvirt keepalive, interval 0 disables.
+            keepalive = (int(config.get('libvirt-keepalive_interval', 5)),
+                         int(config.get('libvirt-keepalive_count', 3)))
+        self.connection_manager = connection.ConnectionManager(
+            self.uri,
+            keepalive=keepalive if keepalive[0] > 0 else None,
+            min_backoff=config.get('libvirt-reconnect_min', 1),
+            max_backoff=config.get('libvirt-reconnect_max', 60))
+        # (uuid, device) -> (time, blockStatsFlags) of previous cycle.
+        self._disk_snapshots = {}
+        # uuid -> (time, CPUStats, vCPU times, source) of previous cycle.
+        self._cpu_snapshots = {}
+        # (uuid, tap) -> (time, tap counters, source) of previous cycle.
+        self._vnic_snapshots = {}
+        # uuid -> domain ID of snapshots, a new ID means restarted domain.
+        self._domain_ids = {}
+        # uuid -> domain ID of snapshots restored from a checkpoint,
+        # checked on first cycle.
+        self._restored_ids = {}
+        # Optional host-local reader of cgroup/sysfs counters.
+        self.hostfs = None
+        # Host files are local, not usable with a remote uri.
+        if config.get('hostfs-enabled') == 'True' and not uri:
+            self.hostfs = hostfs.HostReader(
+                cgroup_root=config.get('hostfs-cgroup_root',
+                                       '/sys/fs/cgroup'),
+                sysfs_root=config.get('hostfs-sysfs_root', '/sys'),
+                proc_root=config.get('hostfs-proc_root', '/proc'),
+                pid_dir=config.get('hostfs-pid_dir',
+                                   '/var/run/libvirt/qemu'))
+        # Include/exclude rules, applied before stats calls.
+        self.domain_filter, self.device_filter = filters.from_config(config)
+        # Adaptive collection budget, load thresholds are of the local
+        # host only.
+        self.budget = None
+        if config.get('budget-enabled') == 'True' and not uri:
+            self.budget = budget.CollectionBudget(
+                wall=config.get('budget-wall', 0),
+                cpu=config.get('budget-cpu', 0),
+                load_threshold=config.get('budget-load_threshold', 1.0),
+                agent_cpu=config.get('budget-agent_cpu', 0.25),
+                pressure_every=config.get('budget-pressure_every', 5),
+                max_defer=config.get('budget-max_defer', 10))
 
     def _get_uri(self):
         return CONF.libvirt_uri or self.per_type_uris.get(CONF.libvirt_type,
                                                           'qemu:///system')
 
-    def _get_connection(self):
-        if not self.connection:
-            global libvirt
-            if libvirt is None:
-                libvirt = __import__('libvirt')
-            self.connection = libvirt.openReadOnly(self.uri)
-
-        return self.connection
-
-    @retry_on_disconnect
+    @skip_on_disconnect
     def get_vm_metrics(self):
-        self._get_connection()
-        all_domains = self.connection.listAllDomains()
+        global libvirt
+        if libvirt is None:
+            libvirt = __import__('libvirt')
+        try:
+            # Does not block while reconnecting in background.
+            all_domains = self.connection_manager.domains()
+        except base.ConnectionUnavailable as e:
+            LOG.warning('Skip cycle - %s', e)
+            return {}
         # Format e.x:
         # resutls = {
         #   'instance-00000315' : {
@@ -76,56 +171,181 @@ class LibvirtInspector(object):
         #   }
         # }
         results = {}
+        # uuid -> (time, CPUStats, vCPU times, source), utilization is
+        # calculated after the loop.
+        cpu_samples = {}
+        calls = collections.Counter()
+        seen = set()
+        if self.budget is not None:
+            all_domains = self.budget.start(all_domains)
         for domain in all_domains:
+            domain = CycleDomain(domain, calls)
+            seen.add(domain.UUIDString())
+            if not self.domain_filter.allowed(domain):
+                continue
             result = {}
-            msg = '### Inspect metrics of %(instance_uuid)s' % {
-                'instance_uuid': domain.UUIDString()}
-            LOG.info(msg)
-            # Get domain state.
-            statestats = self._inspect_state(domain)
-            self._log_inspection(statestats)
-            result['statestats'] = statestats
+            LOG.info('### Inspect metrics of %s', domain.UUIDString())
+            with self._measure('statestats'):
+                self._check_domain_id(domain)
+                # Get domain state.
+                statestats = self._inspect_state(domain)
+                self._log_inspection(statestats)
+                result['statestats'] = statestats
 
             # Only get metrics info of running domain.
             if statestats.state == 'VIR_DOMAIN_RUNNING':
+                files = self._get_host_files(domain)
                 # Get cpu metrics.
-                if self._check_collected_metric('cpustats'):
-                    _cpustats = self._inspect_cpus(domain)
-                    self._log_inspection(_cpustats)
-                    result['cpustats'] = _cpustats
+                if self._collect('cpustats'):
+                    with self._measure('cpustats'):
+                        _cpustats, _source = self._inspect_cpus(domain,
+                                                                files)
+                        self._log_inspection(_cpustats)
+                        result['cpustats'] = _cpustats
+                        if _cpustats is not None:
+                            _vcpus = None
+                            if self._check_collected_metric('vcpustats'):
+                                _vcpus = self._inspect_vcpus(domain)
+                            cpu_samples[domain.UUIDString()] = (
+                                time.time(), _cpustats, _vcpus, _source)
+                # Get memory usage metrics.
+                if self._collect('memoryusagestats'):
+                    with self._measure('memoryusagestats'):
+                        _memoryusagestats = \
+                            self._inspect_memory_usage(domain)
+                        self._log_inspection(_memoryusagestats)
+                        result['memoryusagestats'] = _memoryusagestats
+                # Get memory resident metrics.
+                if self._collect('memoryresidentstats'):
+                    with self._measure('memoryresidentstats'):
+                        _memoryresidentstats = \
+                            self._inspect_memory_resident(domain,
+                                                          files=files)
+                        self._log_inspection(_memoryresidentstats)
+                        result['memoryresidentstats'] = _memoryresidentstats
                 # Get network metrics/interface.
-                if self._check_collected_metric('interfacestats'):
-                    _interfacestats = list(self._inspect_vnics(domain))
-                    self._log_inspection(_interfacestats)
-                    for vnic in _interfacestats:
-                        result['interfacestats_' + vnic[0].name] = vnic[1]
+                if self._collect('interfacestats'):
+                    with self._measure('interfacestats'):
+                        _interfacestats = list(
+                            self._inspect_vnics(domain, files))
+                        self._log_inspection(_interfacestats)
+                        for vnic in _interfacestats:
+                            result['interfacestats_' + vnic[0].name] = \
+                                vnic[1]
                 # Get disk metrics/disk.
-                if self._check_collected_metric('diskstats'):
-                    _diskstats = list(self._inspect_disks(domain))
-                    self._log_inspection(_diskstats)
-                    for disk in _diskstats:
-                        result['diskstats_' + disk[0].device] = disk[1]
+                if self._collect('diskstats'):
+                    with self._measure('diskstats'):
+                        _diskstats = list(self._inspect_disks(domain))
+                        self._log_inspection(_diskstats)
+                        for disk in _diskstats:
+                            result['diskstats_' + disk[0].device] = disk[1]
                 # Get disk info metrics/disk.
-                if self._check_collected_metric('diskinfo'):
-                    _diskinfo = list(self._inspect_disk_info(domain))
-                    self._log_inspection(_diskinfo)
-                    for disk in _diskinfo:
-                        result['diskinfo_' + disk[0].device] = disk[1]
-                # Get memory usage metrics.
-                if self._check_collected_metric('memoryusagestats'):
-                    _memoryusagestats = self._inspect_memory_usage(domain)
-                    self._log_inspection(_memoryusagestats)
-                    result['memoryusagestats'] = _memoryusagestats
-                # Get memory resident metrics.
-                if self._check_collected_metric('memoryresidentstats'):
-                    _memoryresidentstats = \
-                        self._inspect_memory_resident(domain)
-                    self._log_inspection(_memoryresidentstats)
-                    result['memoryresidentstats'] = _memoryresidentstats
+                if self._collect('diskinfo'):
+                    with self._measure('diskinfo'):
+                        _diskinfo = list(self._inspect_disk_info(domain))
+                        self._log_inspection(_diskinfo)
+                        for disk in _diskinfo:
+                            result['diskinfo_' + disk[0].device] = disk[1]
 
             results[domain.UUIDString()] = result
+
+        if self.budget is not None:
+            self.budget.finish()
+        LOG.debug('libvirt calls of %d domains: %s', len(results),
+                  dict(calls))
+        self._cal_cpu_utils(cpu_samples, results)
+        # Forget snapshots of disappeared domains.
+        for snapshots in (self._disk_snapshots, self._vnic_snapshots):
+            for key in list(snapshots):
+                if key[0] not in results:
+                    del snapshots[key]
+        for uuid in list(self._domain_ids):
+            if uuid not in results:
+                del self._domain_ids[uuid]
+        self.domain_filter.prune(seen)
+        self._restored_ids = {}
+        if self.hostfs is not None:
+            self.hostfs.prune(results)
         return results
 
+    def _check_domain_id(self, domain):
+        """Drop snapshots of a restored domain which was restarted."""
+        uuid = domain.UUIDString()
+        domain_id = domain.ID()
+        self._domain_ids[uuid] = domain_id
+        restored_id = self._restored_ids.pop(uuid, None)
+        if restored_id is None or restored_id == domain_id:
+            return
+        LOG.debug('%s restarted since checkpoint, drop its snapshots', uuid)
+        self._cpu_snapshots.pop(uuid, None)
+        for snapshots in (self._disk_snapshots, self._vnic_snapshots):
+            for key in list(snapshots):
+                if key[0] == uuid:
+                    del snapshots[key]
+
+    def export_snapshots(self):
+        """Counter snapshots of last cycle, as checkpoint records."""
+        ids = self._domain_ids
+        records = []
+        for (uuid, device), (now, stats) in \
+                list(self._disk_snapshots.items()):
+            records.append(checkpoint.make_record(
+                checkpoint.KIND_DISK, uuid, ids.get(uuid, -1), device, now,
+                [stats.get(c, 0) for c in checkpoint.DISK_COUNTERS]))
+        for (uuid, tap), (now, counters, source) in \
+                list(self._vnic_snapshots.items()):
+            kind = checkpoint.KIND_VNIC if source == SOURCE_HOSTFS \
+                else checkpoint.KIND_VNIC_LIBVIRT
+            records.append(checkpoint.make_record(
+                kind, uuid, ids.get(uuid, -1), tap, now,
+                [counters[c] for c in checkpoint.VNIC_COUNTERS]))
+        for uuid, (now, cpustats, vcpu_times, source) in \
+                list(self._cpu_snapshots.items()):
+            kind = checkpoint.KIND_CPU_HOSTFS if source == SOURCE_HOSTFS \
+                else checkpoint.KIND_CPU
+            records.append(checkpoint.make_record(
+                kind, uuid, ids.get(uuid, -1), '', now,
+                [cpustats.number, cpustats.time]))
+            for n, vcpu_time in enumerate(vcpu_times or ()):
+                records.append(checkpoint.make_record(
+                    checkpoint.KIND_VCPU, uuid, ids.get(uuid, -1), str(n),
+                    now, [vcpu_time]))
+        return records
+
+    def restore_snapshots(self, records):
+        """Restore counter snapshots from checkpoint records, those of
+        restarted domains are dropped on first cycle.
+        """
+        vcpus = {}
+        for r in records:
+            self._restored_ids[r.uuid] = r.domain_id
+            if r.kind == checkpoint.KIND_DISK:
+                self._disk_snapshots[(r.uuid, r.device)] = (
+                    r.time, dict(zip(checkpoint.DISK_COUNTERS, r.counters)))
+            elif r.kind in (checkpoint.KIND_VNIC,
+                            checkpoint.KIND_VNIC_LIBVIRT):
+                source = SOURCE_HOSTFS if r.kind == checkpoint.KIND_VNIC \
+                    else SOURCE_LIBVIRT
+                self._vnic_snapshots[(r.uuid, r.device)] = (
+                    r.time, dict(zip(checkpoint.VNIC_COUNTERS, r.counters)),
+                    source)
+            elif r.kind in (checkpoint.KIND_CPU,
+                            checkpoint.KIND_CPU_HOSTFS):
+                source = SOURCE_HOSTFS \
+                    if r.kind == checkpoint.KIND_CPU_HOSTFS \
+                    else SOURCE_LIBVIRT
+                self._cpu_snapshots[r.uuid] = (
+                    r.time, base.CPUStats(number=r.counters[0],
+                                          time=r.counters[1], util=None),
+                    None, source)
+            elif r.kind == checkpoint.KIND_VCPU:
+                vcpus.setdefault(r.uuid, {})[int(r.device)] = r.counters[0]
+        for uuid, times in vcpus.items():
+            snapshot = self._cpu_snapshots.get(uuid)
+            if snapshot is not None:
+                self._cpu_snapshots[uuid] = snapshot[:2] + (
+                    [times[n] for n in sorted(times)], snapshot[3])
+
     def _cal_metric_ps(self, current_metric, prev_metric, unit='MB/s'):
         """Calculate metric value per second"""
         result = current_metric - prev_metric
@@ -140,11 +360,37 @@ class LibvirtInspector(object):
 
     def _log_inspection(self, metric):
         """Log inspect operation"""
-        msg = 'Collecting %(metric)s' % {'metric': metric}
-        LOG.info(msg)
+        LOG.info('Collecting %s', metric)
+
+    def _get_host_files(self, domain):
+        """Resolve host files of a running domain, once."""
+        if self.hostfs is None:
+            return None
+        uuid = domain.UUIDString()
+        files = self.hostfs.get(uuid, domain.ID())
+        if files is None:
+            tree = etree.fromstring(domain.XMLDesc(0))
+            vcpu = tree.find('vcpu')
+            vcpus = None
+            if vcpu is not None:
+                vcpus = int(vcpu.get('current', vcpu.text))
+            files = self.hostfs.resolve(uuid, domain.name(), domain.ID(),
+                                        vcpus, list(self._parse_vnics(tree)))
+        return files
 
     def _check_collected_metric(self, metric):
-        return utils.ini_file_loader()['metrics-' + metric] == 'True'
+        return utils.ini_file_loader().get('metrics-' + metric) == 'True'
+
+    def _collect(self, family):
+        """Check if family is enabled and fits the cycle budget."""
+        if not self._check_collected_metric(family):
+            return False
+        return self.budget is None or self.budget.allow(family)
+
+    def _measure(self, family):
+        if self.budget is None:
+            return budget.NO_MEASURE
+        return self.budget.measure(family)
 
     def _inspect_state(self, domain):
         dom_info = domain.info()
@@ -152,24 +398,77 @@ class LibvirtInspector(object):
         state = settings.STATE_MAPPER[dom_info[0]]
         return base.StateStats(state=state)
 
-    def _inspect_cpus(self, domain):
+    def _inspect_cpus(self, domain, files=None):
+        """Return (CPUStats, source of cpu time).
+
+        cgroup usage_usec also counts qemu threads, it is not compared
+        with libvirt cpu time.
+        """
+        if files is not None and files.vcpus:
+            cpu_time = self.hostfs.read_cpu_time(files)
+            if cpu_time is not None:
+                return (base.CPUStats(number=files.vcpus, time=cpu_time,
+                                      util=None), SOURCE_HOSTFS)
         try:
             dom_info = domain.info()
-            return base.CPUStats(number=dom_info[3], time=dom_info[4])
+            return (base.CPUStats(number=dom_info[3], time=dom_info[4],
+                                  util=None), SOURCE_LIBVIRT)
         except libvirt.libvirtError as e:
-            msg = ('Failed to inspect cpu stats of %(instance_uuid)s, '
-                   'can not get info from libvirt: %(error)s') % {
-                'instance_uuid': domain.UUIDString(), 'error': e}
-            LOG.error(msg)
+            LOG.error('Failed to inspect cpu stats of %s, '
+                      'can not get info from libvirt: %s',
+                      domain.UUIDString(), e)
+        return None, None
 
-    def _inspect_vnics(self, domain):
-        tree = etree.fromstring(domain.XMLDesc(0))
+    def _inspect_vcpus(self, domain):
+        """Cumulative time of each vCPU, in nanoseconds.
+
+        getCPUStats(False) is per host CPU, per vCPU times come
+        from vcpus().
+        """
+        try:
+            vcpu_info = domain.vcpus()[0]
+            return [info[2] for info in sorted(vcpu_info)]
+        except libvirt.libvirtError as e:
+            LOG.error('Failed to inspect vcpu stats of %s, '
+                      'can not get info from libvirt: %s',
+                      domain.UUIDString(), e)
+
+    def _cal_cpu_utils(self, samples, results):
+        """Calculate cpu and vCPU utilization of all domains
+        in one pass, against the snapshots of previous cycle.
+        """
+        prev_samples = self._cpu_snapshots
+        # Domains which disappeared are dropped here.
+        self._cpu_snapshots = samples
+        for uuid, (now, cpustats, vcpu_times, source) in samples.items():
+            prev = prev_samples.get(uuid)
+            if prev is None:
+                continue
+            elapsed = (now - prev[0]) * 1e9
+            if elapsed <= 0:
+                continue
+            delta = cpustats.time - prev[1].time
+            if source != prev[3]:
+                LOG.debug('cpu time source of %s changed to %s', uuid,
+                          source)
+            elif delta >= 0 and cpustats.number:
+                results[uuid]['cpustats'] = cpustats._replace(
+                    util=delta * 100.0 / elapsed / cpustats.number)
+            if vcpu_times and prev[2] and len(vcpu_times) == len(prev[2]):
+                for n, (cur, old) in enumerate(zip(vcpu_times, prev[2])):
+                    if cur >= old:
+                        results[uuid]['vcpustats_%d' % n] = \
+                            base.VCPUStats(util=(cur - old) * 100.0 / elapsed)
+
+    def _parse_vnics(self, tree):
         for iface in tree.findall('devices/interface'):
             target = iface.find('target')
             if target is not None:
                 name = target.get('dev')
             else:
                 continue
+            if not self.device_filter.interface(iface, name):
+                continue
             mac = iface.find('mac')
             if mac is not None:
                 mac_address = mac.get('address')
@@ -181,91 +480,138 @@ class LibvirtInspector(object):
 
             params = dict((p.get('name').lower(), p.get('value'))
                           for p in iface.findall('filterref/parameter'))
-            interface = base.Interface(name=name, mac=mac_address,
-                                       fref=fref, parameters=params)
-            stats = None
-            try:
-                # Get stats.
-                dom_stats_1 = domain.interfaceStats(name)
-                time.sleep(1)
-                dom_stats_2 = domain.interfaceStats(name)
-                # Calculate transmitted/received megabit/second.
-                tx_megabit_ps = self._cal_metric_ps(dom_stats_2[4],
-                                                    dom_stats_1[4],
-                                                    unit='Mb/s')
-                rx_megabit_ps = self._cal_metric_ps(dom_stats_2[0],
-                                                    dom_stats_1[0],
-                                                    unit='Mb/s')
-                # Calculate transmitted/received packets/second.
-                tx_packets_ps = self._cal_metric_ps(dom_stats_2[5],
-                                                    dom_stats_1[5],
-                                                    unit='packets/s')
-                rx_packets_ps = self._cal_metric_ps(dom_stats_2[1],
-                                                    dom_stats_1[1],
-                                                    unit='packets/s')
-                stats = base.InterfaceStats(tx_megabit_ps=tx_megabit_ps,
-                                            rx_megabit_ps=rx_megabit_ps,
-                                            tx_packets_ps=tx_packets_ps,
-                                            rx_packets_ps=rx_packets_ps)
-            except libvirt.libvirtError as e:
-                msg = ('Failed to inspect %(interface)s stats of '
-                       '%(instance_uuid)s, can not get info from'
-                       'libvirt: %(error)s') % {
-                    'interface': interface,
-                    'instance_uuid': domain.UUIDString(),
-                    'error': e}
-                LOG.error(msg)
+            yield base.Interface(name=name, mac=mac_address,
+                                 fref=fref, parameters=params)
+
+    def _inspect_vnics(self, domain, files=None):
+        if files is not None:
+            # Interfaces were parsed once, when host files were resolved.
+            interfaces = files.interfaces
+        else:
+            interfaces = self._parse_vnics(
+                etree.fromstring(domain.XMLDesc(0)))
+        uuid = domain.UUIDString()
+        for interface in interfaces:
+            counters = None
+            source = SOURCE_HOSTFS
+            if files is not None and interface.name in files.net_fds:
+                counters = self.hostfs.read_net(files, interface.name)
+            if counters is None:
+                source = SOURCE_LIBVIRT
+                try:
+                    # Cumulative counters, guest point of view.
+                    dom_stats = domain.interfaceStats(interface.name)
+                except libvirt.libvirtError as e:
+                    LOG.error('Failed to inspect %s stats of %s, can not '
+                              'get info from libvirt: %s',
+                              interface, uuid, e)
+                    yield (interface, None)
+                    continue
+                counters = {'rx_bytes': dom_stats[4],
+                            'rx_packets': dom_stats[5],
+                            'tx_bytes': dom_stats[0],
+                            'tx_packets': dom_stats[1]}
 
+            now = time.time()
+            prev = self._vnic_snapshots.get((uuid, interface.name))
+            self._vnic_snapshots[(uuid, interface.name)] = (now, counters,
+                                                            source)
+            if prev is None or prev[2] != source:
+                # Rates need the previous cycle's snapshot, of the
+                # same counters.
+                LOG.debug('First sample of %s of %s', interface.name, uuid)
+                continue
+            stats = self._cal_vnic_stats(prev[0], prev[1], now, counters)
+            if stats is None:
+                LOG.debug('Counters of %s of %s were reset',
+                          interface.name, uuid)
+                continue
             yield (interface, stats)
 
+    def _cal_vnic_stats(self, prev_time, prev, cur_time, cur):
+        """Interface stats from counters of two cycles.
+
+        Counters are seen from the host: tap rx is guest tx.
+        """
+        elapsed = cur_time - prev_time
+        deltas = dict((k, cur[k] - prev[k]) for k in cur)
+        if elapsed <= 0 or min(deltas.values()) < 0:
+            return None
+        return base.InterfaceStats(
+            tx_megabit_ps=self._cal_metric_ps(deltas['rx_bytes'], 0,
+                                              unit='Mb/s') / elapsed,
+            rx_megabit_ps=self._cal_metric_ps(deltas['tx_bytes'], 0,
+                                              unit='Mb/s') / elapsed,
+            tx_packets_ps=deltas['rx_packets'] / elapsed,
+            rx_packets_ps=deltas['tx_packets'] / elapsed)
+
     def _inspect_disks(self, domain):
         tree = etree.fromstring(domain.XMLDesc(0))
+        uuid = domain.UUIDString()
         for device in filter(
             bool,
-            [target.get("dev")
-             for target in tree.findall('devices/disk/target')]):
+            [self.device_filter.disk(disk)
+             for disk in tree.findall('devices/disk')]):
             disk = base.Disk(device=device)
-            stats = None
             try:
-                block_stats_1 = domain.blockStats(device)
-                # block_latency_stats_1 = domain.blockStatsFlags(device)
-                time.sleep(1)
-                block_stats_2 = domain.blockStats(device)
-                # Calculate read/write operations/s.
-                read_requests_ps = self._cal_metric_ps(block_stats_2[0],
-                                                       block_stats_1[0],
-                                                       unit='operations/s')
-                write_requests_ps = self._cal_metric_ps(block_stats_2[2],
-                                                        block_stats_1[2],
-                                                        unit='operations/s')
-                # Calculate read/write megabytes/s.
-                read_megabytes_ps = self._cal_metric_ps(block_stats_2[1],
-                                                        block_stats_1[1],
-                                                        unit='MB/s')
-                write_megabytes_ps = self._cal_metric_ps(block_stats_2[3],
-                                                         block_stats_1[3],
-                                                         unit='MB/s')
-                # Calculate read_await and write_await.
-                iostat = base.IOStat()
-                r_await = iostat.get_specific_diskstat(device)['r_await']
-                w_await = iostat.get_specific_diskstat(device)['w_await']
-                stats = base.DiskStats(read_requests_ps=read_requests_ps,
-                                       write_requests_ps=write_requests_ps,
-                                       read_megabytes_ps=read_megabytes_ps,
-                                       write_megabytes_ps=write_megabytes_ps,
-                                       r_await=r_await,
-                                       w_await=w_await,
-                                       errors=block_stats_2[4])
+                # Cumulative counters, times are in nanoseconds.
+                block_stats = domain.blockStatsFlags(device, 0)
             except libvirt.libvirtError as e:
-                msg = ('Failed to inspect %(device)s stats of '
-                       '%(instance_uuid)s, can not get info from'
-                       'libvirt: %(error)s') % {
-                    'device': device, 'instance_uuid': domain.UUIDString(),
-                    'error': e}
-                LOG.error(msg)
+                LOG.error('Failed to inspect %s stats of %s, can not get '
+                          'info from libvirt: %s', device, uuid, e)
+                yield (disk, None)
+                continue
 
+            now = time.time()
+            prev = self._disk_snapshots.get((uuid, device))
+            self._disk_snapshots[(uuid, device)] = (now, block_stats)
+            if prev is None:
+                # Rates need the previous cycle's snapshot.
+                LOG.debug('First sample of %s of %s', device, uuid)
+                continue
+            stats = self._cal_disk_stats(prev[0], prev[1], now, block_stats)
+            if stats is None:
+                LOG.debug('Counters of %s of %s were reset', device, uuid)
+                continue
             yield (disk, stats)
 
+    def _cal_disk_stats(self, prev_time, prev, cur_time, cur):
+        """Calculate DiskStats from two blockStatsFlags snapshots."""
+        elapsed = cur_time - prev_time
+        if elapsed <= 0:
+            return None
+
+        def delta(key):
+            return cur.get(key, 0) - prev.get(key, 0)
+
+        rd_ops = delta('rd_operations')
+        wr_ops = delta('wr_operations')
+        rd_bytes = delta('rd_bytes')
+        wr_bytes = delta('wr_bytes')
+        rd_times = delta('rd_total_times')
+        # Flushes are accounted as writes, like iostat does on kernels
+        # without separate flush statistics.
+        wr_ops_all = wr_ops + delta('flush_operations')
+        wr_times = delta('wr_total_times') + delta('flush_total_times')
+        if min(rd_ops, wr_ops_all, rd_bytes, wr_bytes,
+               rd_times, wr_times) < 0:
+            # Domain restarted, counters started over.
+            return None
+
+        # Average time of requests in milliseconds.
+        r_await = rd_times / 1e6 / rd_ops if rd_ops else 0.0
+        w_await = wr_times / 1e6 / wr_ops_all if wr_ops_all else 0.0
+        return base.DiskStats(
+            read_requests_ps=rd_ops / elapsed,
+            write_requests_ps=wr_ops / elapsed,
+            read_megabytes_ps=self._cal_metric_ps(rd_bytes, 0,
+                                                  unit='MB/s') / elapsed,
+            write_megabytes_ps=self._cal_metric_ps(wr_bytes, 0,
+                                                   unit='MB/s') / elapsed,
+            r_await=r_await,
+            w_await=w_await,
+            errors=max(cur.get('errs', 0), 0))
+
     def _inspect_memory_usage(self, domain, duration=None):
         try:
             memory_stats = domain.memoryStats()
@@ -278,20 +624,17 @@ class LibvirtInspector(object):
                 memory_used = memory_used / settings.UNITS['Ki']
                 return base.MemoryUsageStats(usage=memory_used)
             else:
-                msg = ('Failed to inspect memory usage of instance '
-                       '<name=%(name)s, id=%(id)s>, '
-                       'can not get info from libvirt.') % {
-                    'name': domain.name(), 'id': domain.ID()}
-                LOG.error(msg)
+                LOG.error('Failed to inspect memory usage of instance '
+                          '<name=%s, id=%s>, can not get info from libvirt.',
+                          domain.name(), domain.ID())
                 return None
                 # raise base.NoDataException(msg)
         # memoryStats might launch an exception if the method is not supported
         # by the underlying hypervisor being used by libvirt.
         except libvirt.libvirtError as e:
-            msg = ('Failed to inspect memory usage of %(instance_uuid)s, '
-                   'can not get info from libvirt: %(error)s') % {
-                'instance_uuid': domain.UUIDString(), 'error': e}
-            LOG.error(msg)
+            LOG.error('Failed to inspect memory usage of %s, '
+                      'can not get info from libvirt: %s',
+                      domain.UUIDString(), e)
             # raise base.NoDataException(msg)
 
     def _inspect_disk_info(self, domain):
@@ -301,11 +644,9 @@ class LibvirtInspector(object):
             if disk_type:
                 if disk_type == 'network':
                     LOG.info('Inspection disk usage of network disk '
-                             '%(domain_id)s unsupported by libvirt' % {
-                                 'domain_id': domain.ID()})
+                             '%s unsupported by libvirt', domain.ID())
                     continue
-                target = disk.find('target')
-                device = target.get('dev')
+                device = self.device_filter.disk(disk)
                 if device:
                     dsk = base.Disk(device=device)
                     block_info = domain.blockInfo(device)
@@ -314,12 +655,16 @@ class LibvirtInspector(object):
                                          physical=block_info[2])
                     yield (dsk, info)
 
-    def _inspect_memory_resident(self, domain, duration=None):
+    def _inspect_memory_resident(self, domain, duration=None, files=None):
+        if files is not None:
+            memory = self.hostfs.read_memory(files)
+            if memory is not None:
+                return base.MemoryResidentStats(
+                    resident=memory / settings.UNITS['Mi'])
         try:
             memory = domain.memoryStats()['rss'] / settings.UNITS['Ki']
             return base.MemoryResidentStats(resident=memory)
         except libvirt.libvirtError as e:
-            msg = ('Failed to inspect memory resident of %(instance_uuid)s, '
-                   'can not get info from libvirt: %(error)s') % {
-                'instance_uuid': domain.UUIDString(), 'error': e}
-            LOG.error(msg)
+            LOG.error('Failed to inspect memory resident of %s, '
+                      'can not get info from libvirt: %s',
+                      domain.UUIDString(), e)
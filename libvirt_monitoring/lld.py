@@ -0,0 +1,220 @@
+"""Zabbix low-level discovery (LLD) provisioning.
+
+Items and triggers are created by Zabbix from the prototypes of a
+template, which is imported once with `import_template`. The agent
+only sends discovery payloads listing domains, vNICs, disks and vCPUs.
+"""
+import json
+import logging
+
+from libvirt_monitoring import base
+from libvirt_monitoring import budget
+from libvirt_monitoring import sampling
+from libvirt_monitoring import poller
+from libvirt_monitoring import topn
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixMetric
+
+
+LOG = logging.getLogger(__name__)
+
+DOMAIN_DISCOVERY_KEY = 'libvirt.domain.discovery'
+VNIC_DISCOVERY_KEY = 'libvirt.vnic.discovery'
+DISK_DISCOVERY_KEY = 'libvirt.disk.discovery'
+VCPU_DISCOVERY_KEY = 'libvirt.vcpu.discovery'
+
+# Metric family -> (fields, device discovery key, device macro)
+FAMILIES = {
+    'statestats': (base.StateStats._fields, DOMAIN_DISCOVERY_KEY, None),
+    'cpustats': (base.CPUStats._fields, DOMAIN_DISCOVERY_KEY, None),
+    'vcpustats': (base.VCPUStats._fields, VCPU_DISCOVERY_KEY, '{#VCPU}'),
+    'memoryusagestats': (base.MemoryUsageStats._fields,
+                         DOMAIN_DISCOVERY_KEY, None),
+    'memoryresidentstats': (base.MemoryResidentStats._fields,
+                            DOMAIN_DISCOVERY_KEY, None),
+    'interfacestats': (base.InterfaceStats._fields,
+                       VNIC_DISCOVERY_KEY, '{#VNIC}'),
+    'diskstats': (base.DiskStats._fields, DISK_DISCOVERY_KEY, '{#DISK}'),
+    'diskinfo': (base.DiskInfo._fields, DISK_DISCOVERY_KEY, '{#DISK}'),
+}
+
+DISCOVERY_RULES = (
+    (DOMAIN_DISCOVERY_KEY, 'Libvirt domains'),
+    (VNIC_DISCOVERY_KEY, 'Libvirt vNICs'),
+    (DISK_DISCOVERY_KEY, 'Libvirt disks'),
+    (VCPU_DISCOVERY_KEY, 'Libvirt vCPUs'),
+)
+
+TEMPLATE_GROUP = 'Templates/Virtualization'
+
+
+def item_key(metric_key, field, uuid):
+    """Item key used with LLD, device is a key parameter.
+
+    e.x: libvirt.diskstats.r_await[<uuid>,vda]
+    """
+    family, _, device = metric_key.partition('_')
+    if device:
+        return 'libvirt.%s.%s[%s,%s]' % (family, field, uuid, device)
+    return 'libvirt.%s.%s[%s]' % (family, field, uuid)
+
+
+def discovery_metrics(host, all_metrics, clock=None):
+    """Build discovery values of domains, vNICs, disks and vCPUs."""
+    domains = []
+    vnics = []
+    disks = []
+    vcpus = []
+    for uuid, vm_metrics in all_metrics.items():
+        domains.append({'{#UUID}': uuid})
+        vm_disks = set()
+        for metric_key in vm_metrics:
+            family, _, device = metric_key.partition('_')
+            if not device:
+                continue
+            if family == 'interfacestats':
+                vnics.append({'{#UUID}': uuid, '{#VNIC}': device})
+            elif family == 'vcpustats':
+                vcpus.append({'{#UUID}': uuid, '{#VCPU}': device})
+            elif family in ('diskstats', 'diskinfo'):
+                vm_disks.add(device)
+        disks.extend({'{#UUID}': uuid, '{#DISK}': disk}
+                     for disk in sorted(vm_disks))
+
+    return [ZabbixMetric(host, key, json.dumps({'data': data}), clock)
+            for key, data in ((DOMAIN_DISCOVERY_KEY, domains),
+                              (VNIC_DISCOVERY_KEY, vnics),
+                              (DISK_DISCOVERY_KEY, disks),
+                              (VCPU_DISCOVERY_KEY, vcpus))]
+
+
+def build_template(config):
+    """Build template export with one item prototype per field
+    which has a threshold, the same items agent sends.
+    """
+    name = config.get('zabbix_agent-template', 'Template Libvirt Monitoring')
+    thresholds = [k.replace('thresholds-', '') for k in config
+                  if k.startswith('thresholds-')]
+    rules = dict((key, {'name': rule_name,
+                        'type': 'TRAP',
+                        'key': key,
+                        'delay': '0',
+                        'lifetime': config.get('zabbix_agent-lld_lifetime',
+                                               '1d'),
+                        'item_prototypes': []})
+                 for key, rule_name in DISCOVERY_RULES)
+
+    aggregated = config.get('sampling-enabled') == 'True'
+    for family, (fields, rule_key, macro) in sorted(FAMILIES.items()):
+        if aggregated:
+            fields = sampling.aggregate_fields(fields)
+        for field in fields:
+            # Thresholds apply to aggregates too, e.x: r_await_max.
+            if not any(t in field for t in thresholds):
+                continue
+            if macro:
+                key = 'libvirt.%s.%s[{#UUID},%s]' % (family, field, macro)
+                item_name = '{#UUID} - %s %s - %s' % (
+                    family.title(), macro, field.title())
+            else:
+                key = 'libvirt.%s.%s[{#UUID}]' % (family, field)
+                item_name = '{#UUID} - %s - %s' % (family.title(),
+                                                   field.title())
+            expression = '{%s:%s.count(%s)}>%s' % (
+                name, key, config['trigger-sec'],
+                config['trigger-constant'])
+            rules[rule_key]['item_prototypes'].append({
+                'name': item_name,
+                'type': 'TRAP',
+                'key': key,
+                'delay': '0',
+                'value_type': 'FLOAT',
+                'trigger_prototypes': [{
+                    'expression': expression,
+                    'name': '%s last %s is too high' % (
+                        item_name, config['trigger-sec']),
+                    'priority': 'WARNING',
+                }],
+            })
+
+    # Host level items, not discovered.
+    host_items = []
+    if config.get('topn-enabled') == 'True':
+        host_items = [{'name': 'Top domains by %s' % field,
+                       'type': 'TRAP',
+                       'key': topn.item_key(field),
+                       'delay': '0',
+                       'history': '7d',
+                       'value_type': 'TEXT'}
+                      for field, _ in topn.RANKINGS]
+    if config.get('budget-enabled') == 'True':
+        host_items.append({'name': 'Deferred metric families',
+                           'type': 'TRAP',
+                           'key': budget.DEFERRED_KEY,
+                           'delay': '0',
+                           'history': '7d',
+                           'value_type': 'TEXT'})
+    if config.get('poller-enabled') == 'True':
+        for uri in config.get('poller-uris', '').split(','):
+            if not uri.strip():
+                continue
+            name = poller.host_name(uri.strip())
+            host_items.append({'name': 'Poll status of %s' % name,
+                               'type': 'TRAP',
+                               'key': poller.status_key(name),
+                               'delay': '0',
+                               'history': '7d',
+                               'value_type': 'UNSIGNED'})
+            host_items.append({'name': 'Domains of %s' % name,
+                               'type': 'TRAP',
+                               'key': poller.domains_key(name),
+                               'delay': '0',
+                               'history': '7d',
+                               'value_type': 'UNSIGNED'})
+
+    return {
+        'zabbix_export': {
+            'version': '5.0',
+            'groups': [{'name': TEMPLATE_GROUP}],
+            'templates': [{
+                'template': name,
+                'name': name,
+                'groups': [{'name': TEMPLATE_GROUP}],
+                'items': host_items,
+                'discovery_rules': [rules[key]
+                                    for key, _ in DISCOVERY_RULES],
+            }],
+        }
+    }
+
+
+def import_template(zapi, config):
+    """Import template and link it to the agent host.
+
+    This is the only place where API is used in LLD mode,
+    run it once at install time.
+    """
+    template = build_template(config)
+    name = template['zabbix_export']['templates'][0]['template']
+    rules = {
+        'groups': {'createMissing': True},
+        'templates': {'createMissing': True, 'updateExisting': True},
+        'discoveryRules': {'createMissing': True, 'updateExisting': True},
+        'items': {'createMissing': True, 'updateExisting': True},
+        'triggers': {'createMissing': True, 'updateExisting': True},
+    }
+    zapi.confimport(confformat='json', source=json.dumps(template),
+                    rules=rules)
+    LOG.info('Imported template %s', name)
+
+    templates = zapi.template.get(filter={'host': name},
+                                  output=['templateid'])
+    hosts = zapi.host.get(filter={'host': config['zabbix_agent-hostname']},
+                          output=['hostid'])
+    if not templates or not hosts:
+        LOG.error('Not found template %s or host %s', name,
+                  config['zabbix_agent-hostname'])
+        return False
+    zapi.template.massadd(templates=templates, hosts=hosts)
+    LOG.info('Linked template %s to host %s', name,
+             config['zabbix_agent-hostname'])
+    return True
@@ -0,0 +1,221 @@
+"""Trapper load generator, to size Zabbix servers and proxies.
+
+Simulated hypervisors send synthetic per-VM item streams through the
+real ZabbixSender/ZabbixMetric encoding path, the achieved throughput,
+request latency percentiles and server processed/failed counts are
+reported. A local fake trapper can be used for offline testing:
+    libvirt_monitoring loadgen --fake --hypervisors 20 --duration 30
+"""
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+import uuid as uuidlib
+import zlib
+
+from six.moves import socketserver
+
+from libvirt_monitoring import utils
+from libvirt_monitoring.py_zabbix_api import zsender
+
+
+# Item streams of each simulated VM, (metric_key, field).
+VM_ITEMS = (
+    ('cpustats', 'util'),
+    ('memoryusagestats', 'usage'),
+    ('diskstats_vda', 'read_requests_ps'),
+    ('diskstats_vda', 'write_requests_ps'),
+    ('diskstats_vda', 'r_await'),
+    ('diskstats_vda', 'w_await'),
+    ('interfacestats_tap0', 'tx_megabit_ps'),
+    ('interfacestats_tap0', 'rx_megabit_ps'),
+)
+
+
+class FakeTrapper(object):
+
+    """Minimal trapper: accept sender data, answer all processed."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        class Handler(socketserver.BaseRequestHandler):
+
+            def _read(self, count):
+                buf = b''
+                while len(buf) < count:
+                    chunk = self.request.recv(count - len(buf))
+                    if not chunk:
+                        break
+                    buf += chunk
+                return buf
+
+            def handle(self):
+                header = self._read(13)
+                if len(header) != 13 or not header.startswith(b'ZBXD'):
+                    return
+                flags, length, _ = struct.unpack('<BII', header[4:])
+                data = self._read(length)
+                if flags & zsender.ZBX_FLAG_COMPRESSED:
+                    data = zlib.decompress(data)
+                count = len(json.loads(data.decode('utf-8'))['data'])
+                body = json.dumps({
+                    'response': 'success',
+                    'info': 'processed: %d; failed: 0; total: %d; '
+                            'seconds spent: 0.000100' % (count, count),
+                }).encode('utf-8')
+                self.request.sendall(b'ZBXD\x01' +
+                                     struct.pack('<Q', len(body)) + body)
+
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            request_queue_size = 128
+
+        self._server = Server((host, port), Handler)
+        self.address = self._server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='fake-trapper')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Hypervisor(object):
+
+    """Simulated agent host, items of its VMs."""
+
+    def __init__(self, n, vms):
+        self.host = 'loadgen-hv%04d' % n
+        self.uuids = [str(uuidlib.uuid4()) for _ in range(vms)]
+
+    def metrics(self):
+        clock = int(time.time())
+        return [zsender.ZabbixMetric(
+            self.host, '%s.%s[%s]' % (metric_key, field, uuid),
+            round(random.uniform(0, 100), 2), clock)
+            for uuid in self.uuids for metric_key, field in VM_ITEMS]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.processed = 0
+        self.failed = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency, sent, response=None):
+        with self._lock:
+            self.latencies.append(latency)
+            self.sent += sent
+            if response is None:
+                self.errors += 1
+            else:
+                self.processed += response.processed
+                self.failed += response.failed
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+
+def _worker(hypervisors, args, stats, deadline):
+    sender = zsender.ZabbixSender(zabbix_server=args.server,
+                                  zabbix_port=args.port,
+                                  chunk_size=args.chunk_size,
+                                  compression=args.compress)
+    next_cycle = time.time()
+    while time.time() < deadline:
+        for hv in hypervisors:
+            metrics = hv.metrics()
+            for m in range(0, len(metrics), args.chunk_size):
+                chunk = metrics[m:m + args.chunk_size]
+                started = time.time()
+                try:
+                    response = sender.send(chunk)
+                except Exception:
+                    response = None
+                stats.add(time.time() - started, len(chunk), response)
+                if time.time() >= deadline:
+                    return
+        if args.interval:
+            # Agent like pacing, one cycle per interval.
+            next_cycle += args.interval
+            time.sleep(max(next_cycle - time.time(), 0))
+
+
+def run(argv):
+    config = utils.ini_file_loader()
+    parser = argparse.ArgumentParser(
+        prog='libvirt_monitoring loadgen',
+        description='Send synthetic agent items to a Zabbix trapper.')
+    parser.add_argument('--server',
+                        default=config.get('zabbix_server-ip', '127.0.0.1'))
+    parser.add_argument('--port', type=int,
+                        default=int(config.get('zabbix_server-port', 10051)))
+    parser.add_argument('--fake', action='store_true',
+                        help='send to a local fake trapper')
+    parser.add_argument('--hypervisors', type=int, default=10)
+    parser.add_argument('--vms', type=int, default=20,
+                        help='VMs per hypervisor')
+    parser.add_argument('--chunk-size', type=int, default=250)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='parallel senders')
+    parser.add_argument('--compress', action='store_true',
+                        help='zlib compressed packets')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='seconds between cycles of each hypervisor, '
+                             '0 to send as fast as possible')
+    args = parser.parse_args(argv)
+
+    trapper = None
+    if args.fake:
+        trapper = FakeTrapper()
+        trapper.start()
+        args.server, args.port = trapper.address
+
+    hypervisors = [Hypervisor(n, args.vms) for n in range(args.hypervisors)]
+    stats = Stats()
+    started = time.time()
+    deadline = started + args.duration
+    workers = []
+    concurrency = max(args.concurrency, 1)
+    for n in range(concurrency):
+        worker = threading.Thread(
+            target=_worker,
+            args=(hypervisors[n::concurrency], args, stats, deadline))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+    if trapper:
+        trapper.stop()
+
+    ordered = sorted(stats.latencies)
+    print('target: %s:%s%s' % (args.server, args.port,
+                               ' (fake)' if args.fake else ''))
+    print('hypervisors: %d, VMs: %d, items per cycle: %d' % (
+        args.hypervisors, args.hypervisors * args.vms,
+        args.hypervisors * args.vms * len(VM_ITEMS)))
+    print('requests: %d (%d errors), %.1f/s' % (
+        len(ordered), stats.errors, len(ordered) / elapsed))
+    print('metrics sent: %d, %.1f/s' % (stats.sent, stats.sent / elapsed))
+    print('server processed: %d, failed: %d' % (stats.processed,
+                                                stats.failed))
+    print('latency ms: p50 %.2f, p90 %.2f, p99 %.2f, max %.2f' % tuple(
+        percentile(ordered, p) * 1000 for p in (0.5, 0.9, 0.99, 1.0)))
+    return 0 if not stats.errors else 1
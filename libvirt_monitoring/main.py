@@ -1,5 +1,6 @@
 import logging
 import os
+import socket
 import sys
 
 
@@ -9,31 +10,73 @@ print(PROJECT_ROOT)
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
+from libvirt_monitoring import agent
 from libvirt_monitoring import daemon
+from libvirt_monitoring import lld
+from libvirt_monitoring import loadgen
+from libvirt_monitoring import replay
 from libvirt_monitoring import utils
 
 
 LOG = logging.getLogger(__name__)
 
 
+def import_template():
+    """Import LLD template and link it to agent host."""
+    configs = utils.ini_file_loader()
+    zapi = agent.get_zabbix_api(configs)
+    if not lld.import_template(zapi, configs):
+        sys.exit(1)
+
+
+def query(args):
+    """Query time series kept by a running agent (tsdb output)."""
+    configs = utils.ini_file_loader()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(configs.get('tsdb-socket',
+                             '/var/run/libvirt_monitoring/query.sock'))
+    sock.sendall((' '.join(args) + '\n').encode('utf-8'))
+    response = b''
+    while not response.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        response += chunk
+    sock.close()
+    print(response.decode('utf-8').strip())
+
+
 def main():
     # Load logging config.
     utils.logging_config_loader()
+    if len(sys.argv) == 2 and 'import-template' == sys.argv[1]:
+        import_template()
+        return
+    if len(sys.argv) > 2 and 'query' == sys.argv[1]:
+        query(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and 'loadgen' == sys.argv[1]:
+        sys.exit(loadgen.run(sys.argv[2:]))
+    if len(sys.argv) in (3, 4) and 'replay' == sys.argv[1]:
+        replay.replay(sys.argv[2], fast=sys.argv[3:] == ['fast'])
+        return
     # Init AgentDaemon.
     LOG.info('Initiliaze AgentDaemon')
     agent_daemon = daemon.AgentDaemon('/tmp/agent-daemon.pid')
     if len(sys.argv) == 2:
         if 'start' == sys.argv[1]:
             agent_daemon.start()
-        if 'stop' == sys.argv[1]:
+        elif 'stop' == sys.argv[1]:
             agent_daemon.stop()
-        if 'restart' == sys.argv[1]:
+        elif 'restart' == sys.argv[1]:
             agent_daemon.restart()
         else:
             print('Unknow command')
             sys.exit(2)
     else:
-        print('usage: %s start|stop|restart' % sys.argv[0])
+        print('usage: %s start|stop|restart|import-template|'
+              'query <uuid> <metric>.<field> [<seconds>]|'
+              'replay <trace> [fast]|loadgen [--help]' % sys.argv[0])
         sys.exit(2)
 
 
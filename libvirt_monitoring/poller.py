@@ -0,0 +1,160 @@
+"""Central poller: one agent monitoring many remote libvirt hosts.
+
+Each host has its own read-only connection (with keepalive) kept
+between cycles, lost ones are reopened in background. Hosts are
+polled concurrently by a pool of worker threads, the cycle waits for
+them until the deadline only. A host which is still busy (stuck RPC)
+is skipped until its poll ends, so a slow host can not delay or
+block the others.
+"""
+import logging
+import threading
+import time
+
+from six.moves import queue
+from six.moves.urllib import parse
+
+from libvirt_monitoring import base
+from libvirt_monitoring import inspector
+
+
+LOG = logging.getLogger(__name__)
+
+# Host status items values.
+STATUS_DOWN = 0
+STATUS_UP = 1
+STATUS_TIMEOUT = 2
+STATUS_BUSY = 3
+
+
+def host_name(uri):
+    """Hypervisor name used in item keys, e.x: hv01."""
+    return parse.urlparse(uri).hostname or uri
+
+
+def status_key(name):
+    return 'libvirt.poller.status[%s]' % name
+
+
+def domains_key(name):
+    return 'libvirt.poller.domains[%s]' % name
+
+
+class RemoteHost(object):
+
+    def __init__(self, uri, keepalive):
+        self.uri = uri
+        self.name = host_name(uri)
+        self.inspector = inspector.LibvirtInspector(uri=uri,
+                                                    keepalive=keepalive)
+        self.busy = False
+        self.status = STATUS_DOWN
+        self.domains = 0
+        self.duration = 0.0
+
+
+class RemotePoller(object):
+
+    """
+    Poll many libvirt hosts, quacks like LibvirtInspector:
+    get_vm_metrics() returns {uuid: metrics} of all hosts
+    (domain UUIDs are unique across hosts).
+    """
+
+    def __init__(self, uris, workers=16, deadline=30, keepalive=(5, 3)):
+        self.hosts = [RemoteHost(uri, keepalive) for uri in uris]
+        self.deadline = float(deadline)
+        self._jobs = queue.Queue()
+        self._cond = threading.Condition()
+        for n in range(min(int(workers), len(self.hosts)) or 1):
+            worker = threading.Thread(target=self._work,
+                                      name='poller-%d' % n)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            host, results = self._jobs.get()
+            started = time.time()
+            try:
+                metrics = host.inspector.get_vm_metrics()
+                # Lost connection is reopened in background.
+                status = STATUS_UP \
+                    if host.inspector.connection_manager.healthy \
+                    else STATUS_DOWN
+            except Exception as e:
+                LOG.error('Failed to poll %s - %s', host.uri, e)
+                metrics = None
+                status = STATUS_DOWN
+            with self._cond:
+                host.busy = False
+                host.duration = time.time() - started
+                # Late results of a timed out cycle are dropped.
+                if host in results:
+                    results[host] = (status, metrics)
+                    self._cond.notify_all()
+
+    def get_vm_metrics(self):
+        """Poll all hosts, merge domain metrics of those which
+        answered before the deadline.
+        """
+        results = {}
+        with self._cond:
+            for host in self.hosts:
+                if host.busy:
+                    LOG.warning('%s is still busy with previous poll',
+                                host.uri)
+                    host.status = STATUS_BUSY
+                    continue
+                host.busy = True
+                results[host] = None
+                self._jobs.put((host, results))
+
+            end = time.time() + self.deadline
+            while None in results.values():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            all_metrics = {}
+            for host, result in list(results.items()):
+                if result is None:
+                    LOG.warning('%s did not answer in %ss', host.uri,
+                                self.deadline)
+                    host.status = STATUS_TIMEOUT
+                    host.domains = 0
+                    continue
+                host.status, metrics = result
+                host.domains = len(metrics or {})
+                if metrics:
+                    all_metrics.update(metrics)
+            # Detach results, workers still running drop theirs.
+            results.clear()
+        return all_metrics
+
+    def export_snapshots(self):
+        records = []
+        for host in self.hosts:
+            records.extend(host.inspector.export_snapshots())
+        return records
+
+    def restore_snapshots(self, records):
+        # Each host drops snapshots of domains it does not have on
+        # its first cycle.
+        for host in self.hosts:
+            host.inspector.restore_snapshots(records)
+
+    def status_items(self):
+        """Host level items with the poll status of each host."""
+        items = []
+        for host in self.hosts:
+            items.append(base.Item(
+                key=status_key(host.name),
+                name='Poll status of %s' % host.name,
+                value=host.status))
+            items.append(base.Item(
+                key=domains_key(host.name),
+                name='Domains of %s' % host.name,
+                value=host.domains))
+        return items
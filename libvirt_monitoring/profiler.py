@@ -0,0 +1,179 @@
+"""On-demand profiling of collection cycles, for a running agent.
+
+- SIGUSR1: profile the next cycles, with cProfile (.pstats files) or
+  a low overhead stack sampler (.folded collapsed stacks, input of
+  flamegraph.pl/speedscope).
+- SIGUSR2: trace allocations over the next cycles, write the top
+  allocation growth between consecutive cycles (Python 3 only).
+
+Signal handlers only set requests, work is done around the cycles.
+Only the collector thread (the one running cycles) is profiled: time
+spent by output sink threads, e.x: sending to Zabbix, is not in the
+profiles, allocations of all threads are traced.
+"""
+import cProfile
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.
+    tracemalloc = None
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StackSampler(object):
+
+    """Sample stacks of one thread from a background thread."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+class CycleProfiler(object):
+
+    def __init__(self, directory, cycles=3, mode='sampler',
+                 sample_interval=0.005, top=25):
+        self.directory = directory
+        self.cycles = int(cycles)
+        # sampler or cprofile
+        self.mode = mode
+        self.sample_interval = float(sample_interval)
+        self.top = int(top)
+        # Cycles left to profile / trace.
+        self._profile_cycles = 0
+        self._memory_cycles = 0
+        self._snapshot = None
+
+    def request_profile(self, signum=None, frame=None):
+        """Signal handler: profile the next cycles."""
+        self._profile_cycles = self.cycles
+
+    def request_memory(self, signum=None, frame=None):
+        """Signal handler: trace allocations of the next cycles."""
+        # One more cycle for the baseline snapshot.
+        self._memory_cycles = self.cycles + 1
+
+    def _path(self, kind, ext):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        return os.path.join(self.directory, '%s-%s-%d.%s' % (
+            kind, time.strftime('%Y%m%d-%H%M%S'), self._profile_cycles
+            or self._memory_cycles, ext))
+
+    def run(self, func, *args, **kwargs):
+        """Run one cycle, profiled if requested."""
+        if self._memory_cycles and self._snapshot is None:
+            self._start_tracing()
+        try:
+            if not self._profile_cycles:
+                return func(*args, **kwargs)
+            return self._profile(func, *args, **kwargs)
+        finally:
+            if self._memory_cycles:
+                self._trace_cycle()
+
+    def _profile(self, func, *args, **kwargs):
+        started = time.time()
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                self._profiled('pstats', profile.dump_stats, started)
+        sampler = StackSampler(threading.current_thread().ident,
+                               self.sample_interval)
+        sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self._profiled('folded', sampler.dump, started)
+
+    def _profiled(self, ext, dump, started):
+        """Write the profile of a cycle with dump(path), the cycle is
+        counted even if it can not be written.
+        """
+        try:
+            path = self._path('profile', ext)
+            dump(path)
+            LOG.info('Profiled cycle of %.2fs to %s', time.time() - started,
+                     path)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write profile to %s - %s',
+                        self.directory, e)
+        self._profile_cycles -= 1
+
+    def _start_tracing(self):
+        if tracemalloc is None:
+            LOG.warning('Memory tracing needs Python 3 tracemalloc')
+            self._memory_cycles = 0
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._snapshot = None
+
+    def _trace_cycle(self):
+        """Diff allocations against previous cycle."""
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        if self._snapshot is not None:
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+            try:
+                path = self._path('memory', 'txt')
+                with open(path, 'w') as f:
+                    for stat in stats[:self.top]:
+                        f.write('%s\n' % stat)
+                LOG.info('Wrote top %d allocation diffs to %s', self.top,
+                         path)
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to write allocation diffs to %s - %s',
+                            self.directory, e)
+        self._snapshot = snapshot
+        self._memory_cycles -= 1
+        if not self._memory_cycles:
+            tracemalloc.stop()
+            self._snapshot = None
@@ -0,0 +1,313 @@
+"""Delivery of trapper packets to several Zabbix servers/proxies.
+
+Policies:
+- broadcast: send each chunk to all targets, in parallel.
+- failover: send to the first healthy target (active/passive).
+- hash: shard by Zabbix host on a consistent hash ring, so a host
+  always goes to the same target while it is healthy.
+
+Each target keeps latency and error statistics. A target which fails
+is skipped, then probed again with real traffic after probe_interval
+seconds.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from libvirt_monitoring.py_zabbix_api import resilience
+
+
+LOG = logging.getLogger(__name__)
+
+# Weight of the last request in latency average.
+LATENCY_ALPHA = 0.2
+# Points of each target on the hash ring.
+RING_REPLICAS = 100
+_INFO_REGEX = re.compile(r'processed: (\d*); failed: (\d*); total: (\d*); '
+                         r'seconds spent: (\d*\.\d*)')
+
+
+class PartialDelivery(Exception):
+
+    """Some shards of a chunk were delivered, the others failed.
+
+    :param error: First failure.
+    :param undelivered: Messages of the failed shards.
+    :param response: Merged response of the delivered shards.
+    """
+
+    def __init__(self, error, undelivered, response):
+        Exception.__init__(self, error)
+        self.error = error
+        self.undelivered = undelivered
+        self.response = response
+
+
+class Target(object):
+
+    """A trapper server or proxy, with health and statistics."""
+
+    def __init__(self, address, bucket=None, breaker=None,
+                 probe_interval=30, name=None):
+        self.address = address
+        self.name = name or '%s:%s' % address
+        self.bucket = bucket
+        self.breaker = breaker
+        self.probe_interval = float(probe_interval)
+        self.healthy = True
+        self._retry_at = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        # Moving average and max, in seconds.
+        self.latency = None
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Check if target may be sent to now, a failed target is
+        probed again once probe_interval is over.
+        """
+        if not self.healthy and time.time() < self._retry_at:
+            return False
+        if self.breaker and not self.breaker.allow():
+            return False
+        return True
+
+    def send(self, send_packet, packet):
+        if self.bucket:
+            self.bucket.acquire()
+        started = time.time()
+        try:
+            response = send_packet(self.address, packet)
+        except Exception as e:
+            latency = time.time() - started
+            self._record(latency, e)
+            if self.breaker:
+                self.breaker.record(False)
+            raise
+        latency = time.time() - started
+        self._record(latency)
+        if self.breaker:
+            self.breaker.record(True, latency)
+        return response
+
+    def _record(self, latency, error=None):
+        with self._lock:
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_ALPHA * (latency - self.latency)
+            self.max_latency = max(self.max_latency, latency)
+            if error is not None:
+                self.errors += 1
+                self.last_error = str(error)
+                self._retry_at = time.time() + self.probe_interval
+                if self.healthy:
+                    LOG.warning('Target %s is unhealthy - %s', self.name,
+                                error)
+                self.healthy = False
+            elif not self.healthy:
+                LOG.info('Target %s is healthy again', self.name)
+                self.healthy = True
+
+    def stats(self):
+        with self._lock:
+            return {'target': self.name,
+                    'healthy': self.healthy,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'last_error': self.last_error,
+                    'latency': self.latency,
+                    'max_latency': self.max_latency}
+
+
+def merge_responses(responses):
+    """Merge trapper responses of several targets into one."""
+    responses = [r for r in responses if r]
+    if len(responses) < 2:
+        return responses[0] if responses else False
+    totals = [0, 0, 0, 0.0]
+    for response in responses:
+        match = _INFO_REGEX.search(response.get('info', ''))
+        if match is None:
+            continue
+        for i in range(3):
+            totals[i] += int(match.group(i + 1))
+        totals[3] += float(match.group(4))
+    return {'response': 'success',
+            'info': 'processed: %d; failed: %d; total: %d; '
+                    'seconds spent: %.6f' % tuple(totals)}
+
+
+class Broadcast(object):
+
+    name = 'broadcast'
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def deliver(self, messages, build_packet, send_packet):
+        targets = [t for t in self.targets if t.available()]
+        if not targets:
+            raise resilience.CircuitOpen('No trapper is available')
+        packet = build_packet(messages)
+        if len(targets) == 1:
+            return targets[0].send(send_packet, packet)
+
+        results = {}
+
+        def send(target):
+            try:
+                results[target] = (target.send(send_packet, packet), None)
+            except Exception as e:
+                results[target] = (None, e)
+
+        threads = [threading.Thread(target=send, args=(t,))
+                   for t in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        error = None
+        for target in targets:
+            response, e = results[target]
+            if e is None:
+                # All targets got the same data, one answer is enough.
+                return response
+            error = e
+        raise error
+
+
+class Failover(object):
+
+    """Targets in priority order, first one is active."""
+
+    name = 'failover'
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def deliver(self, messages, build_packet, send_packet):
+        packet = None
+        error = None
+        for target in self.targets:
+            if not target.available():
+                continue
+            if packet is None:
+                packet = build_packet(messages)
+            try:
+                return target.send(send_packet, packet)
+            except Exception as e:
+                LOG.warning('Failed to send to %s, fail over - %s',
+                            target.name, e)
+                error = e
+        if error is None:
+            raise resilience.CircuitOpen('No trapper is available')
+        raise error
+
+
+class HashShard(object):
+
+    """Consistent hash of Zabbix host over targets."""
+
+    name = 'hash'
+
+    def __init__(self, targets):
+        self.targets = targets
+        ring = []
+        for target in targets:
+            for i in range(RING_REPLICAS):
+                ring.append((self._hash('%s-%d' % (target.name, i)),
+                             target))
+        ring.sort(key=lambda point: point[0])
+        self._points = [point[0] for point in ring]
+        self._ring = [point[1] for point in ring]
+        # host -> targets in ring order from host hash
+        self._routes = {}
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    @staticmethod
+    def host_of(message):
+        """Zabbix host of a str(ZabbixMetric), whatever its key order
+        (json.dumps of a dict, which is not ordered on Python 2).
+        """
+        try:
+            return json.loads(message)['host']
+        except (ValueError, TypeError, KeyError):
+            return message
+
+    def route(self, host):
+        """Targets to try for host, owner first."""
+        route = self._routes.get(host)
+        if route is None:
+            start = bisect.bisect(self._points, self._hash(host))
+            route = []
+            for i in range(len(self._ring)):
+                target = self._ring[(start + i) % len(self._ring)]
+                if target not in route:
+                    route.append(target)
+                    if len(route) == len(self.targets):
+                        break
+            self._routes[host] = route
+        return route
+
+    def deliver(self, messages, build_packet, send_packet):
+        shards = {}
+        for message in messages:
+            route = self.route(self.host_of(message))
+            shards.setdefault(tuple(route), []).append(message)
+
+        responses = []
+        undelivered = []
+        failure = None
+        for route, shard in shards.items():
+            try:
+                responses.append(self._deliver_shard(
+                    route, shard, build_packet, send_packet))
+            except Exception as e:
+                # Other shards are still delivered.
+                failure = failure or e
+                undelivered.extend(shard)
+        if failure is not None:
+            if responses:
+                # Delivered shards must not be sent again.
+                raise PartialDelivery(failure, undelivered,
+                                      merge_responses(responses))
+            raise failure
+        return merge_responses(responses)
+
+    def _deliver_shard(self, route, shard, build_packet, send_packet):
+        packet = None
+        error = None
+        for target in route:
+            if not target.available():
+                continue
+            if packet is None:
+                packet = build_packet(shard)
+            try:
+                return target.send(send_packet, packet)
+            except Exception as e:
+                # Next target on the ring takes over.
+                LOG.warning('Failed to send shard to %s - %s',
+                            target.name, e)
+                error = e
+        if error is None:
+            raise resilience.CircuitOpen('No trapper is available')
+        raise error
+
+
+POLICIES = {
+    Broadcast.name: Broadcast,
+    Failover.name: Failover,
+    HashShard.name: HashShard,
+}
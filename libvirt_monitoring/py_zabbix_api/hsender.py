@@ -0,0 +1,80 @@
+"""ZabbixMetric delivery through the JSON-RPC history.push method.
+
+For network zones where the trapper port is blocked and only HTTP(S)
+to the Zabbix frontend is allowed. Items must be of type
+`Zabbix trapper` or `HTTP agent` with trapping enabled, like for
+ZabbixSender.
+"""
+import logging
+import time
+
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixSender
+
+
+LOG = logging.getLogger(__name__)
+
+
+class HistorySender(ZabbixSender):
+    """Send metrics with history.push (Zabbix >= 7.0), over the
+    keep-alive sessions of ZabbixAPI objects.
+
+    Chunking, delivery policies, shedding and response accounting are
+    the ones of ZabbixSender, a frontend is one delivery target.
+    :type apis: list
+    :param apis: :class:`ZabbixAPI` of each frontend.
+    :type chunk_size: int
+    :param chunk_size: Number of metrics of one history.push request.
+    :type compression: bool
+    :param compression: gzip request bodies, the web server must
+        decode them.
+    Other parameters are the ones of :class:`ZabbixSender`.
+    """
+
+    def __init__(self,
+                 apis,
+                 chunk_size=1000,
+                 rate_limit=None,
+                 breaker=None,
+                 shed_policy='drop',
+                 shed_buffer=10000,
+                 compression=False,
+                 delivery_policy='broadcast',
+                 probe_interval=30):
+
+        self.apis = dict((api.url, api) for api in apis)
+        self.chunk_size = chunk_size
+        self.timeout = apis[0].timeout if apis else None
+        self.compression = compression
+        self.zabbix_uri = [api.url for api in apis]
+        self._init_delivery(rate_limit, breaker, delivery_policy,
+                            probe_interval, shed_policy, shed_buffer)
+
+    @staticmethod
+    def _target_name(url):
+        return url
+
+    def _build_packet(self, messages):
+        """history.push params, str(ZabbixMetric) has its item fields."""
+        return '[' + ','.join(messages) + ']'
+
+    def _send_packet(self, url, packet):
+        LOG.debug('Pushing history to %s', url)
+        started = time.time()
+        result = self.apis[url].push_history(packet, self.compression)
+        spent = time.time() - started
+        LOG.debug('%s response: %s', url, result)
+        if result.get('response') != 'success':
+            raise Exception(result)
+
+        # One entry per item, with itemid or error.
+        data = result.get('data', [])
+        errors = [d['error'] for d in data if 'error' in d]
+        if errors:
+            LOG.error('### Failed when pushing %d of %d metrics: %s ###',
+                      len(errors), len(data), errors[:10])
+        # Trapper like response, for ZabbixResponse.
+        return {'response': 'success',
+                'info': 'processed: %d; failed: %d; total: %d; '
+                        'seconds spent: %.6f' % (
+                            len(data) - len(errors), len(errors),
+                            len(data), spent)}
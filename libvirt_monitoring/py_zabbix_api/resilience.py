@@ -0,0 +1,131 @@
+"""Client side protections of Zabbix API and trapper endpoints.
+
+- TokenBucket: limit request rate sent to one endpoint.
+- CircuitBreaker: stop calling an endpoint which keeps failing or
+  answering too slowly, probe it again later.
+"""
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class TokenBucket(object):
+
+    """Allow `rate` requests per second, with bursts of `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(self.rate, 1))
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, timeout=None):
+        """Take one token, wait for it at most timeout seconds
+        (forever if None). Return False if it timed out.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+
+    """
+    Open after `failures` consecutive failed calls, a call slower
+    than `latency` seconds counts as failed. Once open, calls are
+    rejected for `reset_timeout` seconds, then one probe call is let
+    through (half-open): it closes the circuit if it succeeds, opens
+    it again otherwise.
+    """
+
+    def __init__(self, name, failures=5, latency=None, reset_timeout=30):
+        self.name = name
+        self.failures = int(failures)
+        self.latency = float(latency) if latency else None
+        self.reset_timeout = float(reset_timeout)
+        self.state = STATE_CLOSED
+        self._consecutive = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check if a call may be done now, reserve the probe call
+        if circuit is half-open.
+        """
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return True
+            if self.state == STATE_OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = STATE_HALF_OPEN
+                LOG.info('Circuit %s half-open, probing', self.name)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, success, duration=None):
+        """Record the result of an allowed call."""
+        if success and self.latency and duration is not None and \
+                duration > self.latency:
+            LOG.warning('Circuit %s: call took %.2fs, over %ss SLO',
+                        self.name, duration, self.latency)
+            success = False
+        with self._lock:
+            self._probing = False
+            if success:
+                if self.state != STATE_CLOSED:
+                    LOG.info('Circuit %s closed', self.name)
+                self.state = STATE_CLOSED
+                self._consecutive = 0
+                return
+            self._consecutive += 1
+            if self.state == STATE_HALF_OPEN or \
+                    self._consecutive >= self.failures:
+                if self.state != STATE_OPEN:
+                    LOG.error('Circuit %s open after %d failures',
+                              self.name, self._consecutive)
+                self.state = STATE_OPEN
+                self._opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker, CircuitOpen if rejected."""
+        if not self.allow():
+            raise CircuitOpen('Circuit %s is %s' % (self.name, self.state))
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True, time.time() - started)
+        return result
@@ -1,167 +1,515 @@
-"""A copy with some litte changes of both
-Python Zabbix API libs (link bellow).
-
-- Py-zabbix: https://github.com/blacked/py-zabbix
-- Pyzabbix: https://github.com/lukecyca/pyzabbix
-
-"""
-import json
-import logging
-import requests
-
-
-try:
-    from logging import NullHandler
-except ImportError:
-    # Added in Python 2.7
-    class NullHandler(logging.Handler):
-        def handle(self, record):
-            pass
-
-        def emit(self, record):
-            pass
-
-        def createLock(self):
-            self.lock = None
-
-
-LOG = logging.getLogger(__name__)
-LOG.addHandler(NullHandler())
-
-
-class ZabbixAPIException(Exception):
-    pass
-
-
-class ZabbixAPIObjectClass(object):
-    """ZabbixAPI Object class"""
-
-    def __init__(self, name, parent):
-        self.name = name
-        self.parent = parent
-
-    def __getattr__(self, attr):
-        """Dynamically create a method (ie: get)"""
-        def fn(*args, **kwargs):
-            if args and kwargs:
-                raise TypeError('Found both args and kwargs')
-
-            method = '{0}.{1}'.format(self.name, attr)
-            LOG.debug('Call %s method', method)
-            return self.parent.do_request(
-                method,
-                args or kwargs
-            )['result']
-
-        return fn
-
-
-class ZabbixAPI(object):
-
-    def __init__(self, url='http://localhost/zabbix',
-                 user='Admin', password='zabbix',
-                 timeout=None, session=None):
-        if session:
-            self.session = session
-        else:
-            self.session = requests.Session()
-
-        # Default headers for all requests
-        self.session.headers.update({
-            'Content-Type': 'application/json-rpc',
-            'User-Agent': 'python/py_zabbix_api',
-            'Cache-Control': 'no-cache'
-        })
-
-        self.timeout = timeout
-
-        self.id = 0
-        self.url = url + '/api_jsonrpc.php'
-        self.auth = None
-        self._login(user, password)
-        LOG.debug('JSON-RPC Server Endpoint: %s', self.url)
-
-    def _login(self, user='', password=''):
-        """Do login to zabbix server.
-
-        :param user(str): Username used to login into Zabbix.
-        :param password(str): Password used to login into Zabbix.
-        """
-        LOG.debug('ZabbixAPI.login(%s, %s)', user, password)
-        self.auth = None
-
-        self.auth = self.user.login(user=user, password=password)
-
-    def __getattr__(self, attr):
-        """Dynamically create an object class (ie: host)"""
-        return ZabbixAPIObjectClass(attr, self)
-
-    def api_version(self):
-        return self.apiinfo.version()
-
-    def confimport(self, confformat='', source='', rules=''):
-        """Alias for configuration.import because it clashes with
-           Python's import reserved keyword
-        :param rules:
-        :param source:
-        :param confformat:
-        """
-
-        return self.do_request(
-            method="configuration.import",
-            params={"format": confformat, "source": source, "rules": rules}
-        )['result']
-
-    def do_request(self, method, params=None):
-        request_json = {
-            'jsonrpc': '2.0',
-            'method': method,
-            'params': params or {},
-            'id': self.id,
-        }
-
-        # apiinfo.version and user.login doesn't require auth token
-        if self.auth and method != 'apiinfo.version':
-            request_json['auth'] = self.auth
-
-        LOG.debug("Sending: %s", json.dumps(request_json,
-                                            indent=4,
-                                            separators=(',', ': ')))
-        response = self.session.post(
-            self.url,
-            data=json.dumps(request_json),
-            timeout=self.timeout
-        )
-        LOG.debug('Response Code: %s', str(response.status_code))
-
-        # NOTE: Getting a 412 response code means the headers are not in the
-        # list of allowed headers.
-        response.raise_for_status()
-
-        if not len(response.text):
-            raise ZabbixAPIException('Received empty response')
-
-        try:
-            response_json = json.loads(response.text)
-        except ValueError:
-            raise ZabbixAPIException(
-                'Unable to parse json: %s', response.text
-            )
-        LOG.debug('Response Body: %s', json.dumps(response_json,
-                                                  indent=4,
-                                                  separators=(',', ': ')))
-
-        self.id += 1
-
-        if 'error' in response_json:  # some exception
-            if 'data' not in response_json['error']:
-                # some errors don't contain 'data': workaround for ZBX-9340
-                response_json['error']['data'] = "No data"
-            msg = "Error {code}: {message}, {data}".format(
-                code=response_json['error']['code'],
-                message=response_json['error']['message'],
-                data=response_json['error']['data']
-            )
-            raise ZabbixAPIException(msg, response_json['error']['code'])
-
-        return response_json
+"""A copy with some litte changes of both
+Python Zabbix API libs (link bellow).
+
+- Py-zabbix: https://github.com/blacked/py-zabbix
+- Pyzabbix: https://github.com/lukecyca/pyzabbix
+
+"""
+import codecs
+import errno
+import json
+import logging
+import os
+import requests
+import zlib
+
+from libvirt_monitoring.py_zabbix_api import resilience
+from libvirt_monitoring.utils import LazyJSON
+
+
+try:
+    from logging import NullHandler
+except ImportError:
+    # Added in Python 2.7
+    class NullHandler(logging.Handler):
+        def handle(self, record):
+            pass
+
+        def emit(self, record):
+            pass
+
+        def createLock(self):
+            self.lock = None
+
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+
+# Fragments of the error data Zabbix returns when the auth token
+# is no longer valid (expired, logged out or removed server side).
+SESSION_EXPIRED_ERRORS = (
+    'session terminated',
+    're-login',
+    'not authorised',
+    'not authorized',
+)
+
+# (connect, read) timeouts of API requests, in seconds.
+DEFAULT_TIMEOUT = (5, 30)
+
+# Bytes read at once from streamed responses.
+STREAM_CHUNK_SIZE = 65536
+
+
+class ZabbixAPIException(Exception):
+    pass
+
+
+class ZabbixAPISessionExpired(ZabbixAPIException):
+    pass
+
+
+class ZabbixAPIObjectClass(object):
+    """ZabbixAPI Object class"""
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+
+    def __getattr__(self, attr):
+        """Dynamically create a method (ie: get)"""
+        def fn(*args, **kwargs):
+            if args and kwargs:
+                raise TypeError('Found both args and kwargs')
+
+            method = '{0}.{1}'.format(self.name, attr)
+            LOG.debug('Call %s method', method)
+            return self.parent.do_request(
+                method,
+                args or kwargs
+            )['result']
+
+        return fn
+
+
+class ZabbixAPI(object):
+
+    def __init__(self, url='http://localhost/zabbix',
+                 user='Admin', password='zabbix',
+                 timeout=None, session=None,
+                 api_token=None, token_cache=None,
+                 rate_limit=None, breaker=None, login=True):
+        if session:
+            self.session = session
+        else:
+            self.session = requests.Session()
+
+        # Default headers for all requests
+        self.session.headers.update({
+            'Content-Type': 'application/json-rpc',
+            'User-Agent': 'python/py_zabbix_api',
+            'Cache-Control': 'no-cache',
+            # Large get results compress well.
+            'Accept-Encoding': 'gzip, deflate',
+        })
+
+        self.timeout = timeout or DEFAULT_TIMEOUT
+
+        self.id = 0
+        self.url = url + '/api_jsonrpc.php'
+        # (rate, burst) of requests per second, None for no limit.
+        self.rate_limit = None
+        if rate_limit:
+            self.rate_limit = resilience.TokenBucket(*rate_limit)
+        # (failures, latency, reset_timeout) of circuit breaker,
+        # None to disable it.
+        self.breaker = None
+        if breaker:
+            self.breaker = resilience.CircuitBreaker(self.url, *breaker)
+        self.auth = None
+        # NOTE: self.user is reserved for the `user` API object class.
+        self._user = user
+        self._password = password
+        self._api_token = api_token
+        self._token_cache = token_cache
+        # (major, minor) of the frontend, asked on first login.
+        self._version = None
+        LOG.debug('JSON-RPC Server Endpoint: %s', self.url)
+
+        if self._api_token:
+            # API tokens are used as is, no login round trip.
+            self.auth = self._api_token
+        else:
+            self.auth = self._load_cached_token()
+            # Without login, the first push_history logs in, a frontend
+            # may be down at startup.
+            if not self.auth and login:
+                self._login(user, password)
+
+    def _login(self, user='', password=''):
+        """Do login to zabbix server.
+
+        :param user(str): Username used to login into Zabbix.
+        :param password(str): Password used to login into Zabbix.
+        """
+        LOG.debug('ZabbixAPI.login(%s, %s)', user, password)
+        self.auth = None
+
+        # `user` parameter was renamed in Zabbix 5.4, removed in 6.4.
+        if self._frontend_version() >= (5, 4):
+            self.auth = self.user.login(username=user, password=password)
+        else:
+            self.auth = self.user.login(user=user, password=password)
+        self._save_cached_token()
+
+    def _frontend_version(self):
+        """(major, minor) version of the frontend, asked once."""
+        if self._version is None:
+            self._version = tuple(
+                int(v) for v in self.api_version().split('.')[:2])
+        return self._version
+
+    def _load_cached_token(self):
+        """Load session token cached by a previous run.
+
+        The cached token is only reused if it was issued for the same
+        endpoint and user. It is not verified here, an expired token is
+        detected by do_request and replaced transparently.
+        """
+        if not self._token_cache:
+            return None
+        try:
+            with open(self._token_cache, 'r') as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            LOG.debug('Unable to load cached token %s: %s',
+                      self._token_cache, e)
+            return None
+
+        if (cached.get('url') != self.url or
+                cached.get('user') != self._user):
+            LOG.debug('Ignore cached token of %s@%s',
+                      cached.get('user'), cached.get('url'))
+            return None
+        LOG.debug('Use cached token from %s', self._token_cache)
+        return cached.get('auth')
+
+    def _save_cached_token(self):
+        """Write session token to cache file, readable by owner only."""
+        if not self._token_cache or not self.auth:
+            return
+        tmp_path = self._token_cache + '.tmp'
+        try:
+            cache_dir = os.path.dirname(self._token_cache)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            try:
+                os.remove(tmp_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'url': self.url,
+                           'user': self._user,
+                           'auth': self.auth}, f)
+            os.rename(tmp_path, self._token_cache)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to cache token in %s: %s',
+                        self._token_cache, e)
+
+    def _relogin(self):
+        """Replace an expired session token with a new one."""
+        LOG.info('Session token expired, login again as %s', self._user)
+        self._login(self._user, self._password)
+
+    def __getattr__(self, attr):
+        """Dynamically create an object class (ie: host)"""
+        return ZabbixAPIObjectClass(attr, self)
+
+    def api_version(self):
+        return self.apiinfo.version()
+
+    def confimport(self, confformat='', source='', rules=''):
+        """Alias for configuration.import because it clashes with
+           Python's import reserved keyword
+        :param rules:
+        :param source:
+        :param confformat:
+        """
+
+        return self.do_request(
+            method="configuration.import",
+            params={"format": confformat, "source": source, "rules": rules}
+        )['result']
+
+    def do_request(self, method, params=None):
+        """Do request, login again once if the session token expired.
+
+        API tokens can not be renewed, their errors are raised as is.
+        """
+        try:
+            return self._do_request(method, params)
+        except ZabbixAPISessionExpired:
+            if self._api_token or method == 'user.login':
+                raise
+            self._relogin()
+            return self._do_request(method, params)
+
+    def iter_request(self, method, params=None):
+        """Same as do_request, but yield objects of the result list one
+        by one, parsed from the response stream: the whole response is
+        never held in memory.
+        """
+        try:
+            for obj in self._iter_request(method, params):
+                yield obj
+        except ZabbixAPISessionExpired:
+            # Errors come instead of result, nothing was yielded yet.
+            if self._api_token or method == 'user.login':
+                raise
+            self._relogin()
+            for obj in self._iter_request(method, params):
+                yield obj
+
+    def get_paged(self, obj, params=None, page_size=1000, pk=None):
+        """Yield objects of <obj>.get in ID ordered pages.
+
+        IDs are fetched first (streamed), then objects are asked by
+        chunks of page_size IDs. The sorted ID list is held by the
+        agent and the frontend still selects all IDs once, but full
+        objects are only built page_size at a time on both sides.
+        :param obj: API object, e.x: item
+        :param pk: ID property, <obj>id by default
+        """
+        pk = pk or obj + 'id'
+        method = obj + '.get'
+        id_params = dict((k, v) for k, v in (params or {}).items()
+                         if not k.startswith('select'))
+        id_params['output'] = [pk]
+        ids = sorted(int(o[pk]) for o in self.iter_request(method,
+                                                           id_params))
+        for i in range(0, len(ids), page_size):
+            page_params = dict(params or {})
+            page_params[pk + 's'] = [str(x) for x in ids[i:i + page_size]]
+            page_params['sortfield'] = pk
+            for o in self.iter_request(method, page_params):
+                yield o
+
+    def push_history(self, items, compress=False):
+        """Push item values with history.push (Zabbix >= 7.0).
+
+        :param items: Already encoded JSON array of {host, key, value,
+            clock} objects, the fields of str(ZabbixMetric).
+        :param compress: gzip the request body, the web server must
+            decode it (e.x: Apache mod_deflate input filter).
+        :return: history.push result, {'response', 'data'}
+        """
+        try:
+            return self._push_history(items, compress)
+        except ZabbixAPISessionExpired:
+            if self._api_token:
+                raise
+            self._relogin()
+            return self._push_history(items, compress)
+
+    def _push_history(self, items, compress=False):
+        if not self.auth:
+            self._login(self._user, self._password)
+        # Values are not decoded again, the body is built around them.
+        body = ('{"jsonrpc": "2.0", "method": "history.push", '
+                '"params": %s, "id": %d}' % (items, self.id)).encode('utf-8')
+        # Token in header, the auth property is dropped by Zabbix 7.2.
+        headers = {'Authorization': 'Bearer %s' % self.auth}
+        if compress:
+            encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = encoder.compress(body) + encoder.flush()
+            headers['Content-Encoding'] = 'gzip'
+        response = self.session.post(self.url, data=body, headers=headers,
+                                     timeout=self.timeout)
+        LOG.debug('Response Code: %s', response.status_code)
+        response.raise_for_status()
+        try:
+            response_json = json.loads(response.content.decode('utf-8'))
+        except ValueError:
+            raise ZabbixAPIException(
+                'Unable to parse json: %s', response.content
+            )
+        self.id += 1
+        if 'error' in response_json:
+            self._raise_error(response_json['error'])
+        return response_json['result']
+
+    def _request_json(self, method, params):
+        request_json = {
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params or {},
+            'id': self.id,
+        }
+
+        # apiinfo.version and user.login doesn't require auth token
+        if self.auth and method != 'apiinfo.version':
+            request_json['auth'] = self.auth
+
+        LOG.debug("Sending: %s", LazyJSON(request_json,
+                                          indent=4,
+                                          separators=(',', ': ')))
+        return request_json
+
+    def _send(self, request_json, stream=False):
+        if self.rate_limit:
+            self.rate_limit.acquire()
+        if self.breaker:
+            # Fails fast with CircuitOpen while endpoint is unhealthy.
+            return self.breaker.call(self._post, request_json, stream)
+        return self._post(request_json, stream)
+
+    def _do_request(self, method, params=None):
+        response = self._send(self._request_json(method, params))
+
+        if not len(response.content):
+            raise ZabbixAPIException('Received empty response')
+
+        try:
+            response_json = json.loads(response.content.decode('utf-8'))
+        except ValueError:
+            raise ZabbixAPIException(
+                'Unable to parse json: %s', response.content
+            )
+        LOG.debug('Response Body: %s', LazyJSON(response_json,
+                                                indent=4,
+                                                separators=(',', ': ')))
+
+        self.id += 1
+
+        if 'error' in response_json:  # some exception
+            self._raise_error(response_json['error'])
+
+        return response_json
+
+    def _iter_request(self, method, params=None):
+        response = self._send(self._request_json(method, params),
+                              stream=True)
+        try:
+            # Content is decompressed by urllib3.
+            chunks = response.raw.stream(STREAM_CHUNK_SIZE,
+                                         decode_content=True)
+            self.id += 1
+            for key, value in _iter_response(chunks):
+                if key == 'error':
+                    self._raise_error(value)
+                yield value
+        finally:
+            response.close()
+
+    def _raise_error(self, error):
+        if 'data' not in error:
+            # some errors don't contain 'data': workaround for ZBX-9340
+            error['data'] = "No data"
+        msg = "Error {code}: {message}, {data}".format(
+            code=error['code'],
+            message=error['message'],
+            data=error['data']
+        )
+        if any(e in msg.lower() for e in SESSION_EXPIRED_ERRORS):
+            raise ZabbixAPISessionExpired(msg, error['code'])
+        raise ZabbixAPIException(msg, error['code'])
+
+    def _post(self, request_json, stream=False):
+        response = self.session.post(
+            self.url,
+            data=json.dumps(request_json),
+            timeout=self.timeout,
+            stream=stream
+        )
+        LOG.debug('Response Code: %s', response.status_code)
+
+        # NOTE: Getting a 412 response code means the headers are not in the
+        # list of allowed headers.
+        response.raise_for_status()
+        return response
+
+
+class _StreamBuffer(object):
+
+    """Text decoded from a byte chunks iterator, read on demand."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read one more chunk, False at end of stream."""
+        if self.eof:
+            return False
+        # Drop text already parsed.
+        self.text = self.text[self.pos:]
+        self.pos = 0
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.text += self.decoder.decode(b'', True)
+            return False
+        self.text += self.decoder.decode(chunk)
+        return True
+
+    def skip_space(self):
+        """Return next non blank character, without consuming it."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ZabbixAPIException('Unexpected end of response')
+
+    def expect(self, chars):
+        char = self.skip_space()
+        if char not in chars:
+            raise ZabbixAPIException(
+                'Unable to parse json: unexpected %r' % char)
+        self.pos += 1
+        return char
+
+    def decode(self, decoder=json.JSONDecoder()):
+        """Decode next JSON value, reading as much as needed."""
+        self.skip_space()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+                # A number may continue in next chunk.
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise ZabbixAPIException(
+                        'Unable to parse json: %s' % self.text[:200])
+            self.fill()
+
+
+def _iter_response(chunks):
+    """Parse a JSON-RPC response from chunks of bytes.
+
+    Yield ('result', obj) for each object of a result list,
+    ('result', value) for other results and ('error', error).
+    """
+    buf = _StreamBuffer(chunks)
+    buf.expect('{')
+    if buf.skip_space() == '}':
+        return
+    while True:
+        key = buf.decode()
+        buf.expect(':')
+        if key == 'result' and buf.skip_space() == '[':
+            buf.pos += 1
+            if buf.skip_space() == ']':
+                buf.pos += 1
+            else:
+                while True:
+                    yield key, buf.decode()
+                    if buf.expect(',]') == ']':
+                        break
+        elif key in ('result', 'error'):
+            yield key, buf.decode()
+        else:
+            buf.decode()
+        if buf.expect(',}') == '}':
+            return
@@ -2,12 +2,18 @@
 
 https://github.com/blacked/py-zabbix/blob/master/pyzabbix/sender.py
 """
+import collections
 from decimal import Decimal
 import json
 import logging
 import re
 import socket
 import struct
+import zlib
+
+from libvirt_monitoring.py_zabbix_api import delivery
+from libvirt_monitoring.py_zabbix_api import resilience
+from libvirt_monitoring.utils import LazyCall
 
 # For python 2 and 3 compatibility
 try:
@@ -36,6 +42,13 @@ except ImportError:
 LOG = logging.getLogger(__name__)
 LOG.addHandler(NullHandler())
 
+# (connect, read) timeouts of trapper connections, in seconds.
+DEFAULT_TIMEOUT = (5, 30)
+
+# Protocol header flags.
+ZBX_FLAG_PROTOCOL = 0x01
+ZBX_FLAG_COMPRESSED = 0x02
+
 
 class ZabbixResponse(object):
     """The :class:`ZabbixResponse` contains the parsed response from Zabbix.
@@ -117,12 +130,11 @@ class ZabbixMetric(object):
                 raise Exception('Clock must be time in unixtime format')
 
     def __repr__(self):
-        """Represent detailed ZabbixMetric view."""
+        """Represent detailed ZabbixMetric view.
 
-        result = json.dumps(self.__dict__)
-        LOG.debug('%s: %s', self.__class__.__name__, result)
-
-        return result
+        This is the wire encoding of the metric, keep it free of logging.
+        """
+        return json.dumps(self.__dict__)
 
 
 class ZabbixSender(object):
@@ -139,6 +151,26 @@ class ZabbixSender(object):
          /etc/zabbix/zabbix_agentd.conf
     :type chunk_size: int
     :param chunk_size: Number of metrics send to the server at one time
+    :type timeout: tuple
+    :param timeout: (connect, read) timeouts in seconds.
+    :type rate_limit: tuple
+    :param rate_limit: (rate, burst) of packets per second and server.
+    :type breaker: tuple
+    :param breaker: (failures, latency, reset_timeout) of each server
+        circuit breaker.
+    :type delivery_policy: str
+    :param delivery_policy: How chunks are delivered to several servers:
+        `broadcast` to all of them in parallel, `failover` to the first
+        healthy one, `hash` sharded by host.
+    :type probe_interval: float
+    :param probe_interval: Seconds before a failed server is tried again.
+    :type compression: bool
+    :param compression: zlib compress packets (Zabbix >= 4.0).
+    :type shed_policy: str
+    :param shed_policy: What to do with messages while all circuits are
+        open: `drop` them or `buffer` up to shed_buffer messages, sent
+        first once a server is back. Messages of a failed send are
+        buffered too, before the error is raised.
     >>> from pyzabbix import ZabbixMetric, ZabbixSender
     >>> metrics = []
     >>> m = ZabbixMetric('localhost', 'cpu[usage]', 20)
@@ -151,22 +183,61 @@ class ZabbixSender(object):
                  zabbix_server='127.0.0.1',
                  zabbix_port=10051,
                  use_config=None,
-                 chunk_size=250):
+                 chunk_size=250,
+                 timeout=DEFAULT_TIMEOUT,
+                 rate_limit=None,
+                 breaker=None,
+                 shed_policy='drop',
+                 shed_buffer=10000,
+                 compression=False,
+                 delivery_policy='broadcast',
+                 probe_interval=30):
 
         self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.compression = compression
 
         if use_config:
             self.zabbix_uri = self._load_from_config(use_config)
         else:
             self.zabbix_uri = [(zabbix_server, zabbix_port)]
 
-    def __repr__(self):
-        """Represent detailed ZabbixSender view."""
+        self._init_delivery(rate_limit, breaker, delivery_policy,
+                            probe_interval, shed_policy, shed_buffer)
 
-        result = json.dumps(self.__dict__, ensure_ascii=False)
-        LOG.debug('%s: %s', self.__class__.__name__, result)
+    def _init_delivery(self, rate_limit, breaker, delivery_policy,
+                       probe_interval, shed_policy, shed_buffer):
+        """Targets of self.zabbix_uri, delivery policy and shedding."""
+        # Per server token buckets, circuit breakers and statistics.
+        self.targets = []
+        for host_addr in self.zabbix_uri:
+            name = self._target_name(host_addr)
+            self.targets.append(delivery.Target(
+                host_addr,
+                bucket=resilience.TokenBucket(*rate_limit)
+                if rate_limit else None,
+                breaker=resilience.CircuitBreaker(name, *breaker)
+                if breaker else None,
+                probe_interval=probe_interval,
+                name=name))
+        self.delivery = delivery.POLICIES[delivery_policy](self.targets)
+        self.shed_policy = shed_policy
+        self._backlog = collections.deque(maxlen=int(shed_buffer))
+        self.shed = 0
+
+    @staticmethod
+    def _target_name(host_addr):
+        return '%s:%s' % host_addr
 
-        return result
+    def __repr__(self):
+        """Represent detailed ZabbixSender view."""
+        return json.dumps({'zabbix_uri': self.zabbix_uri,
+                           'chunk_size': self.chunk_size,
+                           'timeout': self.timeout,
+                           'compression': self.compression,
+                           'delivery': self.delivery.name,
+                           'shed_policy': self.shed_policy},
+                          ensure_ascii=False)
 
     def _load_from_config(self, config_file):
         """Load zabbix server ip address and port from zabbix agent file.
@@ -262,8 +333,24 @@ class ZabbixSender(object):
         :return: Data packet for zabbix
         """
 
-        data_len = struct.pack('<Q', len(request))
-        packet = b'ZBXD\x01' + data_len + request
+        if self.compression:
+            data = zlib.compress(request)
+            # Data length, then uncompressed length.
+            header = struct.pack('<BII',
+                                 ZBX_FLAG_PROTOCOL | ZBX_FLAG_COMPRESSED,
+                                 len(data), len(request))
+            packet = b'ZBXD' + header + data
+        else:
+            data_len = struct.pack('<Q', len(request))
+            packet = b'ZBXD\x01' + data_len + request
+
+        LOG.debug('Packet [str]: %s', packet)
+        LOG.debug('Packet [hex]: %s', LazyCall(self._hex_packet, packet))
+        return packet
+
+    @staticmethod
+    def _hex_packet(packet):
+        """Hex dump of a packet, only built for debug records."""
 
         def ord23(x):
             if not isinstance(x, int):
@@ -271,10 +358,7 @@ class ZabbixSender(object):
             else:
                 return x
 
-        LOG.debug('Packet [str]: %s', packet)
-        LOG.debug('Packet [hex]: %s',
-                  ':'.join(hex(ord23(x))[2:] for x in packet))
-        return packet
+        return ':'.join(hex(ord23(x))[2:] for x in packet)
 
     def _get_response(self, connection):
         """Get response from zabbix server, reads from self.socket.
@@ -287,13 +371,16 @@ class ZabbixSender(object):
         response_header = self._receive(connection, 13)
         LOG.debug('Response header: %s', response_header)
 
-        if (not response_header.startswith(b'ZBXD\x01') or
+        if (not response_header.startswith(b'ZBXD') or
                 len(response_header) != 13):
             LOG.debug('Zabbix return not valid response.')
             result = False
         else:
-            response_len = struct.unpack('<Q', response_header[5:])[0]
-            response_body = connection.recv(response_len)
+            flags, response_len, _ = struct.unpack('<BII',
+                                                   response_header[4:])
+            response_body = self._receive(connection, response_len)
+            if flags & ZBX_FLAG_COMPRESSED:
+                response_body = zlib.decompress(response_body)
             result = json.loads(response_body.decode('utf-8'))
             LOG.debug('Data received: %s', result)
 
@@ -332,33 +419,46 @@ class ZabbixSender(object):
         :rtype: str
         :return: Response from Zabbix Server
         """
-        messages = self._create_messages(metrics)
-        request = self._create_request(messages)
-        packet = self._create_packet(request)
+        return self._chunk_send_messages(self._create_messages(metrics))
 
-        for host_addr in self.zabbix_uri:
-            LOG.debug('Sending data to %s', host_addr)
+    def _chunk_send_messages(self, messages):
+        """Send the one chunk of already encoded messages to zabbix server.
+        :type messages: list
+        :param messages: List of zabbix messages
+        :rtype: str
+        :return: Response from Zabbix Server
+        """
+        return self.delivery.deliver(messages, self._build_packet,
+                                     self._send_packet)
 
-            # create socket object
-            connection = socket.socket()
+    def _build_packet(self, messages):
+        return self._create_packet(self._create_request(messages))
 
-            # server and port must be tuple
-            connection.connect(host_addr)
+    def target_stats(self):
+        """Latency and error statistics of each server."""
+        return [t.stats() for t in self.targets]
 
-            try:
-                connection.sendall(packet)
-            except Exception as err:
-                # In case of error we should close connection, otherwise
-                # we will close it afret data will be received.
-                connection.close()
-                raise Exception(err)
+    def _send_packet(self, host_addr, packet):
+        LOG.debug('Sending data to %s', host_addr)
 
-            response = self._get_response(connection)
-            LOG.debug('%s response: %s', host_addr, response)
+        # create socket object, server and port must be tuple
+        connection = socket.create_connection(host_addr, self.timeout[0])
+        connection.settimeout(self.timeout[1])
 
-            if response and response.get('response') != 'success':
-                LOG.debug('Response error: %s}', response)
-                raise Exception(response)
+        try:
+            connection.sendall(packet)
+        except Exception as err:
+            # In case of error we should close connection, otherwise
+            # we will close it afret data will be received.
+            connection.close()
+            raise Exception(err)
+
+        response = self._get_response(connection)
+        LOG.debug('%s response: %s', host_addr, response)
+
+        if response and response.get('response') != 'success':
+            LOG.debug('Response error: %s}', response)
+            raise Exception(response)
 
         return response
 
@@ -374,3 +474,50 @@ class ZabbixSender(object):
         for m in range(0, len(metrics), self.chunk_size):
             result.parse(self._chunk_send(metrics[m:m + self.chunk_size]))
         return result
+
+    def send_messages(self, messages):
+        """Send already encoded metrics to zabbix server.
+
+        Messages are `str(ZabbixMetric)`, this lets callers encode a
+        batch once and share it with other outputs.
+        :type messages: list
+        :param messages: List of zabbix messages
+        :rtype: :class:`pyzabbix.sender.ZabbixResponse`
+        :return: Parsed response from Zabbix Server
+        """
+        result = ZabbixResponse()
+        if self._backlog:
+            # Shed while all circuits were open, oldest first.
+            messages = list(self._backlog) + list(messages)
+            self._backlog.clear()
+        for m in range(0, len(messages), self.chunk_size):
+            chunk = messages[m:m + self.chunk_size]
+            try:
+                result.parse(self._chunk_send_messages(chunk))
+            except Exception as e:
+                error = e
+                if isinstance(e, delivery.PartialDelivery):
+                    # Only the failed shards are left to send.
+                    result.parse(e.response)
+                    chunk, error = e.undelivered, e.error
+                unsent = list(chunk) + list(messages[m + self.chunk_size:])
+                if isinstance(error, resilience.CircuitOpen):
+                    self._shed(unsent, error)
+                    break
+                if self.shed_policy == 'buffer':
+                    # Sent again first with the next batch.
+                    self._shed(unsent, error)
+                raise error
+        return result
+
+    def _shed(self, messages, reason):
+        """Buffer or drop messages which can not be sent now."""
+        if self.shed_policy == 'buffer':
+            # Oldest messages are dropped once the buffer is full.
+            self._backlog.extend(messages)
+            LOG.warning('%s, buffered %d messages (%d in buffer)',
+                        reason, len(messages), len(self._backlog))
+        else:
+            self.shed += len(messages)
+            LOG.warning('%s, dropped %d messages (%d so far)',
+                        reason, len(messages), self.shed)
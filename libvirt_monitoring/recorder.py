@@ -0,0 +1,151 @@
+"""Recording of libvirt and Zabbix interactions, see replay.
+
+Every libvirt domain call, Zabbix API request and trapper send of a
+running agent is written with its arguments, result and latency to a
+gzip JSON lines trace. Results equal to the previous one of the same
+call (e.x: domain XML) are stored as a reference only.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+def call_key(uuid, method, args):
+    return json.dumps([uuid, method, args])
+
+
+class Recorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._started = time.time()
+        # uri -> current cycle
+        self._cycles = {}
+        # call key -> digest of last result
+        self._last = {}
+
+    def write(self, event, started, result=None, error=None):
+        event['t'] = round(started - self._started, 6)
+        event['latency'] = round(time.time() - started, 6)
+        if error is not None:
+            event['error'] = error
+        else:
+            encoded = json.dumps(result, sort_keys=True)
+            digest = hashlib.md5(encoded.encode('utf-8')).hexdigest()
+            key = call_key(event.get('uuid'), event['call'], event.get('args'))
+            with self._lock:
+                same = self._last.get(key) == digest
+                self._last[key] = digest
+            if same:
+                event['same'] = True
+            else:
+                event['result'] = result
+        line = (json.dumps(event) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                LOG.info('Trace written to %s', self.path)
+
+    def attach(self, libvirt_agent):
+        """Record calls of agent's inspector(s) and Zabbix clients."""
+        if libvirt_agent.poller:
+            inspectors = [h.inspector for h in libvirt_agent.poller.hosts]
+        else:
+            inspectors = [libvirt_agent.inspector]
+        for i in inspectors:
+            self._attach_manager(i.connection_manager)
+        zsender_ = getattr(libvirt_agent, 'zsender', None)
+        if zsender_ is not None:
+            zsender_.send_messages = self._recorded(
+                'zsender.send_messages', zsender_.send_messages,
+                lambda messages: [len(messages)], _response_dict)
+        zapi = getattr(libvirt_agent, 'zapi', None)
+        if zapi is not None:
+            zapi.do_request = self._recorded(
+                'zapi.do_request', zapi.do_request,
+                lambda method, params=None: [method, params])
+
+    def _recorded(self, call, func, args_of, result_of=None):
+        recorder = self
+
+        def recorded(*args, **kwargs):
+            event = {'call': call, 'args': args_of(*args, **kwargs)}
+            started = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                recorder.write(event, started, error=[None, None, str(e)])
+                raise
+            recorder.write(event, started, result_of(result)
+                           if result_of else result)
+            return result
+        return recorded
+
+    def _attach_manager(self, manager):
+        recorder = self
+        domains = manager.domains
+        uri = manager.uri
+
+        def recorded_domains():
+            cycle = recorder._cycles.get(uri, -1) + 1
+            recorder._cycles[uri] = cycle
+            started = time.time()
+            handles = domains()
+            recorder.write({'call': 'listAllDomains', 'uri': uri,
+                            'cycle': cycle}, started,
+                           [h.UUIDString() for h in handles])
+            return [RecordingDomain(h, recorder, uri, cycle)
+                    for h in handles]
+        manager.domains = recorded_domains
+
+
+class RecordingDomain(object):
+
+    """Domain handle which records its calls."""
+
+    def __init__(self, domain, recorder, uri, cycle):
+        self._domain = domain
+        self._recorder = recorder
+        self._event = {'uri': uri, 'cycle': cycle,
+                       'uuid': domain.UUIDString()}
+
+    def __getattr__(self, attr):
+        func = getattr(self._domain, attr)
+        recorder = self._recorder
+        base_event = self._event
+
+        def recorded(*args):
+            event = dict(base_event, call=attr, args=list(args))
+            started = time.time()
+            try:
+                result = func(*args)
+            except Exception as e:
+                error = [None, None, str(e)]
+                if hasattr(e, 'get_error_code'):
+                    error = [e.get_error_code(), e.get_error_domain(),
+                             str(e)]
+                recorder.write(event, started, error=error)
+                raise
+            recorder.write(event, started, result)
+            return result
+        return recorded
+
+
+def _response_dict(response):
+    return {'processed': response.processed, 'failed': response.failed,
+            'total': response.total, 'time': str(response.time),
+            'chunk': response.chunk}
@@ -0,0 +1,257 @@
+"""Replay of traces written by recorder ([replay] record = <path>).
+
+An agent is fed from the trace instead of libvirt/Zabbix, at original
+timing or as fast as possible, to benchmark or profile a recorded
+workload anywhere:
+    libvirt_monitoring replay <trace> [fast]
+"""
+import collections
+import gzip
+import json
+import logging
+import time
+
+from libvirt_monitoring import agent
+from libvirt_monitoring import inspector
+from libvirt_monitoring import poller
+from libvirt_monitoring import recorder
+from libvirt_monitoring import utils
+from libvirt_monitoring.py_zabbix_api import zsender
+
+libvirt = None
+
+LOG = logging.getLogger(__name__)
+
+
+class Trace(object):
+
+    """Events of a trace file, indexed for replay."""
+
+    def __init__(self, path):
+        self.uris = []
+        # uri -> [{'t': start, 'domains': [uuid], 'calls': {key: deque}}]
+        self.cycles = {}
+        # call -> deque of events
+        self.zabbix = collections.defaultdict(collections.deque)
+        last = {}
+        with gzip.open(path, 'rb') as f:
+            try:
+                for line in f:
+                    self._add(json.loads(line.decode('utf-8')), last)
+            except (EOFError, IOError, ValueError) as e:
+                # Agent killed while recording.
+                LOG.warning('Trace %s is truncated: %s', path, e)
+
+    def _add(self, event, last):
+        key = recorder.call_key(event.get('uuid'), event['call'],
+                                event.get('args'))
+        if event.get('same'):
+            event['result'] = last.get(key)
+        elif 'error' not in event:
+            last[key] = event.get('result')
+        if 'uri' not in event:
+            self.zabbix[event['call']].append(event)
+            return
+        uri = event['uri']
+        if uri not in self.cycles:
+            self.uris.append(uri)
+            self.cycles[uri] = []
+        cycles = self.cycles[uri]
+        if event['call'] == 'listAllDomains':
+            cycles.append({'t': event['t'], 'event': event,
+                           'calls': collections.defaultdict(
+                               collections.deque)})
+        elif cycles:
+            cycles[-1]['calls'][key].append(event)
+
+
+class Player(object):
+
+    def __init__(self, fast=False):
+        self.fast = fast
+
+    def play(self, event):
+        """Wait for the call latency, return result or raise error."""
+        if not self.fast:
+            time.sleep(event.get('latency', 0))
+        if 'error' in event:
+            code, domain, message = event['error']
+            if code is None:
+                raise Exception(message)
+            global libvirt
+            if libvirt is None:
+                libvirt = __import__('libvirt')
+            error = libvirt.libvirtError(message)
+            error.err = (code, domain, message, 0, None, None, None, 0, 0)
+            raise error
+        return event.get('result')
+
+
+class ReplayDomain(object):
+
+    def __init__(self, uuid, cycle, player):
+        self._uuid = uuid
+        self._cycle = cycle
+        self._player = player
+
+    def UUIDString(self):
+        return self._uuid
+
+    def __getattr__(self, attr):
+        def replayed(*args):
+            calls = self._cycle['calls'].get(
+                recorder.call_key(self._uuid, attr, list(args)))
+            if not calls:
+                return self._player.play({'error': [
+                    -1, -1, 'Call %s%r of %s not in trace' % (
+                        attr, args, self._uuid)]})
+            return self._player.play(calls.popleft())
+        return replayed
+
+
+class ReplayConnectionManager(object):
+
+    """Quacks like connection.ConnectionManager, serves one uri of
+    a trace, one recorded cycle per domains() call.
+    """
+
+    healthy = True
+    state = 'up'
+
+    def __init__(self, trace, uri, player):
+        self.uri = uri
+        self._cycles = collections.deque(trace.cycles[uri])
+        self._player = player
+
+    def domains(self):
+        if not self._cycles:
+            return []
+        cycle = self._cycles.popleft()
+        uuids = self._player.play(cycle['event'])
+        return [ReplayDomain(uuid, cycle, self._player) for uuid in uuids]
+
+    def mark_down(self):
+        pass
+
+
+class ReplaySender(object):
+
+    def __init__(self, trace, player):
+        self._events = trace.zabbix['zsender.send_messages']
+        self._player = player
+
+    def send_messages(self, messages):
+        result = zsender.ZabbixResponse()
+        if not self._events:
+            return result
+        recorded = self._player.play(self._events.popleft())
+        result._processed = recorded['processed']
+        result._failed = recorded['failed']
+        result._total = recorded['total']
+        result._chunk = recorded['chunk']
+        return result
+
+    def target_stats(self):
+        return []
+
+
+class ReplayAPI(object):
+
+    def __init__(self, trace, player):
+        self._events = trace.zabbix['zapi.do_request']
+        self._player = player
+
+    def do_request(self, method, params=None):
+        for event in self._events:
+            if event['args'][0] == method:
+                self._events.remove(event)
+                return self._player.play(event)
+        return {'jsonrpc': '2.0', 'result': [], 'id': 0}
+
+
+class SyncFanOut(object):
+
+    """Write each batch to the sinks from the caller's thread: cycle
+    durations include the send, and no batch is dropped nor pending
+    when the replay ends.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def start(self):
+        pass
+
+    def publish(self, batch):
+        for sink in self.sinks:
+            try:
+                sink.write(batch)
+            except Exception as e:
+                LOG.error('Sink %s failed to write batch - %s',
+                          sink.name, e)
+
+
+class ReplayAgent(agent.LibvirtAgent):
+
+    """Agent fed by a trace, only the Zabbix output is enabled and
+    it does not touch local checkpoint, cgroups nor network.
+    """
+
+    def __init__(self, trace, fast=False):
+        self.trace = trace
+        self.player = Player(fast)
+        config = dict(utils.ini_file_loader())
+        config.update({'default-outputs': 'zabbix',
+                       'checkpoint-enabled': 'False',
+                       'poller-enabled': 'False',
+                       'sampling-enabled': 'False',
+                       'replay-record': ''})
+        super(ReplayAgent, self).__init__(config)
+        self.fanout = SyncFanOut(self.sinks)
+        if len(trace.uris) > 1:
+            self.poller = poller.RemotePoller(trace.uris)
+            self.inspector = self.poller
+            inspectors = [h.inspector for h in self.poller.hosts]
+        else:
+            self.inspector = inspector.LibvirtInspector(
+                uri=trace.uris[0] if trace.uris else 'test:///default')
+            inspectors = [self.inspector]
+        for i in inspectors:
+            i.connection_manager = ReplayConnectionManager(
+                trace, i.uri, self.player)
+
+    def _init_zabbix(self):
+        self.zsender = ReplaySender(self.trace, self.player)
+        self.zapi = None
+        if self.provisioning != 'lld':
+            self.zapi = ReplayAPI(self.trace, self.player)
+
+    def replay(self):
+        """Run all recorded cycles, return their durations, send
+        included.
+        """
+        cycles = max([len(c) for c in self.trace.cycles.values()] or [0])
+        starts = [c['t'] for c in self.trace.cycles.get(
+            self.trace.uris[0], [])] if self.trace.uris else []
+        durations = []
+        begin = time.time()
+        for n in range(cycles):
+            if not self.player.fast and n < len(starts):
+                # Original pacing of cycles.
+                time.sleep(max(starts[n] - starts[0] -
+                               (time.time() - begin), 0))
+            started = time.time()
+            self.get_and_send_metrics()
+            durations.append(time.time() - started)
+            LOG.info('Replayed cycle %d in %.3fs', n, durations[-1])
+        return durations
+
+
+def replay(path, fast=False):
+    trace = Trace(path)
+    durations = ReplayAgent(trace, fast).replay()
+    for n, duration in enumerate(durations):
+        print('cycle %d: %.3fs' % (n, duration))
+    if durations:
+        print('total: %.3fs, max: %.3fs' % (
+            sum(durations), max(durations)))
@@ -0,0 +1,200 @@
+"""High-frequency sampling with in-agent aggregation.
+
+Metrics are sampled several times per reporting interval, only
+min/mean/max and an approximate p95 of each series are reported.
+"""
+import collections
+import logging
+import math
+import numbers
+
+
+LOG = logging.getLogger(__name__)
+
+AGGREGATES = ('min', 'max', 'p95')
+
+
+class P2Quantile(object):
+
+    """
+    Streaming quantile estimator, P-square algorithm
+    (Jain & Chlamtac, 1985): five markers, O(1) memory and time.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.n = 0
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+    def add(self, x):
+        q = self.heights
+        if self.n < 5:
+            q.append(float(x))
+            self.n += 1
+            if self.n == 5:
+                q.sort()
+            return
+        self.n += 1
+
+        if x < q[0]:
+            q[0] = float(x)
+            k = 0
+        elif x >= q[4]:
+            q[4] = float(x)
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        pos = self.positions
+        for i in range(k + 1, 5):
+            pos[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Adjust heights of the middle markers.
+        for i in (1, 2, 3):
+            d = self.desired[i] - pos[i]
+            if (d >= 1 and pos[i + 1] - pos[i] > 1) or \
+                    (d <= -1 and pos[i - 1] - pos[i] < -1):
+                d = 1 if d > 0 else -1
+                h = self._parabolic(i, d)
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (pos[i + d] - pos[i])
+                q[i] = h
+                pos[i] += d
+
+    def _parabolic(self, i, d):
+        q = self.heights
+        pos = self.positions
+        return q[i] + float(d) / (pos[i + 1] - pos[i - 1]) * (
+            (pos[i] - pos[i - 1] + d) * (q[i + 1] - q[i]) /
+            (pos[i + 1] - pos[i]) +
+            (pos[i + 1] - pos[i] - d) * (q[i] - q[i - 1]) /
+            (pos[i] - pos[i - 1]))
+
+    def value(self):
+        if self.n == 0:
+            return None
+        if self.n < 5:
+            # Nearest rank on the few samples seen.
+            ordered = sorted(self.heights)
+            rank = int(math.ceil(self.p * len(ordered))) - 1
+            return ordered[max(rank, 0)]
+        return self.heights[2]
+
+
+class Series(object):
+
+    """Aggregates of one series over the current interval."""
+
+    __slots__ = ('min', 'max', 'sum', 'count', 'p95')
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.count = 0
+        self.p95 = P2Quantile(0.95)
+
+    def add(self, value):
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+        self.p95.add(value)
+
+
+_aggregate_types = {}
+
+
+def aggregate_fields(fields):
+    """Fields of aggregated metric: the mean keeps the field name,
+    e.x: r_await, r_await_min, r_await_max, r_await_p95.
+    """
+    result = []
+    for f in fields:
+        result.append(f)
+        result.extend('%s_%s' % (f, a) for a in AGGREGATES)
+    return result
+
+
+def aggregate_type(cls):
+    """Named tuple type holding aggregates of a metric type."""
+    agg_cls = _aggregate_types.get(cls)
+    if agg_cls is None:
+        agg_cls = collections.namedtuple(cls.__name__ + 'Aggregate',
+                                         aggregate_fields(cls._fields))
+        _aggregate_types[cls] = agg_cls
+    return agg_cls
+
+
+class Aggregator(object):
+
+    """
+    Feed it with inspector samples, flush it once per reporting
+    interval to get {uuid: {metric_key: aggregates}}.
+
+    Non numeric fields (e.x: state) report their last value.
+    """
+
+    def __init__(self):
+        # (uuid, metric_key) -> (metric type, {field: Series}, last)
+        self._series = {}
+        self.samples = 0
+
+    def add(self, all_metrics):
+        self.samples += 1
+        for uuid, vm_metrics in all_metrics.items():
+            for metric_key, metric_value in vm_metrics.items():
+                if not metric_value:
+                    continue
+                key = (uuid, metric_key)
+                entry = self._series.get(key)
+                if entry is None:
+                    entry = (type(metric_value), {}, {})
+                    self._series[key] = entry
+                series, last = entry[1], entry[2]
+                for f in metric_value._fields:
+                    value = getattr(metric_value, f)
+                    if value is None:
+                        continue
+                    last[f] = value
+                    if isinstance(value, bool) or \
+                            not isinstance(value, numbers.Number):
+                        continue
+                    s = series.get(f)
+                    if s is None:
+                        s = series[f] = Series()
+                    s.add(value)
+
+    def flush(self):
+        """Return aggregates of the interval and start a new one."""
+        results = {}
+        for (uuid, metric_key), (cls, series, last) in \
+                self._series.items():
+            values = {}
+            for f in cls._fields:
+                s = series.get(f)
+                if s is None:
+                    # Non numeric or never sampled.
+                    values[f] = last.get(f)
+                    for a in AGGREGATES:
+                        values['%s_%s' % (f, a)] = None
+                    continue
+                values[f] = s.sum / s.count
+                values[f + '_min'] = s.min
+                values[f + '_max'] = s.max
+                values[f + '_p95'] = s.p95.value()
+            results.setdefault(uuid, {})[metric_key] = \
+                aggregate_type(cls)(**values)
+        LOG.debug('Aggregated %d series from %d samples',
+                  len(self._series), self.samples)
+        self._series = {}
+        self.samples = 0
+        return results
@@ -0,0 +1,314 @@
+import logging
+import numbers
+import os
+import socket
+import threading
+import time
+
+from six.moves import queue
+
+from libvirt_monitoring import exporter
+from libvirt_monitoring import tsdb
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixMetric
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Batch(object):
+
+    """
+    Items collected in one cycle, shared read-only by all sinks.
+
+    Each wire format is encoded at most once per cycle, whatever
+    the number of sinks which use it.
+    """
+
+    def __init__(self, host, metrics, items, clock=None, host_items=()):
+        self.host = host
+        self.clock = int(clock or time.time())
+        # {uuid: {metric_key: namedtuple}}, as returned by inspector.
+        self.metrics = metrics
+        self.items = tuple(items)
+        # Items about the whole host, e.x: top-N rankings.
+        self.host_items = tuple(host_items)
+        self._encoded = {}
+        self._lock = threading.RLock()
+
+    def encode(self, fmt):
+        with self._lock:
+            encoded = self._encoded.get(fmt)
+            if encoded is None:
+                encoded = ENCODERS[fmt](self)
+                self._encoded[fmt] = encoded
+            return encoded
+
+
+def _encode_json(batch):
+    """One zabbix message (JSON object) per item, host items last."""
+    return tuple(str(ZabbixMetric(batch.host, item.key, item.value,
+                                  batch.clock))
+                 for item in batch.items + batch.host_items)
+
+
+def _encode_jsonl(batch):
+    lines = batch.encode('json')
+    if not lines:
+        return b''
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _escape_tag(value):
+    return str(value).replace(' ', r'\ ').replace(',', r'\,') \
+        .replace('=', r'\=')
+
+
+def _encode_line(batch):
+    """InfluxDB line protocol, one line per domain metric."""
+    lines = []
+    timestamp = batch.clock * 10 ** 9
+    for uuid, vm_metrics in batch.metrics.items():
+        for metric_key, metric_value in vm_metrics.items():
+            if not metric_value:
+                continue
+            family, _, device = metric_key.partition('_')
+            tags = 'uuid=' + _escape_tag(uuid)
+            if device:
+                tags += ',device=' + _escape_tag(device)
+            fields = []
+            for f in metric_value._fields:
+                value = getattr(metric_value, f)
+                if value is None:
+                    continue
+                if isinstance(value, bool) or \
+                        not isinstance(value, numbers.Number):
+                    fields.append('%s="%s"' % (
+                        f, str(value).replace('"', r'\"')))
+                else:
+                    fields.append('%s=%s' % (f, value))
+            if fields:
+                lines.append('%s_%s,%s %s %d' % (
+                    exporter.METRIC_PREFIX, family, tags,
+                    ','.join(fields), timestamp))
+    return tuple(line.encode('utf-8') for line in lines)
+
+
+ENCODERS = {
+    'json': _encode_json,
+    'jsonl': _encode_jsonl,
+    'line': _encode_line,
+}
+
+
+class Sink(object):
+
+    """
+    Base output sink.
+
+    Each sink owns a bounded queue and a worker thread. When the
+    queue is full the oldest batch is dropped, so a slow sink never
+    blocks collection nor the other sinks.
+    Usage: subclass Sink and override the write() method.
+    """
+
+    name = 'sink'
+
+    def __init__(self, queue_size=2):
+        self._queue = queue.Queue(maxsize=max(int(queue_size), 1))
+        self._thread = None
+        self.dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='sink-%s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, batch):
+        while True:
+            try:
+                self._queue.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                    LOG.warning('Sink %s is too slow, dropped %d batches',
+                                self.name, self.dropped)
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                self.write(batch)
+            except Exception as e:
+                LOG.error('Sink %s failed to write batch - %s',
+                          self.name, e)
+
+    def write(self, batch):
+        """
+        You should override this method when you subclass Sink.
+        It is called from the sink's own thread.
+        """
+        raise NotImplementedError()
+
+
+class ZabbixSink(Sink):
+
+    """
+    Send items to Zabbix trapper, through the agent which owns
+    thresholds and item/trigger provisioning.
+    """
+
+    name = 'zabbix'
+
+    def __init__(self, agent, queue_size=2):
+        super(ZabbixSink, self).__init__(queue_size)
+        self.agent = agent
+
+    def write(self, batch):
+        self.agent.send_items(batch)
+
+
+class OpenMetricsSink(Sink):
+
+    name = 'openmetrics'
+
+    def __init__(self, host='0.0.0.0', port=9177, queue_size=2):
+        super(OpenMetricsSink, self).__init__(queue_size)
+        self.exporter = exporter.OpenMetricsExporter(host=host, port=port)
+
+    def start(self):
+        self.exporter.start()
+        super(OpenMetricsSink, self).start()
+
+    def write(self, batch):
+        self.exporter.update(batch.metrics)
+
+
+class UDPSink(Sink):
+
+    """
+    Send items in line protocol over UDP, lines are packed into
+    datagrams of at most max_packet bytes.
+    """
+
+    name = 'udp'
+
+    def __init__(self, host='127.0.0.1', port=8089, max_packet=1400,
+                 queue_size=2):
+        super(UDPSink, self).__init__(queue_size)
+        self.address = (host, int(port))
+        self.max_packet = int(max_packet)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, batch):
+        packet = []
+        size = 0
+        for line in batch.encode('line'):
+            if packet and size + len(line) + 1 > self.max_packet:
+                self.sock.sendto(b'\n'.join(packet), self.address)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self.sock.sendto(b'\n'.join(packet), self.address)
+
+
+class FileSink(Sink):
+
+    """Append items to a local JSON-lines file."""
+
+    name = 'file'
+
+    def __init__(self, path, queue_size=2):
+        super(FileSink, self).__init__(queue_size)
+        self.path = path
+
+    def write(self, batch):
+        data = batch.encode('jsonl')
+        if not data:
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o640)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+class TSDBSink(Sink):
+
+    """Keep recent history in memory, queried on a Unix socket."""
+
+    name = 'tsdb'
+
+    def __init__(self, path, capacity=180, max_age=3600, queue_size=2):
+        super(TSDBSink, self).__init__(queue_size)
+        self.store = tsdb.TimeSeriesStore(capacity=capacity,
+                                          max_age=max_age)
+        self.server = tsdb.QueryServer(self.store, path)
+
+    def start(self):
+        self.server.start()
+        super(TSDBSink, self).start()
+
+    def write(self, batch):
+        self.store.add(batch.metrics, batch.clock)
+
+
+class FanOut(object):
+
+    """Hand each cycle's batch to all sinks."""
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def publish(self, batch):
+        for sink in self.sinks:
+            sink.submit(batch)
+
+
+def load_sinks(agent, config):
+    """Build sinks listed in [default] outputs."""
+    outputs = [o.strip() for o in
+               config.get('default-outputs', 'zabbix').split(',')
+               if o.strip()]
+    queue_size = config.get('default-sink_queue_size', 2)
+    sinks = []
+    for output in outputs:
+        if output == 'zabbix':
+            sinks.append(ZabbixSink(agent, queue_size=queue_size))
+        elif output == 'openmetrics':
+            sinks.append(OpenMetricsSink(
+                host=config.get('exporter-host', '0.0.0.0'),
+                port=config.get('exporter-port', 9177),
+                queue_size=queue_size))
+        elif output == 'udp':
+            sinks.append(UDPSink(
+                host=config.get('udp-host', '127.0.0.1'),
+                port=config.get('udp-port', 8089),
+                max_packet=config.get('udp-max_packet', 1400),
+                queue_size=queue_size))
+        elif output == 'file':
+            sinks.append(FileSink(
+                config.get('file-path',
+                           '/var/lib/libvirt_monitoring/metrics.jsonl'),
+                queue_size=queue_size))
+        elif output == 'tsdb':
+            sinks.append(TSDBSink(
+                config.get('tsdb-socket',
+                           '/var/run/libvirt_monitoring/query.sock'),
+                capacity=config.get('tsdb-capacity', 180),
+                max_age=config.get('tsdb-max_age', 3600),
+                queue_size=queue_size))
+        else:
+            LOG.error('Unknown output %s', output)
+    return sinks
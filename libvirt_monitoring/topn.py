@@ -0,0 +1,70 @@
+"""Top-N noisy neighbour ranking.
+
+Domains are ranked each cycle by disk IOPS and MB/s, network Mb/s
+and CPU utilization, summed over their devices. Each ranking is sent
+as one host level item holding a JSON list.
+"""
+import heapq
+import json
+import operator
+
+from libvirt_monitoring import base
+
+
+# (ranked field, metric family)
+RANKINGS = (
+    ('read_requests_ps', 'diskstats'),
+    ('write_requests_ps', 'diskstats'),
+    ('read_megabytes_ps', 'diskstats'),
+    ('write_megabytes_ps', 'diskstats'),
+    ('tx_megabit_ps', 'interfacestats'),
+    ('rx_megabit_ps', 'interfacestats'),
+    ('util', 'cpustats'),
+)
+
+
+def item_key(field):
+    return 'libvirt.topn[%s]' % field
+
+
+def rank(all_metrics, size=10):
+    """Return {field: [(uuid, value), ...]}, largest first.
+
+    Per domain totals are built in one pass over all devices, then
+    heap selection keeps the `size` largest, without a full sort.
+    """
+    families = {}
+    for field, family in RANKINGS:
+        families.setdefault(family, []).append(field)
+
+    totals = dict((field, {}) for field, _ in RANKINGS)
+    for uuid, vm_metrics in all_metrics.items():
+        for metric_key, metric_value in vm_metrics.items():
+            if not metric_value:
+                continue
+            fields = families.get(metric_key.partition('_')[0])
+            if not fields:
+                continue
+            for field in fields:
+                value = getattr(metric_value, field, None)
+                if value is None:
+                    continue
+                field_totals = totals[field]
+                field_totals[uuid] = field_totals.get(uuid, 0) + value
+
+    return dict((field, heapq.nlargest(size, field_totals.items(),
+                                       key=operator.itemgetter(1)))
+                for field, field_totals in totals.items())
+
+
+def items(rankings):
+    """Host level items of the rankings."""
+    result = []
+    for field, _ in RANKINGS:
+        ranking = rankings.get(field, [])
+        value = json.dumps([{'uuid': uuid, 'value': value}
+                            for uuid, value in ranking])
+        result.append(base.Item(key=item_key(field),
+                                name='Top domains by %s' % field,
+                                value=value))
+    return result
@@ -0,0 +1,191 @@
+"""In-memory time series store with a local query socket.
+
+Each (uuid, metric, field) series is a fixed size ring buffer of
+timestamps and values kept in array('d'), so memory is bounded and
+range reads are slices of contiguous C arrays.
+
+Query protocol, one line per request, JSON response:
+    list [<uuid>]
+    <uuid> <metric>.<field> [<seconds>]
+e.x: <uuid> diskstats_vda.r_await 900 (last 15 minutes).
+"""
+from array import array
+import bisect
+import errno
+import json
+import logging
+import numbers
+import os
+import threading
+import time
+
+from six.moves import socketserver
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_RANGE = 900
+
+
+class RingBuffer(object):
+
+    """Fixed capacity series of (time, value), O(1) append."""
+
+    __slots__ = ('capacity', 'times', 'values', 'head', 'count')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        # Next index to write.
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _segments(self):
+        """Contiguous index ranges, oldest first."""
+        if self.count < self.capacity:
+            return ((0, self.count),)
+        return ((self.head, self.capacity), (0, self.head))
+
+    def range(self, since, until=None):
+        """Points with since <= time <= until, as two arrays."""
+        times = array('d')
+        values = array('d')
+        for start, end in self._segments():
+            lo = bisect.bisect_left(self.times, since, start, end)
+            hi = end
+            if until is not None:
+                hi = bisect.bisect_right(self.times, until, lo, end)
+            times.extend(self.times[lo:hi])
+            values.extend(self.values[lo:hi])
+        return times, values
+
+    @property
+    def last_time(self):
+        if not self.count:
+            return None
+        return self.times[self.head - 1]
+
+
+class TimeSeriesStore(object):
+
+    """Ring buffers keyed by (uuid, metric_key, field)."""
+
+    def __init__(self, capacity=180, max_age=None):
+        self.capacity = int(capacity)
+        # Series not updated for max_age seconds are dropped.
+        self.max_age = float(max_age) if max_age else None
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def add(self, all_metrics, clock=None):
+        clock = float(clock or time.time())
+        with self._lock:
+            for uuid, vm_metrics in all_metrics.items():
+                for metric_key, metric_value in vm_metrics.items():
+                    if not metric_value:
+                        continue
+                    for f in metric_value._fields:
+                        value = getattr(metric_value, f)
+                        if isinstance(value, bool) or \
+                                not isinstance(value, numbers.Number):
+                            continue
+                        key = (uuid, metric_key, f)
+                        ring = self._series.get(key)
+                        if ring is None:
+                            ring = RingBuffer(self.capacity)
+                            self._series[key] = ring
+                        ring.append(clock, value)
+            if self.max_age:
+                for key, ring in list(self._series.items()):
+                    if clock - ring.last_time > self.max_age:
+                        del self._series[key]
+
+    def query(self, uuid, metric_key, field, since, until=None):
+        with self._lock:
+            ring = self._series.get((uuid, metric_key, field))
+            if ring is None:
+                return None
+            return ring.range(since, until)
+
+    def list(self, uuid=None):
+        with self._lock:
+            return sorted('%s %s.%s' % key for key in self._series
+                          if uuid is None or key[0] == uuid)
+
+
+class QueryServer(object):
+
+    """Answer queries on a Unix socket, readable by owner only."""
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self._server = None
+
+    def handle(self, line):
+        args = line.split()
+        if not args:
+            return {'error': 'empty query'}
+        if args[0] == 'list':
+            return {'series': self.store.list(*args[1:2])}
+        if len(args) not in (2, 3) or '.' not in args[1]:
+            return {'error': 'usage: <uuid> <metric>.<field> [<seconds>] '
+                             '| list [<uuid>]'}
+        metric_key, field = args[1].rsplit('.', 1)
+        try:
+            seconds = float(args[2]) if len(args) == 3 else DEFAULT_RANGE
+        except ValueError:
+            return {'error': 'invalid range %s' % args[2]}
+        result = self.store.query(args[0], metric_key, field,
+                                  time.time() - seconds)
+        if result is None:
+            return {'error': 'unknown series %s %s' % (args[0], args[1])}
+        return {'times': result[0].tolist(), 'values': result[1].tolist()}
+
+    def start(self):
+        query_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                line = self.rfile.readline().decode('utf-8').strip()
+                response = query_server.handle(line)
+                self.wfile.write((json.dumps(response) + '\n')
+                                 .encode('utf-8'))
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        socket_dir = os.path.dirname(self.path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0o700)
+        old_umask = os.umask(0o077)
+        try:
+            self._server = Server(self.path, Handler)
+        finally:
+            os.umask(old_umask)
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='tsdb-query')
+        thread.daemon = True
+        thread.start()
+        LOG.info('Time series query socket listening on %s', self.path)
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
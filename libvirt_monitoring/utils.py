@@ -1,3 +1,4 @@
+import json
 import logging
 import logging.config
 from six.moves import configparser
@@ -39,3 +40,45 @@ def logging_config_loader():
         for handler in root_logger.handlers:
             if handler.level == logging.INFO:
                 handler.setLevel(logging.DEBUG)
+
+
+class LazyCall(object):
+    """Defer a call until the log record is actually emitted.
+
+    Usage: LOG.debug('Packet: %s', LazyCall(hexlify, packet))
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class LazyJSON(LazyCall):
+    """Defer JSON serialization until the log record is emitted."""
+
+    def __init__(self, obj, **kwargs):
+        super(LazyJSON, self).__init__(json.dumps, obj, **kwargs)
+
+
+class SampledLogger(object):
+    """Logger proxy which emits only one debug record in every N.
+
+    Level check comes first, so a disabled debug costs one call.
+    """
+
+    def __init__(self, logger, every=1):
+        self.logger = logger
+        self.every = max(int(every), 1)
+        self._count = 0
+
+    def debug(self, msg, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self._count += 1
+        if self._count >= self.every:
+            self._count = 0
+            self.logger.debug(msg, *args)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""CPU cost of a collection cycle with debug logging on and off.
+
+Not part of the test suite, run it with:
+    python -m tests.bench_debug_cost
+"""
+import logging
+import unittest
+
+from libvirt_monitoring import budget
+
+from tests import fakes
+from tests import test_debug_cost
+
+
+DOMAINS = 50
+CYCLES = 5
+
+
+class BenchDebugCost(fakes.TestCase):
+
+    config = test_debug_cost.CONFIG
+
+    def setUp(self):
+        super(BenchDebugCost, self).setUp()
+        fakes.add_host('qemu:///system',
+                       fakes.make_domains(DOMAINS, vnics=2, disks=2))
+        test_debug_cost.log_to_buffer(self)
+
+    def _cpu_per_cycle(self, level):
+        logging.getLogger().setLevel(level)
+        libvirt_agent = fakes.make_agent()
+        # First cycle only takes counter snapshots.
+        libvirt_agent.get_and_send_metrics()
+        started = budget._cpu_time()
+        for _ in range(CYCLES):
+            libvirt_agent.get_and_send_metrics()
+        return (budget._cpu_time() - started) / CYCLES
+
+    def test_debug_on_and_off(self):
+        on = self._cpu_per_cycle(logging.DEBUG)
+        off = self._cpu_per_cycle(logging.INFO)
+        print('\n%d domains, cpu per cycle: debug on %.1f ms, '
+              'debug off %.1f ms' % (DOMAINS, on * 1000, off * 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Fake libvirt module and configuration of tests.
+
+Fake hypervisors are registered by URI, each one with its domains, an
+optional delay of listAllDomains (a stuck RPC) and a failure mode
+(connection refused). Agents of tests send to a trapper without
+network.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+from six.moves import configparser
+
+from libvirt_monitoring import agent
+from libvirt_monitoring import connection
+from libvirt_monitoring import inspector
+from libvirt_monitoring import replay
+from libvirt_monitoring import settings
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixSender
+
+
+ETC_CONFIG = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'etc', 'config.ini')
+
+
+class libvirtError(Exception):
+
+    def __init__(self, msg, code=1, domain=0):
+        Exception.__init__(self, msg)
+        self.err = (code, domain, msg)
+
+    def get_error_code(self):
+        return self.err[0]
+
+    def get_error_domain(self):
+        return self.err[1]
+
+
+class FakeDomain(object):
+
+    """Running domain, counters grow at fixed rates over time."""
+
+    def __init__(self, uuid, name, vcpus=2, vnics=1, disks=1):
+        self.uuid = uuid
+        self._name = name
+        self.vcpus_count = vcpus
+        self.vnics = ['tap%s%d' % (name[-4:], n) for n in range(vnics)]
+        self.disks = ['vd%s' % chr(ord('a') + n) for n in range(disks)]
+        self.domain_id = 1
+        self.started = time.time()
+        self.fail_vnics = False
+
+    def _elapsed(self):
+        return time.time() - self.started
+
+    def UUIDString(self):
+        return self.uuid
+
+    def ID(self):
+        return self.domain_id
+
+    def name(self):
+        return self._name
+
+    def info(self):
+        # Half a CPU busy, in nanoseconds.
+        return [1, 2097152, 1048576, self.vcpus_count,
+                int(self._elapsed() * 5e8)]
+
+    def XMLDesc(self, flags):
+        devices = ''.join(
+            "<disk type='file' device='disk'><source file='/%s'/>"
+            "<target dev='%s'/></disk>" % (disk, disk)
+            for disk in self.disks)
+        devices += ''.join(
+            "<interface type='bridge'><mac address='52:54:00:00:00:%02x'/>"
+            "<target dev='%s'/></interface>" % (n, vnic)
+            for n, vnic in enumerate(self.vnics))
+        return ("<domain><name>%s</name><uuid>%s</uuid><vcpu>%d</vcpu>"
+                "<devices>%s</devices></domain>" % (
+                    self._name, self.uuid, self.vcpus_count, devices))
+
+    def vcpus(self):
+        cpu_time = int(self._elapsed() * 5e8 / self.vcpus_count)
+        return ([[n, 1, cpu_time, n] for n in range(self.vcpus_count)],
+                [])
+
+    def interfaceStats(self, device):
+        if self.fail_vnics:
+            raise libvirtError('interface %s not found' % device)
+        # 1 MB/s received, 0.5 MB/s sent by the guest.
+        elapsed = self._elapsed()
+        return (int(elapsed * 1e6), int(elapsed * 1000), 0, 0,
+                int(elapsed * 5e5), int(elapsed * 500), 0, 0)
+
+    def blockStatsFlags(self, device, flags):
+        elapsed = self._elapsed()
+        return {'rd_operations': int(elapsed * 100),
+                'wr_operations': int(elapsed * 50),
+                'rd_bytes': int(elapsed * 4096 * 100),
+                'wr_bytes': int(elapsed * 4096 * 50),
+                'rd_total_times': int(elapsed * 1e8),
+                'wr_total_times': int(elapsed * 1e8),
+                'flush_operations': 0, 'flush_total_times': 0, 'errs': -1}
+
+    def blockInfo(self, device):
+        return [10 * 1024 ** 3, 1024 ** 3, 1024 ** 3]
+
+    def memoryStats(self):
+        return {'available': 2097152, 'unused': 1048576, 'rss': 1572864}
+
+
+class FakeHost(object):
+
+    def __init__(self, domains, delay=0, fail=False):
+        self.domains = domains
+        # Seconds listAllDomains hangs.
+        self.delay = delay
+        self.fail = fail
+        self.opened = 0
+
+
+class FakeConnection(object):
+
+    def __init__(self, host):
+        self.host = host
+        self.lookups = 0
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+    def registerCloseCallback(self, callback, opaque):
+        pass
+
+    def unregisterCloseCallback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def listAllDomains(self):
+        if self.host.delay:
+            time.sleep(self.host.delay)
+        return list(self.host.domains)
+
+    def lookupByUUIDString(self, uuid):
+        self.lookups += 1
+        for domain in self.host.domains:
+            if domain.uuid == uuid:
+                return domain
+        raise libvirtError('Domain not found: %s' % uuid, code=42)
+
+
+# uri -> FakeHost
+HOSTS = {}
+_lock = threading.Lock()
+
+
+def _open_read_only(uri):
+    with _lock:
+        host = HOSTS.get(uri)
+    if host is None or host.fail:
+        raise libvirtError('unable to connect to %s' % uri, code=38,
+                           domain=7)
+    host.opened += 1
+    return FakeConnection(host)
+
+
+def _build_module():
+    module = types.ModuleType('libvirt')
+    module.libvirtError = libvirtError
+    module.VIR_ERR_SYSTEM_ERROR = 38
+    module.VIR_ERR_NO_CONNECT = 39
+    module.VIR_ERR_INVALID_CONN = 40
+    module.VIR_FROM_REMOTE = 14
+    module.VIR_FROM_RPC = 7
+    module.virEventRegisterDefaultImpl = lambda: None
+    module.virEventRunDefaultImpl = lambda: time.sleep(1)
+    module.openReadOnly = _open_read_only
+    return module
+
+
+libvirt = _build_module()
+
+
+def install():
+    """Make the fake module the libvirt of the agent modules."""
+    sys.modules['libvirt'] = libvirt
+    connection.libvirt = libvirt
+    inspector.libvirt = libvirt
+
+
+def add_host(uri, domains=(), delay=0, fail=False):
+    with _lock:
+        HOSTS[uri] = host = FakeHost(list(domains), delay=delay, fail=fail)
+    return host
+
+
+def make_domains(count, host=0, **kwargs):
+    """Domains with UUIDs unique across hosts."""
+    return [FakeDomain('%08x-0000-4000-8000-%012x' % (host, n),
+                       'hv%d-instance-%04d' % (host, n), **kwargs)
+            for n in range(count)]
+
+
+class NullTrapper(ZabbixSender):
+
+    """Builds and logs packets like ZabbixSender, no network."""
+
+    def _send_packet(self, host_addr, packet):
+        logging.getLogger(ZabbixSender.__module__).debug(
+            'Sending data to %s', host_addr)
+        return {'response': 'success',
+                'info': 'processed: 1; failed: 0; total: 1; '
+                        'seconds spent: 0.000100'}
+
+
+def make_agent():
+    """Agent of the test configuration, its outputs write from the
+    caller's thread and Zabbix ones send to a NullTrapper.
+    """
+    libvirt_agent = agent.LibvirtAgent()
+    libvirt_agent.zsender = NullTrapper()
+    libvirt_agent.fanout = replay.SyncFanOut(libvirt_agent.sinks)
+    return libvirt_agent
+
+
+def write_config(path, overrides):
+    """Copy etc/config.ini to path, with overrides {'section-key': value}.
+    """
+    parser = configparser.RawConfigParser()
+    parser.read([ETC_CONFIG])
+    for name, value in overrides.items():
+        section, _, key = name.partition('-')
+        if not parser.has_section(section):
+            parser.add_section(section)
+        parser.set(section, key, str(value))
+    with open(path, 'w') as f:
+        parser.write(f)
+
+
+class TestCase(unittest.TestCase):
+
+    """Fake libvirt installed, configuration of etc/config.ini with the
+    config overrides of the test case.
+    """
+
+    config = {}
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        install()
+        self.tmpdir = tempfile.mkdtemp(prefix='libvirt_monitoring-')
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        conf_path = os.path.join(self.tmpdir, 'config.ini')
+        write_config(conf_path, self.config)
+        self.addCleanup(setattr, settings, 'CONF_PATH', settings.CONF_PATH)
+        settings.CONF_PATH = conf_path
+        self.addCleanup(HOSTS.clear)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from libvirt_monitoring import budget
+
+
+class TestCollectionBudget(unittest.TestCase):
+
+    def setUp(self):
+        # No load pressure, 50ms of wall time per cycle.
+        self.budget = budget.CollectionBudget(wall=0.05, load_threshold=1e9,
+                                              agent_cpu=1e9)
+
+    def _cycle(self, domains, slow):
+        """Collect diskstats over domains, return (order, collected)."""
+        order = []
+        collected = []
+        for domain in self.budget.start(domains):
+            order.append(domain)
+            if self.budget.allow('diskstats'):
+                collected.append(domain)
+                if domain in slow:
+                    time.sleep(0.03)
+        self.budget.finish()
+        return order, collected
+
+    def test_next_cycle_starts_where_last_one_was_cut_off(self):
+        domains = list('abcdefgh')
+        order, collected = self._cycle(domains, slow='ab')
+        self.assertEqual(domains, order)
+        self.assertEqual(list('ab'), collected)
+        self.assertIn('diskstats', self.budget.deferred)
+
+        order, collected = self._cycle(domains, slow='')
+        self.assertEqual(list('cdefghab'), order)
+        self.assertEqual(list('cdefghab'), collected)
+        # Nothing was cut off, the order is kept.
+        order, collected = self._cycle(domains, slow='cd')
+        self.assertEqual(list('cdefghab'), order)
+        self.assertEqual(list('cd'), collected)
+        order, collected = self._cycle(domains, slow='')
+        self.assertEqual(list('efghabcd'), order)
+
+    def test_fewer_domains(self):
+        self._cycle(list('abcdefgh'), slow='abcdef')
+        order, collected = self._cycle(list('abc'), slow='')
+        self.assertEqual(list('cab'), order)
+
+    def test_no_domains(self):
+        self.assertEqual(([], []), self._cycle([], slow=''))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from libvirt_monitoring import checkpoint
+from libvirt_monitoring import inspector
+
+from tests import fakes
+
+
+UUID = '6695eb01-f6a4-8304-79aa-97f2502e193f'
+
+
+class TestCheckpoint(fakes.TestCase):
+
+    def setUp(self):
+        super(TestCheckpoint, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'ckpt', 'snapshots.ckpt')
+
+    def _record(self, device, timestamp=None, kind=checkpoint.KIND_DISK):
+        return checkpoint.make_record(kind, UUID, 3, device,
+                                      timestamp or time.time(), [1, 2, 3])
+
+    def test_round_trip(self):
+        records = [self._record(u'vda'),
+                   self._record(u'tap\xe9', kind=checkpoint.KIND_VNIC),
+                   self._record(u'', kind=checkpoint.KIND_CPU),
+                   self._record(u'd' * checkpoint.DEVICE_SIZE)]
+        self.assertTrue(checkpoint.save(self.path, records))
+        self.assertEqual(records, checkpoint.load(self.path))
+
+    def test_max_age(self):
+        now = time.time()
+        checkpoint.save(self.path, [self._record(u'vda', now - 700),
+                                    self._record(u'vdb', now - 10)])
+        self.assertEqual([u'vdb'], [r.device for r in checkpoint.load(
+            self.path, max_age=600)])
+        self.assertEqual(2, len(checkpoint.load(self.path)))
+
+    def test_long_device_names_are_not_saved(self):
+        # 17 two bytes characters.
+        checkpoint.save(self.path, [self._record(u'vda'),
+                                    self._record(u'd' * 33),
+                                    self._record(u'\xe9' * 17)])
+        self.assertEqual([u'vda'],
+                         [r.device for r in checkpoint.load(self.path)])
+
+    def test_invalid_utf8_device(self):
+        record = self._record(u'vda')
+        data = bytearray(checkpoint.HEADER.pack(checkpoint.MAGIC,
+                                                checkpoint.VERSION, 1))
+        # Two bytes character cut after its first byte.
+        data += checkpoint.RECORD.pack(
+            record.kind, b'\x00' * 16, record.domain_id, b'vd\xc3',
+            record.time, *record.counters)
+        path = os.path.join(self.tmpdir, 'invalid.ckpt')
+        with open(path, 'wb') as f:
+            f.write(bytes(data))
+        loaded = checkpoint.load(path)
+        self.assertEqual(1, len(loaded))
+        self.assertTrue(loaded[0].device.startswith(u'vd'))
+
+    def test_restarted_domains_are_dropped(self):
+        domains = fakes.make_domains(2)
+        fakes.add_host('qemu:///system', domains)
+        before = inspector.LibvirtInspector()
+        before.get_vm_metrics()
+        checkpoint.save(self.path, before.export_snapshots())
+
+        # Second domain was restarted while the agent was stopped.
+        domains[1].domain_id = 2
+        after = inspector.LibvirtInspector()
+        after.restore_snapshots(checkpoint.load(self.path))
+        time.sleep(0.05)
+        metrics = after.get_vm_metrics()
+        self.assertIsNotNone(metrics[domains[0].uuid]['cpustats'].util)
+        self.assertIsNone(metrics[domains[1].uuid]['cpustats'].util)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import time
+
+from libvirt_monitoring import base
+from libvirt_monitoring import connection
+
+from tests import fakes
+
+
+URI = 'test://hv0/default'
+
+
+class TestConnectionManager(fakes.TestCase):
+
+    def setUp(self):
+        super(TestConnectionManager, self).setUp()
+        self.host = fakes.add_host(URI, fakes.make_domains(2))
+        self.manager = connection.ConnectionManager(URI, min_backoff=0.01)
+
+    def _wait_up(self):
+        for _ in range(100):
+            if self.manager.healthy:
+                return
+            time.sleep(0.01)
+        self.fail('%s not reconnected' % URI)
+
+    def test_lookup_from_listed_handles(self):
+        listed = self.manager.domains()
+        conn = self.manager.get()
+        self.assertIs(listed[1], self.manager.lookup(listed[1].uuid))
+        self.assertEqual(0, conn.lookups)
+        # Not listed yet.
+        self.host.domains.extend(fakes.make_domains(1, host=1))
+        uuid = self.host.domains[-1].uuid
+        self.manager.lookup(uuid)
+        self.manager.lookup(uuid)
+        self.assertEqual(1, conn.lookups)
+
+    def test_handles_are_bound_again_after_reconnect(self):
+        uuid = self.manager.domains()[0].uuid
+        self.manager.mark_down()
+        self.assertRaises(base.ConnectionUnavailable, self.manager.lookup,
+                          uuid)
+        self._wait_up()
+        conn = self.manager.get()
+        self.assertEqual(2, self.host.opened)
+        # Handles of the lost connection are not used.
+        self.manager.lookup(uuid)
+        self.assertEqual(1, conn.lookups)
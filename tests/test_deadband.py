@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import unittest
+
+from libvirt_monitoring import agent
+from libvirt_monitoring import base
+from libvirt_monitoring import deadband
+from libvirt_monitoring import sinks
+from libvirt_monitoring import utils
+
+
+KEY = 'diskstats_vda.read_requests_ps[vm1]'
+
+
+class FakeSender(object):
+
+    def __init__(self):
+        self.sent = []
+        self.fail = False
+
+    def send_messages(self, messages):
+        if self.fail:
+            raise IOError('trapper is down')
+        self.sent.append([json.loads(m) for m in messages])
+        return 'ok'
+
+
+class FakeAgent(agent.LibvirtAgent):
+
+    """send_items of an agent with a fake trapper, no API."""
+
+    def __init__(self, relative=0.01):
+        self.config = {'zabbix_agent-hostname': 'agent 01',
+                       'thresholds-read_requests_ps': '500'}
+        self.provisioning = 'api'
+        self.item_log = utils.SampledLogger(logging.getLogger(__name__), 1)
+        self.deadband = deadband.DeadbandFilter(relative=relative,
+                                                heartbeat=10)
+        self._deadband_fields = {}
+        self.zsender = FakeSender()
+
+    def create_item(self, item, value_type=0):
+        pass
+
+    def create_trigger(self, item):
+        pass
+
+    def cycle(self, value):
+        """Send one cycle, return values sent."""
+        self.deadband.next_cycle(['vm1'])
+        self.zsender.sent = []
+        item = base.Item(key=KEY, name='Read requests', value=value)
+        try:
+            self.send_items(sinks.Batch('agent 01', {}, [item]))
+        except IOError:
+            pass
+        return [float(m['value']) for messages in self.zsender.sent
+                for m in messages]
+
+
+class TestDeadband(unittest.TestCase):
+
+    def test_small_changes_are_suppressed(self):
+        fake = FakeAgent()
+        self.assertEqual([600], fake.cycle(600))
+        self.assertEqual([], fake.cycle(603))
+        self.assertEqual([700], fake.cycle(700))
+
+    def test_threshold_crossing_is_sent(self):
+        fake = FakeAgent()
+        self.assertEqual([502], fake.cycle(502))
+        # Below threshold, not sent.
+        self.assertEqual([], fake.cycle(499))
+        # Within the deadband of the last sent value, but an alert.
+        self.assertEqual([502], fake.cycle(502))
+
+    def test_unsent_values_are_not_remembered(self):
+        fake = FakeAgent()
+        fake.zsender.fail = True
+        self.assertEqual([], fake.cycle(600))
+        fake.zsender.fail = False
+        self.assertEqual([601], fake.cycle(601))
+
+    def test_heartbeat(self):
+        fake = FakeAgent()
+        sent = [fake.cycle(600) for _ in range(11)]
+        self.assertEqual([[600]] + [[]] * 9 + [[600]], sent)
+
+    def test_unchanged_domains(self):
+        fake = FakeAgent()
+        fake.deadband.heartbeat = 3
+        skipped = []
+        for cycle in range(5):
+            # Running domain: its cpu time counter always grows, values
+            # without threshold may change.
+            metrics = {'cpustats': base.CPUStats(number=1, time=cycle,
+                                                 util=cycle),
+                       'diskstats_vda': base.DiskStats(
+                           read_megabytes_ps=cycle, read_requests_ps=600,
+                           write_megabytes_ps=0, write_requests_ps=0,
+                           r_await=None, w_await=None, errors=0)}
+            if cycle == 4:
+                metrics['diskstats_vda'] = metrics['diskstats_vda']._replace(
+                    read_requests_ps=900)
+            fake.deadband.next_cycle(['vm1'])
+            skipped.append(fake.deadband.unchanged(
+                'vm1', fake._deadband_values(metrics)))
+        self.assertEqual([False, True, True, False, False], skipped)
+        self.assertEqual({'diskstats_vda.read_requests_ps': True,
+                          'diskstats_vda.read_megabytes_ps': False,
+                          'cpustats.time': False},
+                         dict((k, fake._deadband_fields[k]) for k in (
+                             'diskstats_vda.read_requests_ps',
+                             'diskstats_vda.read_megabytes_ps',
+                             'cpustats.time')))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Debug serialization of a collection cycle is deferred: nothing is
+serialized for debug records while debug logging is off.
+
+CPU cost of cycles with debug on and off is measured by
+tests/bench_debug_cost.py.
+"""
+import logging
+
+import six
+
+from libvirt_monitoring import utils
+
+from tests import fakes
+
+
+DOMAINS = 5
+# Items over their threshold, sent to Zabbix.
+CONFIG = {'thresholds-_ps': 0,
+          'zabbix_agent-provisioning': 'lld',
+          'zabbix_agent-use_config': False,
+          'checkpoint-enabled': False}
+
+
+def log_to_buffer(test):
+    """Format records of the root logger like the agent's handlers,
+    until the end of the test.
+    """
+    handler = logging.StreamHandler(six.StringIO())
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(process)d %(levelname)s %(name)s %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    test.addCleanup(root.removeHandler, handler)
+    test.addCleanup(root.setLevel, root.level)
+
+
+class TestDebugCost(fakes.TestCase):
+
+    config = CONFIG
+
+    def setUp(self):
+        super(TestDebugCost, self).setUp()
+        fakes.add_host('qemu:///system',
+                       fakes.make_domains(DOMAINS, vnics=2, disks=2))
+        log_to_buffer(self)
+        self.evaluated = 0
+        original = utils.LazyCall.__dict__['__str__']
+
+        def counted(lazy):
+            self.evaluated += 1
+            return original(lazy)
+
+        utils.LazyCall.__str__ = counted
+        self.addCleanup(setattr, utils.LazyCall, '__str__', original)
+
+    def _evaluations(self, level):
+        """Deferred debug calls evaluated over two cycles."""
+        logging.getLogger().setLevel(level)
+        libvirt_agent = fakes.make_agent()
+        # Second cycle has rates.
+        libvirt_agent.get_and_send_metrics()
+        libvirt_agent.get_and_send_metrics()
+        return self.evaluated
+
+    def test_debug_off(self):
+        self.assertEqual(0, self._evaluations(logging.INFO))
+
+    def test_debug_on(self):
+        self.assertGreater(self._evaluations(logging.DEBUG), 0)
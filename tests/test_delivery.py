@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import time
+import unittest
+
+from libvirt_monitoring.py_zabbix_api import delivery
+from libvirt_monitoring.py_zabbix_api import resilience
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixMetric
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixSender
+
+
+def response(packet):
+    return {'response': 'success',
+            'info': 'processed: %d; failed: 0; total: %d; '
+                    'seconds spent: 0.000100' % (len(packet), len(packet))}
+
+
+class Trappers(object):
+
+    """send_packet of trappers, `down` ones refuse connections."""
+
+    def __init__(self):
+        self.down = set()
+        self.sent = {}
+
+    def __call__(self, address, packet):
+        if address in self.down:
+            raise socket.error('Connection refused')
+        self.sent.setdefault(address, []).extend(packet)
+        return response(packet)
+
+
+def make_targets(count, probe_interval=30):
+    return [delivery.Target(('trapper%d' % n, 10051),
+                            probe_interval=probe_interval)
+            for n in range(count)]
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.targets = make_targets(3)
+        self.policy = delivery.Broadcast(self.targets)
+        self.trappers = Trappers()
+
+    def test_partial_failure(self):
+        self.trappers.down.add(self.targets[1].address)
+        self.assertIn('processed: 2;', self.policy.deliver(
+            ['a', 'b'], list, self.trappers)['info'])
+        self.assertEqual([True, False, True],
+                         [t.healthy for t in self.targets])
+        # Failed target is skipped until probe_interval is over.
+        self.trappers.down.clear()
+        self.policy.deliver(['c'], list, self.trappers)
+        self.assertEqual({self.targets[0].address: ['a', 'b', 'c'],
+                          self.targets[2].address: ['a', 'b', 'c']},
+                         self.trappers.sent)
+
+    def test_all_targets_fail(self):
+        self.trappers.down.update(t.address for t in self.targets)
+        self.assertRaises(socket.error, self.policy.deliver, ['a'], list,
+                          self.trappers)
+        self.assertRaises(resilience.CircuitOpen, self.policy.deliver,
+                          ['a'], list, self.trappers)
+
+
+class TestFailover(unittest.TestCase):
+
+    def test_priority_order(self):
+        targets = make_targets(3)
+        policy = delivery.Failover(targets)
+        trappers = Trappers()
+        policy.deliver(['a'], list, trappers)
+        trappers.down.add(targets[0].address)
+        policy.deliver(['b'], list, trappers)
+        trappers.down.clear()
+        # First target is not probed before probe_interval.
+        policy.deliver(['c'], list, trappers)
+        self.assertEqual({targets[0].address: ['a'],
+                          targets[1].address: ['b', 'c']}, trappers.sent)
+        trappers.down.update(t.address for t in targets[1:])
+        self.assertRaises(socket.error, policy.deliver, ['d'], list,
+                          trappers)
+        self.assertRaises(resilience.CircuitOpen, policy.deliver, ['e'],
+                          list, trappers)
+
+
+class TestProbeInterval(unittest.TestCase):
+
+    def test_failed_target_is_probed_again(self):
+        target = make_targets(1, probe_interval=0.05)[0]
+        trappers = Trappers()
+        trappers.down.add(target.address)
+        self.assertRaises(socket.error, target.send, trappers, ['a'])
+        self.assertFalse(target.available())
+        time.sleep(0.06)
+        self.assertTrue(target.available())
+        # Probe fails, target waits another probe_interval.
+        self.assertRaises(socket.error, target.send, trappers, ['b'])
+        self.assertFalse(target.available())
+        time.sleep(0.06)
+        trappers.down.clear()
+        target.send(trappers, ['c'])
+        self.assertTrue(target.healthy)
+        self.assertEqual(2, target.stats()['errors'])
+
+
+class ShardedSender(ZabbixSender):
+
+    """Two trappers sharded by host, packets of `refused` host are
+    rejected like by an open circuit.
+    """
+
+    def __init__(self):
+        ZabbixSender.__init__(self, chunk_size=10)
+        self.zabbix_uri = [('trapper0', 10051), ('trapper1', 10051)]
+        self._init_delivery(None, None, 'hash', 0, 'buffer', 100)
+        self.refused = None
+        self.sent = []
+
+    def _build_packet(self, messages):
+        return list(messages)
+
+    def _send_packet(self, host_addr, packet):
+        if any(json.loads(m)['host'] == self.refused for m in packet):
+            raise resilience.CircuitOpen('%s:%s is open' % host_addr)
+        self.sent.extend(packet)
+        return response(packet)
+
+
+class TestHashShard(unittest.TestCase):
+
+    def setUp(self):
+        self.targets = [delivery.Target(('trapper%d' % n, 10051))
+                        for n in range(3)]
+        self.shard = delivery.HashShard(self.targets)
+
+    def test_host_of_any_key_order(self):
+        # Python 2 dicts are dumped in hash order, e.x: host last.
+        message = '{"value": "1", "key": "k", "clock": 1, "host": "hv \\"1"}'
+        self.assertEqual('hv "1', delivery.HashShard.host_of(message))
+        metric = ZabbixMetric('hv 2', 'cpustats.util[vm]', 50, 1)
+        self.assertEqual('hv 2', delivery.HashShard.host_of(str(metric)))
+
+    def test_host_goes_to_one_target(self):
+        sent = {}
+
+        def send_packet(address, packet):
+            sent.setdefault(address, []).extend(packet)
+            return {'response': 'success',
+                    'info': 'processed: %d; failed: 0; total: %d; '
+                            'seconds spent: 0.000100' % (len(packet),
+                                                         len(packet))}
+
+        messages = [str(ZabbixMetric('host%d' % (n % 10), 'key%d' % n, n, 1))
+                    for n in range(100)]
+        response = self.shard.deliver(messages, list, send_packet)
+        self.assertIn('processed: 100;', response['info'])
+        owners = {}
+        for address, packet in sent.items():
+            for message in packet:
+                host = json.loads(message)['host']
+                owners.setdefault(host, set()).add(address)
+        self.assertEqual(10, len(owners))
+        for addresses in owners.values():
+            self.assertEqual(1, len(addresses))
+
+    def test_partial_failure_is_not_sent_again(self):
+        sender = ShardedSender()
+        owners = {}
+        for n in range(20):
+            host = 'host%d' % n
+            owners.setdefault(sender.delivery.route(host)[0].name, host)
+        self.assertEqual(2, len(owners))
+        good, bad = sorted(owners.values())
+        messages = [str(ZabbixMetric(host, 'key', n, 1))
+                    for n, host in enumerate([good, bad, good, bad])]
+
+        # Circuit of the bad host shard opens on both targets.
+        sender.refused = bad
+        response = sender.send_messages(messages)
+        self.assertEqual(2, response.processed)
+        self.assertEqual(messages[1::2], list(sender._backlog))
+        sender.refused = None
+        sender.send_messages([])
+        self.assertEqual(sorted(messages), sorted(sender.sent))
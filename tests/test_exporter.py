@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import collections
+import unittest
+
+from libvirt_monitoring import base
+from libvirt_monitoring import exporter
+
+
+UUID = '6695eb01-f6a4-8304-79aa-97f2502e193f'
+DiskSource = collections.namedtuple('DiskSource', ['path'])
+
+
+class TestOpenMetricsExporter(unittest.TestCase):
+
+    def _lines(self, vm_metrics):
+        openmetrics = exporter.OpenMetricsExporter()
+        openmetrics.update({UUID: vm_metrics})
+        return openmetrics.payload.decode('utf-8').split('\n')
+
+    def test_label_values_are_escaped(self):
+        lines = self._lines({
+            'statestats': base.StateStats(state='running'),
+            'disksource_a"b\\c': DiskSource(path='/srv/"vm"\\disk\n1')})
+        self.assertIn('libvirt_statestats_state{uuid="%s",'
+                      'state="running"} 1' % UUID, lines)
+        self.assertIn('libvirt_disksource_path{uuid="%s",'
+                      'device="a\\"b\\\\c",'
+                      'path="/srv/\\"vm\\"\\\\disk\\n1"} 1' % UUID, lines)
+        self.assertEqual('# EOF', lines[-2])
+
+    def test_special_values(self):
+        lines = self._lines({'cpustats': base.CPUStats(
+            number=2, time=float('inf'), util=float('nan'))})
+        self.assertIn('libvirt_cpustats_number{uuid="%s"} 2' % UUID, lines)
+        self.assertIn('libvirt_cpustats_time{uuid="%s"} +Inf' % UUID, lines)
+        self.assertIn('libvirt_cpustats_util{uuid="%s"} NaN' % UUID, lines)
+        lines = self._lines({'cpustats': base.CPUStats(
+            number=2, time=float('-inf'), util=12.5)})
+        self.assertIn('libvirt_cpustats_time{uuid="%s"} -Inf' % UUID, lines)
+        self.assertIn('libvirt_cpustats_util{uuid="%s"} 12.5' % UUID, lines)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from libvirt_monitoring import base
+from libvirt_monitoring import hostfs
+from libvirt_monitoring import inspector
+from libvirt_monitoring import settings
+
+from tests import fakes
+
+
+SCOPE = 'machine.slice/machine-qemu\\x2d1\\x2dinstance.scope'
+MEMORY_STAT = ('anon %d\nfile 4294967296\nkernel 8388608\n'
+               'shmem 0\nfile_mapped 1048576\n')
+
+
+class FakeTree(object):
+
+    """cgroup v2, sysfs and procfs of one qemu process under a
+    temporary directory.
+    """
+
+    def __init__(self, root, name, taps, pid=4242):
+        self.root = root
+        self.cgroup_root = os.path.join(root, 'cgroup')
+        self.sysfs_root = os.path.join(root, 'sys')
+        self.proc_root = os.path.join(root, 'proc')
+        self.pid_dir = os.path.join(root, 'run')
+        self.scope = os.path.join(self.cgroup_root, SCOPE)
+        os.makedirs(os.path.join(self.scope, 'libvirt', 'emulator'))
+        os.makedirs(os.path.join(self.proc_root, str(pid)))
+        os.makedirs(self.pid_dir)
+        self._write(os.path.join(self.pid_dir, name + '.pid'), pid)
+        self._write(os.path.join(self.proc_root, str(pid), 'cgroup'),
+                    '0::/%s/libvirt/emulator\n' % SCOPE)
+        self.set_cpu(0)
+        self.set_memory(0, 0)
+        for tap in taps:
+            os.makedirs(self._stats_dir(tap))
+            self.set_net(tap, 0, 0, 0, 0)
+
+    @staticmethod
+    def _write(path, value):
+        with open(path, 'w') as f:
+            f.write('%s\n' % value)
+
+    def _stats_dir(self, tap):
+        return os.path.join(self.sysfs_root, 'class/net', tap, 'statistics')
+
+    def set_cpu(self, usage_usec):
+        self._write(os.path.join(self.scope, 'cpu.stat'),
+                    'usage_usec %d\nuser_usec %d\nsystem_usec 0'
+                    % (usage_usec, usage_usec))
+
+    def set_memory(self, anon, current):
+        self._write(os.path.join(self.scope, 'memory.stat'),
+                    MEMORY_STAT % anon)
+        self._write(os.path.join(self.scope, 'memory.current'), current)
+
+    def set_net(self, tap, rx_bytes, rx_packets, tx_bytes, tx_packets):
+        for stat, value in zip(hostfs.NET_STATS, (rx_bytes, rx_packets,
+                                                  tx_bytes, tx_packets)):
+            self._write(os.path.join(self._stats_dir(tap), stat), value)
+
+    def config(self):
+        return {'hostfs-enabled': True,
+                'hostfs-cgroup_root': self.cgroup_root,
+                'hostfs-sysfs_root': self.sysfs_root,
+                'hostfs-proc_root': self.proc_root,
+                'hostfs-pid_dir': self.pid_dir}
+
+
+class TestHostReader(fakes.TestCase):
+
+    def setUp(self):
+        super(TestHostReader, self).setUp()
+        self.tree = FakeTree(self.tmpdir, 'instance-1', ['tap1'])
+        self.reader = hostfs.HostReader(
+            cgroup_root=self.tree.cgroup_root,
+            sysfs_root=self.tree.sysfs_root,
+            proc_root=self.tree.proc_root,
+            pid_dir=self.tree.pid_dir)
+        self.addCleanup(self.reader.prune, ())
+        self.interfaces = [base.Interface(name='tap1',
+                                          mac='52:54:00:00:00:01',
+                                          fref=None, parameters={})]
+
+    def _resolve(self):
+        return self.reader.resolve('uuid-1', 'instance-1', 1, 2,
+                                   self.interfaces)
+
+    def test_resolve_domain_scope(self):
+        files = self._resolve()
+        self.assertEqual(self.tree.scope, files.cgroup)
+        self.assertIs(files, self.reader.get('uuid-1', 1))
+        # Restarted domain.
+        self.assertIsNone(self.reader.get('uuid-1', 2))
+
+    def test_read_counters(self):
+        self.tree.set_cpu(1500000)
+        self.tree.set_memory(anon=2 * 1024 ** 3, current=6 * 1024 ** 3)
+        files = self._resolve()
+        self.assertEqual(1500000000, self.reader.read_cpu_time(files))
+        # Page cache of memory.current is not resident guest memory.
+        self.assertEqual(2 * 1024 ** 3, self.reader.read_memory(files))
+        self.assertEqual({'rx_bytes': 0, 'rx_packets': 0, 'tx_bytes': 0,
+                          'tx_packets': 0},
+                         self.reader.read_net(files, 'tap1'))
+        # Files are read again with pread.
+        self.tree.set_cpu(2500000)
+        self.assertEqual(2500000000, self.reader.read_cpu_time(files))
+
+    def test_missing_files(self):
+        os.remove(os.path.join(self.tree.scope, 'memory.stat'))
+        files = self._resolve()
+        self.assertIsNone(self.reader.read_memory(files))
+        self.assertIsNone(self.reader.read_net(files, 'tap9'))
+        self.assertIsNotNone(self.reader.read_cpu_time(files))
+
+
+class TestInspectorHostfs(fakes.TestCase):
+
+    def setUp(self):
+        super(TestInspectorHostfs, self).setUp()
+        self.domain = fakes.make_domains(1)[0]
+        self.tree = FakeTree(os.path.join(self.tmpdir, 'host'),
+                             self.domain.name(), self.domain.vnics)
+        fakes.write_config(settings.CONF_PATH, self.tree.config())
+        fakes.add_host('qemu:///system', [self.domain])
+        self.inspector = inspector.LibvirtInspector()
+        self.addCleanup(self.inspector.hostfs.prune, ())
+        self.tap = self.domain.vnics[0]
+
+    def _cycle(self):
+        return self.inspector.get_vm_metrics()[self.domain.uuid]
+
+    def test_counters_from_host_files(self):
+        self.tree.set_memory(anon=1024 ** 3, current=3 * 1024 ** 3)
+        first = self._cycle()
+        self.assertEqual(1024, first['memoryresidentstats'].resident)
+        self.assertNotIn('interfacestats_' + self.tap, first)
+        started = time.time()
+        time.sleep(0.2)
+        # One of the two vCPUs busy.
+        self.tree.set_cpu((time.time() - started) * 1e6)
+        self.tree.set_net(self.tap, 250000, 250, 125000, 125)
+        second = self._cycle()
+        self.assertAlmostEqual(50, second['cpustats'].util, delta=10)
+        vnic = second['interfacestats_' + self.tap]
+        # Tap rx is guest tx.
+        self.assertAlmostEqual(8, vnic.tx_megabit_ps, delta=2)
+        self.assertAlmostEqual(4, vnic.rx_megabit_ps, delta=1)
+
+    def test_sources_are_not_mixed(self):
+        self.tree.set_cpu(1000)
+        self._cycle()
+        # cgroup and tap removed under the reader.
+        files = self.inspector.hostfs.get(self.domain.uuid, 1)
+        for fd in [files.cpu_fd] + list(files.net_fds[self.tap].values()):
+            os.close(fd)
+        os.remove(os.path.join(self.tree.scope, 'cpu.stat'))
+        for stat in hostfs.NET_STATS:
+            os.remove(os.path.join(self.tree._stats_dir(self.tap), stat))
+        time.sleep(0.1)
+        second = self._cycle()
+        # libvirt counters are not compared with cgroup/tap ones.
+        self.assertIsNone(second['cpustats'].util)
+        self.assertNotIn('interfacestats_' + self.tap, second)
+        time.sleep(0.1)
+        third = self._cycle()
+        self.assertAlmostEqual(25, third['cpustats'].util, delta=5)
+        self.assertIsNotNone(third['interfacestats_' + self.tap])
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import time
+
+from libvirt_monitoring import inspector
+from libvirt_monitoring import poller
+
+from tests import fakes
+
+
+HV0 = 'test://hv0/default'
+HV1 = 'test://hv1/default'
+SLOW = 'test://slow/default'
+DOWN = 'test://down/default'
+
+
+class TestRemotePoller(fakes.TestCase):
+
+    def setUp(self):
+        super(TestRemotePoller, self).setUp()
+        self.fast = fakes.add_host(HV0, fakes.make_domains(3, 0))
+        self.other = fakes.add_host(HV1, fakes.make_domains(2, 1))
+        self.slow = fakes.add_host(SLOW, fakes.make_domains(1, 2),
+                                   delay=1.0)
+        self.down = fakes.add_host(DOWN, fail=True)
+
+    def _statuses(self, remote):
+        return dict((item.key, item.value)
+                    for item in remote.status_items())
+
+    def test_fast_hosts_are_merged(self):
+        remote = poller.RemotePoller([HV0, HV1],
+                                     workers=2, deadline=5)
+        metrics = remote.get_vm_metrics()
+        self.assertEqual(5, len(metrics))
+        statuses = self._statuses(remote)
+        self.assertEqual(poller.STATUS_UP,
+                         statuses[poller.status_key('hv0')])
+        self.assertEqual(3, statuses[poller.domains_key('hv0')])
+        self.assertEqual(2, statuses[poller.domains_key('hv1')])
+
+    def test_slow_host_does_not_delay_others(self):
+        remote = poller.RemotePoller([HV0, SLOW],
+                                     workers=2, deadline=0.3)
+        started = time.time()
+        metrics = remote.get_vm_metrics()
+        self.assertLess(time.time() - started, 0.9)
+        self.assertEqual(3, len(metrics))
+        statuses = self._statuses(remote)
+        self.assertEqual(poller.STATUS_UP,
+                         statuses[poller.status_key('hv0')])
+        self.assertEqual(poller.STATUS_TIMEOUT,
+                         statuses[poller.status_key('slow')])
+        self.assertEqual(0, statuses[poller.domains_key('slow')])
+
+        # Its poll is still running: skipped, the others are polled.
+        metrics = remote.get_vm_metrics()
+        self.assertEqual(3, len(metrics))
+        self.assertEqual(poller.STATUS_BUSY,
+                         self._statuses(remote)[poller.status_key('slow')])
+
+    def test_failing_host_is_down(self):
+        remote = poller.RemotePoller([HV0, DOWN],
+                                     workers=2, deadline=5)
+        metrics = remote.get_vm_metrics()
+        self.assertEqual(3, len(metrics))
+        statuses = self._statuses(remote)
+        self.assertEqual(poller.STATUS_DOWN,
+                         statuses[poller.status_key('down')])
+        self.assertEqual(poller.STATUS_UP,
+                         statuses[poller.status_key('hv0')])
+
+    def test_snapshots_of_all_hosts(self):
+        remote = poller.RemotePoller([HV0, HV1],
+                                     workers=2, deadline=5)
+        remote.get_vm_metrics()
+        uuids = set(r.uuid for r in remote.export_snapshots())
+        self.assertEqual(5, len(uuids))
+
+
+class TestVnicRates(fakes.TestCase):
+
+    def setUp(self):
+        super(TestVnicRates, self).setUp()
+        self.domains = fakes.make_domains(2, vnics=40)
+        fakes.add_host('test:///vnics', self.domains)
+        self.inspector = inspector.LibvirtInspector(uri='test:///vnics')
+
+    def _vnics(self, metrics):
+        return dict((key, value) for domain in metrics.values()
+                    for key, value in domain.items()
+                    if key.startswith('interfacestats_'))
+
+    def test_rates_from_previous_cycle(self):
+        started = time.time()
+        # First cycle only takes snapshots.
+        self.assertEqual({}, self._vnics(self.inspector.get_vm_metrics()))
+        time.sleep(0.2)
+        vnics = self._vnics(self.inspector.get_vm_metrics())
+        # interfaceStats is not sampled twice with a sleep in between.
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(80, len(vnics))
+        for stats in vnics.values():
+            self.assertAlmostEqual(8, stats.rx_megabit_ps, delta=1)
+            self.assertAlmostEqual(4, stats.tx_megabit_ps, delta=0.5)
+            self.assertAlmostEqual(500, stats.tx_packets_ps, delta=50)
+
+    def test_failing_interface(self):
+        self.inspector.get_vm_metrics()
+        self.domains[0].fail_vnics = True
+        vnics = self._vnics(self.inspector.get_vm_metrics())
+        failed = [key for key, stats in vnics.items() if stats is None]
+        self.assertEqual(40, len(failed))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from libvirt_monitoring import profiler
+
+
+def cycle():
+    return sum(range(1000))
+
+
+class TestCycleProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.directory = os.path.join(self.tmpdir, 'profiles')
+
+    def _run_cycles(self, profile, count):
+        for _ in range(count):
+            self.assertEqual(cycle(), profile.run(cycle))
+
+    def test_profiles_are_written(self):
+        for mode, ext in (('sampler', '.folded'), ('cprofile', '.pstats')):
+            shutil.rmtree(self.directory, ignore_errors=True)
+            profile = profiler.CycleProfiler(self.directory, cycles=2,
+                                             mode=mode)
+            profile.request_profile()
+            self._run_cycles(profile, 3)
+            names = os.listdir(self.directory)
+            self.assertEqual(2, len(names))
+            self.assertTrue(all(n.endswith(ext) for n in names))
+
+    def test_unwritable_directory(self):
+        # A file where the directory should be.
+        open(self.directory, 'w').close()
+        for mode in ('sampler', 'cprofile'):
+            profile = profiler.CycleProfiler(self.directory, cycles=2,
+                                             mode=mode)
+            profile.request_profile()
+            self._run_cycles(profile, 2)
+            self.assertEqual(0, profile._profile_cycles)
+
+    @unittest.skipIf(profiler.tracemalloc is None, 'needs tracemalloc')
+    def test_unwritable_directory_memory(self):
+        open(self.directory, 'w').close()
+        profile = profiler.CycleProfiler(self.directory, cycles=2)
+        profile.request_memory()
+        self._run_cycles(profile, 3)
+        self.assertEqual(0, profile._memory_cycles)
+        self.assertFalse(profiler.tracemalloc.is_tracing())
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import os
+
+from libvirt_monitoring import replay
+
+from tests import fakes
+
+
+URI = 'test:///default'
+UUID = '6695eb01-f6a4-8304-79aa-97f2502e193f'
+CYCLES = 3
+SEND_LATENCY = 0.1
+
+
+def write_trace(path):
+    events = []
+    for cycle in range(CYCLES):
+        events.append({'uri': URI, 'call': 'listAllDomains', 'cycle': cycle,
+                       't': 0, 'latency': 0, 'result': [UUID]})
+        events.append({'uri': URI, 'cycle': cycle, 'uuid': UUID,
+                       'call': 'ID', 'args': [], 't': 0, 'latency': 0,
+                       'result': 1})
+        events.append({'uri': URI, 'cycle': cycle, 'uuid': UUID,
+                       'call': 'info', 'args': [], 't': 0, 'latency': 0,
+                       'result': [1, 2048, 1024, 2, cycle * 10 ** 9]})
+        events.append({'call': 'zsender.send_messages', 'args': [1],
+                       't': 0, 'latency': SEND_LATENCY,
+                       'result': {'processed': 1, 'failed': 0,
+                                  'total': 1, 'time': '0.0001',
+                                  'chunk': 1}})
+    with gzip.open(path, 'wb') as f:
+        for event in events:
+            f.write((json.dumps(event) + '\n').encode('utf-8'))
+
+
+class TestReplay(fakes.TestCase):
+
+    config = {'zabbix_agent-provisioning': 'lld',
+              'thresholds-cpustats.number': 0,
+              'metrics-vcpustats': False,
+              'metrics-memoryusagestats': False,
+              'metrics-memoryresidentstats': False,
+              'metrics-interfacestats': False,
+              'metrics-diskstats': False,
+              'metrics-diskinfo': False}
+
+    def setUp(self):
+        super(TestReplay, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'trace.gz')
+        write_trace(self.path)
+
+    def _replay(self, fast):
+        trace = replay.Trace(self.path)
+        durations = replay.ReplayAgent(trace, fast).replay()
+        return trace, durations
+
+    def test_durations_include_send(self):
+        trace, durations = self._replay(fast=False)
+        self.assertEqual(CYCLES, len(durations))
+        for duration in durations:
+            self.assertGreaterEqual(duration, SEND_LATENCY)
+        self.assertEqual(0, len(trace.zabbix['zsender.send_messages']))
+
+    def test_fast_replay_sends_all_batches(self):
+        trace, durations = self._replay(fast=True)
+        self.assertEqual(CYCLES, len(durations))
+        self.assertEqual(0, len(trace.zabbix['zsender.send_messages']))
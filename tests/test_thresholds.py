@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from libvirt_monitoring import agent
+from libvirt_monitoring import base
+from libvirt_monitoring import lld
+from libvirt_monitoring import utils
+
+from tests import fakes
+
+
+class TestThresholds(fakes.TestCase):
+
+    def setUp(self):
+        super(TestThresholds, self).setUp()
+        self.agent = agent.LibvirtAgent.__new__(agent.LibvirtAgent)
+        self.agent.config = utils.ini_file_loader()
+        self.agent.item_log = utils.SampledLogger(
+            logging.getLogger(__name__), 1)
+
+    def _over(self, key, value):
+        return self.agent._over_threshold(
+            base.Item(key=key, name=key, value=value))
+
+    def test_cpu_utilization(self):
+        self.assertTrue(self._over('cpustats.util[vm1]', 95.0))
+        self.assertFalse(self._over('cpustats.util[vm1]', 20.0))
+        self.assertTrue(self._over('vcpustats_3.util[vm1]', 100.0))
+        self.assertFalse(self._over('vcpustats_3.util[vm1]', 10.0))
+        # Not a rate, never sent.
+        self.assertFalse(self._over('cpustats.time[vm1]', 10 ** 12))
+
+    def test_template_has_cpu_utilization(self):
+        template = lld.build_template(self.agent.config)
+        self.assertIn('libvirt.cpustats.util[{#UUID}]', str(template))
+        self.assertIn('libvirt.vcpustats.util[{#UUID},{#VCPU}]',
+                      str(template))
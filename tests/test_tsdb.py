@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from libvirt_monitoring import base
+from libvirt_monitoring import sinks
+from libvirt_monitoring import tsdb
+
+
+def metrics(*uuids):
+    return dict((uuid, {'cpustats': base.CPUStats(number=2, time=10,
+                                                  util=5.0)})
+                for uuid in uuids)
+
+
+class TestTimeSeriesStore(unittest.TestCase):
+
+    def test_range(self):
+        store = tsdb.TimeSeriesStore(capacity=3)
+        for clock in range(100, 105):
+            store.add(metrics('vm1'), clock)
+        times, values = store.query('vm1', 'cpustats', 'util', 102)
+        self.assertEqual([102.0, 103.0, 104.0], list(times))
+        self.assertEqual([5.0] * 3, list(values))
+        self.assertIsNone(store.query('vm1', 'cpustats', 'missing', 0))
+
+    def test_stale_series_are_dropped(self):
+        store = tsdb.TimeSeriesStore(capacity=10, max_age='60')
+        store.add(metrics('vm1', 'vm2'), 1000)
+        store.add(metrics('vm1'), 1030)
+        self.assertEqual(6, len(store.list()))
+        store.add(metrics('vm1'), 1061)
+        self.assertEqual(['vm1 cpustats.number', 'vm1 cpustats.time',
+                          'vm1 cpustats.util'], store.list())
+
+    def test_sink_max_age_from_config(self):
+        sink = sinks.load_sinks(None, {'default-outputs': 'tsdb',
+                                       'tsdb-socket': '/nonexistent.sock',
+                                       'tsdb-max_age': '120'})[0]
+        self.assertEqual(120, sink.store.max_age)
+        sink.write(sinks.Batch('agent', metrics('vm1'), [], clock=1000))
+        sink.write(sinks.Batch('agent', metrics('vm2'), [], clock=1200))
+        self.assertEqual(['vm2'], sorted(set(
+            series.split()[0] for series in sink.store.list())))
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from libvirt_monitoring.py_zabbix_api import zapi
+
+
+URL = 'http://frontend/zabbix'
+SESSION_TERMINATED = {'code': -32602, 'message': 'Invalid params.',
+                      'data': 'Session terminated, re-login, please.'}
+
+
+def chunked(content, size):
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+class FakeRaw(object):
+
+    """urllib3 response of a streamed request, in small chunks."""
+
+    def __init__(self, content):
+        self.content = content
+
+    def stream(self, amt, decode_content=True):
+        return iter(chunked(self.content, 7))
+
+
+class FakeResponse(object):
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.content = json.dumps(body).encode('utf-8')
+        self.raw = FakeRaw(self.content)
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeFrontend(object):
+
+    """requests.Session answering like a Zabbix frontend of a version.
+
+    Requests are recorded as (method, params, auth, headers), auth is
+    the token of the request, from its property or Bearer header.
+    """
+
+    def __init__(self, version='7.0.0'):
+        self.headers = {}
+        self.version = version
+        self.tokens = set()
+        # False for a frontend dropping every new session at once.
+        self.keep_sessions = True
+        self.requests = []
+        self.items = []
+
+    def expire(self):
+        """Terminate all sessions, server side."""
+        self.tokens.clear()
+
+    def calls(self, method):
+        return [r for r in self.requests if r[0] == method]
+
+    def post(self, url, data=None, headers=None, timeout=None,
+             stream=False):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        request = json.loads(data)
+        auth = request.get('auth')
+        if headers and 'Authorization' in headers:
+            auth = headers['Authorization'].split(' ', 1)[1]
+        self.requests.append((request['method'], request['params'], auth,
+                              headers))
+        try:
+            body = {'result': self._handle(request['method'],
+                                           request['params'], auth)}
+        except zapi.ZabbixAPIException as e:
+            body = {'error': e.args[0]}
+        body.update({'jsonrpc': '2.0', 'id': request['id']})
+        return FakeResponse(body)
+
+    def _handle(self, method, params, auth):
+        if method == 'apiinfo.version':
+            return self.version
+        if method == 'user.login':
+            major, minor = [int(v) for v in self.version.split('.')[:2]]
+            name = 'username' if (major, minor) >= (5, 4) else 'user'
+            if name not in params or len(params) != 2:
+                raise zapi.ZabbixAPIException({
+                    'code': -32602, 'message': 'Invalid params.',
+                    'data': 'Invalid parameter "/": unexpected '
+                            'parameter.'})
+            token = 'token%d' % (len(self.calls('user.login')) - 1)
+            if self.keep_sessions:
+                self.tokens.add(token)
+            return token
+        if auth not in self.tokens:
+            raise zapi.ZabbixAPIException(SESSION_TERMINATED)
+        if method == 'history.push':
+            return {'response': 'success',
+                    'data': [{'itemid': '1'} for _ in params]}
+        if method == 'item.get':
+            items = self.items
+            if 'itemids' in params:
+                items = [i for i in items if i['itemid'] in params['itemids']]
+            if 'sortfield' in params:
+                items = sorted(items, key=lambda i: int(i['itemid']))
+            if params.get('output') != 'extend':
+                items = [dict((k, i[k]) for k in params['output'])
+                         for i in items]
+            return items
+        return []
+
+
+HISTORY = '[{"host": "h", "key": "k", "value": "1", "clock": 1}]'
+
+
+class TestLogin(unittest.TestCase):
+
+    def _api(self, frontend, **kwargs):
+        return zapi.ZabbixAPI(URL, user='agent', password='secret',
+                              session=frontend, **kwargs)
+
+    def test_login_parameter_of_version(self):
+        for version, name in (('7.0.5', 'username'), ('6.0.30', 'username'),
+                              ('5.4.0', 'username'), ('5.2.7', 'user')):
+            frontend = FakeFrontend(version)
+            api = self._api(frontend)
+            self.assertEqual('token0', api.auth)
+            params = frontend.calls('user.login')[0][1]
+            self.assertEqual({name: 'agent', 'password': 'secret'}, params)
+
+    def test_history_push_lazy_login_and_relogin(self):
+        frontend = FakeFrontend()
+        api = self._api(frontend, login=False)
+        self.assertEqual([], frontend.requests)
+
+        result = api.push_history(HISTORY)
+        self.assertEqual('success', result['response'])
+        self.assertEqual(1, len(frontend.calls('user.login')))
+        push = frontend.calls('history.push')[-1]
+        self.assertEqual({'Authorization': 'Bearer token0'}, push[3])
+
+        frontend.expire()
+        api.push_history(HISTORY)
+        self.assertEqual(2, len(frontend.calls('user.login')))
+        # Version is asked once.
+        self.assertEqual(1, len(frontend.calls('apiinfo.version')))
+        push = frontend.calls('history.push')[-1]
+        self.assertEqual({'Authorization': 'Bearer token1'}, push[3])
+
+    def test_api_token_is_not_renewed(self):
+        frontend = FakeFrontend()
+        frontend.tokens.add('api-token')
+        api = self._api(frontend, api_token='api-token')
+        api.push_history(HISTORY)
+        self.assertEqual('Bearer api-token',
+                         frontend.requests[-1][3]['Authorization'])
+        frontend.expire()
+        self.assertRaises(zapi.ZabbixAPISessionExpired,
+                          api.push_history, HISTORY)
+        self.assertEqual([], frontend.calls('user.login'))
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = os.path.join(self.tmpdir, 'zabbix', 'token')
+        self.frontend = FakeFrontend()
+
+    def _api(self, user='agent'):
+        return zapi.ZabbixAPI(URL, user=user, password='secret',
+                              session=self.frontend, token_cache=self.cache)
+
+    def test_cache_is_private(self):
+        self._api()
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.cache).st_mode))
+        self.assertEqual(0o700, stat.S_IMODE(
+            os.stat(os.path.dirname(self.cache)).st_mode))
+        with open(self.cache) as f:
+            self.assertEqual({'url': URL + '/api_jsonrpc.php',
+                              'user': 'agent', 'auth': 'token0'},
+                             json.load(f))
+
+    def test_cached_token_is_reused(self):
+        self._api()
+        api = self._api()
+        self.assertEqual('token0', api.auth)
+        self.assertEqual(1, len(self.frontend.calls('user.login')))
+        api.host.get()
+        self.assertEqual('token0', self.frontend.requests[-1][2])
+
+    def test_invalid_cache(self):
+        os.makedirs(os.path.dirname(self.cache))
+        with open(self.cache, 'w') as f:
+            f.write('{not json')
+        self.assertEqual('token0', self._api().auth)
+        # Token of another user.
+        self.assertEqual('token1', self._api(user='other').auth)
+        self.assertEqual(2, len(self.frontend.calls('user.login')))
+
+    def test_expired_cached_token(self):
+        self._api()
+        self.frontend.expire()
+        api = self._api()
+        self.assertEqual([], api.host.get())
+        self.assertEqual(2, len(self.frontend.calls('user.login')))
+        with open(self.cache) as f:
+            self.assertEqual('token1', json.load(f)['auth'])
+
+
+class TestRelogin(unittest.TestCase):
+
+    def setUp(self):
+        self.frontend = FakeFrontend()
+        self.api = zapi.ZabbixAPI(URL, user='agent', password='secret',
+                                  session=self.frontend)
+
+    def test_relogin_once(self):
+        self.frontend.expire()
+        self.assertEqual([], self.api.host.get())
+        self.assertEqual(2, len(self.frontend.calls('user.login')))
+        self.assertEqual('token1', self.frontend.requests[-1][2])
+
+    def test_relogin_is_not_repeated(self):
+        self.frontend.expire()
+        self.frontend.keep_sessions = False
+        self.assertRaises(zapi.ZabbixAPISessionExpired, self.api.host.get)
+        self.assertEqual(2, len(self.frontend.calls('user.login')))
+        self.assertEqual(2, len(self.frontend.calls('host.get')))
+
+
+class TestStreamedResponse(unittest.TestCase):
+
+    def _parse(self, body, size):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        return list(zapi._iter_response(chunked(body, size)))
+
+    def test_chunk_boundaries(self):
+        items = [{'itemid': str(n), 'name': u'caf\xe9 \u20ac %d' % n,
+                  'lastvalue': 1234567 * n} for n in range(20)]
+        body = json.dumps({'jsonrpc': '2.0', 'result': items, 'id': 1},
+                          ensure_ascii=False).encode('utf-8')
+        # Down to one byte chunks: multibyte characters and numbers
+        # are split between chunks.
+        for size in (1, 2, 3, 5, 64, len(body)):
+            self.assertEqual([('result', item) for item in items],
+                             self._parse(body, size))
+        # Scalar result and a number ending the body.
+        self.assertEqual([('result', 1234)],
+                         self._parse(b'{"id": 1, "result": 1234}', 1))
+        self.assertEqual([('result', '7.0.0')],
+                         self._parse(b'{"result":"7.0.0","id":12345}', 1))
+
+    def test_empty_results(self):
+        for body in (b'{}', b' { } ', b'{"result": [], "id": 1}',
+                     b'{"result":[ ],"id":1}'):
+            self.assertEqual([], self._parse(body, 1))
+
+    def test_error_body(self):
+        body = {'jsonrpc': '2.0', 'error': SESSION_TERMINATED, 'id': 1}
+        self.assertEqual([('error', SESSION_TERMINATED)],
+                         self._parse(body, 3))
+
+    def test_invalid_body(self):
+        for body in (b'', b'[]', b'{"result": [{"itemid": "1"}',
+                     b'{"result": [1 2]}', b'<html>'):
+            self.assertRaises(zapi.ZabbixAPIException, self._parse, body, 4)
+
+
+class TestPaging(unittest.TestCase):
+
+    def setUp(self):
+        self.frontend = FakeFrontend()
+        self.frontend.items = [{'itemid': str(n), 'key_': 'key%d' % n}
+                               for n in range(25, 0, -1)]
+        self.api = zapi.ZabbixAPI(URL, user='agent', password='secret',
+                                  session=self.frontend)
+
+    def test_iter_request(self):
+        items = list(self.api.iter_request('item.get', {'output': 'extend'}))
+        self.assertEqual(self.frontend.items, items)
+        self.frontend.expire()
+        self.frontend.keep_sessions = False
+        self.assertRaises(zapi.ZabbixAPISessionExpired, list,
+                          self.api.iter_request('item.get', {}))
+
+    def test_iter_request_relogin(self):
+        self.frontend.expire()
+        self.assertEqual(25, len(list(self.api.iter_request(
+            'item.get', {'output': ['itemid']}))))
+        self.assertEqual(2, len(self.frontend.calls('user.login')))
+
+    def test_get_paged(self):
+        items = list(self.api.get_paged(
+            'item', {'output': 'extend', 'selectTags': 'extend'},
+            page_size=10))
+        self.assertEqual([str(n) for n in range(1, 26)],
+                         [i['itemid'] for i in items])
+        calls = self.frontend.calls('item.get')
+        # IDs first, without select options, then 3 pages.
+        self.assertEqual({'output': ['itemid']}, calls[0][1])
+        self.assertEqual([10, 10, 5],
+                         [len(c[1]['itemids']) for c in calls[1:]])
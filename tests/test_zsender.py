@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import socket
+import unittest
+
+from libvirt_monitoring.py_zabbix_api.zsender import ZabbixSender
+
+
+class FlakySender(ZabbixSender):
+
+    """Trapper which refuses packets after `accept` of them."""
+
+    def __init__(self, **kwargs):
+        ZabbixSender.__init__(self, chunk_size=2, probe_interval=0,
+                              **kwargs)
+        self.accept = None
+        self.sent = []
+
+    def _build_packet(self, messages):
+        return list(messages)
+
+    def _send_packet(self, host_addr, packet):
+        if self.accept is not None:
+            if not self.accept:
+                raise socket.error('Connection refused')
+            self.accept -= 1
+        self.sent.extend(packet)
+        return {'response': 'success',
+                'info': 'processed: %d; failed: 0; total: %d; '
+                        'seconds spent: 0.000100' % (len(packet),
+                                                     len(packet))}
+
+
+class TestSendFailure(unittest.TestCase):
+
+    def test_unsent_messages_are_buffered(self):
+        sender = FlakySender(shed_policy='buffer')
+        sender.accept = 1
+        self.assertRaises(socket.error, sender.send_messages, list('abcde'))
+        self.assertEqual(list('ab'), sender.sent)
+        self.assertEqual(list('cde'), list(sender._backlog))
+        # Backlog is sent first, and kept while sends fail.
+        sender.accept = 0
+        self.assertRaises(socket.error, sender.send_messages, ['f'])
+        self.assertEqual(list('cdef'), list(sender._backlog))
+        sender.accept = None
+        response = sender.send_messages(['g'])
+        self.assertEqual(5, response.processed)
+        self.assertEqual(list('abcdefg'), sender.sent)
+        self.assertEqual(0, len(sender._backlog))
+
+    def test_drop_policy(self):
+        sender = FlakySender(shed_policy='drop')
+        sender.accept = 1
+        self.assertRaises(socket.error, sender.send_messages, list('abcde'))
+        self.assertEqual(0, len(sender._backlog))